@@ -0,0 +1,1805 @@
+#!/usr/bin/env python3
+"""
+Load test / benchmark for the GoEye customization sync server
+
+Starts web_server.py locally in a scratch directory (so the real
+customization_data.json is never touched) and drives it with simulated
+devices. Only the standard library is used.
+
+    python3 benchmark_server.py load --engines single threaded asyncio
+    python3 benchmark_server.py fleet --devices 500 --output fleet.json --baseline baseline.json
+"""
+import argparse
+import contextlib
+import gzip
+import heapq
+import http.client
+import importlib.util
+import json
+import multiprocessing
+import os
+import platform
+import py_compile
+import random
+import shlex
+import selectors
+import shutil
+import socket
+import subprocess
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_SCRIPT = os.path.join(SCRIPT_DIR, 'web_server.py')
+# The Flutter web build lives at the repo root in this checkout
+WEB_ROOT = SCRIPT_DIR
+API_PATH = '/api/customizations'
+LARGE_STATIC_PATH = '/main.dart.js'
+# Ways to run the app for the `interfaces` comparison: (name, web_server.py args,
+# `python -m` command for an external server or None, module that must be installed)
+INTERFACES = [
+    ('http.server (threaded)', ['--engine', 'threaded'], None, None),
+    ('wsgiref (threaded WSGI)', ['--engine', 'wsgi'], None, None),
+    ('gunicorn gthread (WSGI)', [], ['gunicorn', '--bind', '127.0.0.1:{port}', '--workers', '1',
+                                     '--worker-class', 'gthread', '--threads', '32', 'web_server:wsgi_app'],
+     'gunicorn'),
+    ('waitress (WSGI)', [], ['waitress', '--listen=127.0.0.1:{port}', '--threads=32', 'web_server:wsgi_app'],
+     'waitress'),
+    ('uvicorn (ASGI)', [], ['uvicorn', '--port', '{port}', '--no-access-log', '--log-level', 'warning',
+                            'web_server:asgi_app'], 'uvicorn'),
+    ('hypercorn (ASGI)', [], ['hypercorn', '--bind', '127.0.0.1:{port}', 'web_server:asgi_app'], 'hypercorn'),
+]
+# What a browser fetches on a cold load of the Flutter web app
+COLD_LOAD_PATHS = [
+    '/', '/flutter_bootstrap.js', '/manifest.json', '/favicon.png', '/icons/Icon-192.png',
+    '/main.dart.js', '/canvaskit/skwasm.js', '/canvaskit/skwasm.wasm', '/canvaskit/canvaskit.js',
+    '/assets/AssetManifest.bin.json', '/assets/FontManifest.json',
+    '/assets/fonts/MaterialIcons-Regular.otf', '/version.json', '/flutter_service_worker.js',
+]
+# Accept-Encoding headers compared by `compression`: none, a gzip-only client and a current browser
+COLD_LOAD_ENCODINGS = (None, 'gzip', 'gzip, deflate, br')
+
+# Request kinds simulated by `fleet`
+FLEET_KINDS = ('poll', 'upload', 'admin', 'coldload')
+# Metrics compared against a --baseline: (name, +1 if higher is better or -1 if
+# lower is better, smallest absolute change that counts as a regression)
+FLEET_BASELINE_METRICS = [
+    ('rps', +1, 0.0),
+    ('error_pct', -1, 0.1),
+    ('shed_pct', -1, 0.1),
+    ('server_peak_rss_MB', -1, 2.0),
+] + [(f'{kind}_{stat}_ms', -1, 1.0) for kind in FLEET_KINDS for stat in ('p50', 'p95', 'p99')]
+# A baseline is only comparable when these settings match
+FLEET_CONFIG_KEYS = ('devices', 'duration', 'poll_interval', 'upload_rate', 'admin_interval', 'admin_burst',
+                     'cold_loads_per_min', 'storm', 'follow_advice', 'server_args')
+
+
+def free_port():
+    """Ask the OS for an unused TCP port"""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def raise_open_file_limit():
+    """Thousands of simulated subscribers need thousands of sockets"""
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    target = 65536 if hard == resource.RLIM_INFINITY else min(hard, 65536)
+    if soft != resource.RLIM_INFINITY and soft < target:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def make_workdir():
+    """Throwaway working directory for web_server.py: the seed data, and the web build as build/web"""
+    workdir = tempfile.mkdtemp(prefix='goeye-bench-')
+    shutil.copy(os.path.join(SCRIPT_DIR, 'initial_customization_data.json'), workdir)
+    os.makedirs(os.path.join(workdir, 'build'))
+    os.symlink(WEB_ROOT, os.path.join(workdir, 'build', 'web'))
+    return workdir
+
+
+def server_env():
+    """Environment for web_server.py subprocesses"""
+    # Keep the caller's PYTHONPATH so optional packages installed there (brotli, Pillow) are found
+    return dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [SCRIPT_DIR, os.environ.get('PYTHONPATH')])))
+
+
+def precompress_web_root():
+    """Run the deploy step that writes the web build's .br/.gz sidecars (only stale ones are redone)"""
+    workdir = make_workdir()
+    try:
+        subprocess.run([sys.executable, SERVER_SCRIPT, '--precompress-only'], cwd=workdir, env=server_env(),
+                       stdout=subprocess.DEVNULL, check=True)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+class ServerProcess:
+    """web_server.py running in a throwaway working directory.
+
+    With `module_command`, `python -m <module_command>` is run instead (an
+    external WSGI/ASGI server importing web_server); `{port}` in it is
+    replaced with the port. `prepare(workdir)` runs before the server starts;
+    `startup_seconds` is the time from launching it to its first healthy answer.
+    """
+
+    def __init__(self, server_args=(), port=None, module_command=None, prepare=None):
+        self.port = port or free_port()
+        self.workdir = make_workdir()
+        if prepare is not None:
+            prepare(self.workdir)
+        started = time.perf_counter()
+        if module_command is None:
+            # Sidecars are served if present, but aren't (re)built in the background during a measurement;
+            # `compression` runs the build step first
+            command = [sys.executable, SERVER_SCRIPT, '--port', str(self.port), '--no-precompress', *server_args]
+        else:
+            command = [sys.executable, '-m', *(arg.format(port=self.port) for arg in module_command)]
+        self.process = subprocess.Popen(command, cwd=self.workdir, env=server_env(),
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self._wait_healthy()
+        self.startup_seconds = time.perf_counter() - started
+
+    def _wait_healthy(self, timeout=10):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError('web_server.py exited during startup')
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=1)
+                conn.request('GET', '/health')
+                if conn.getresponse().status == 200:
+                    conn.close()
+                    return
+            except OSError:
+                time.sleep(0.01)
+        raise RuntimeError('web_server.py did not become healthy')
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def poll_loop(port, stop, latencies, errors):
+    """One device polling the API as fast as the server answers (keep-alive)"""
+    conn = None
+    while not stop.is_set():
+        try:
+            if conn is None:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            start = time.perf_counter()
+            conn.request('GET', API_PATH)
+            response = conn.getresponse()
+            response.read()
+            latencies.append(time.perf_counter() - start)
+            if response.status != 200:
+                errors.append(response.status)
+            if response.getheader('Connection', '').lower() == 'close':
+                conn.close()
+                conn = None
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(type(e).__name__)
+            if conn is not None:
+                conn.close()
+            conn = None
+    if conn is not None:
+        conn.close()
+
+
+class SlowConnection(http.client.HTTPConnection):
+    """Connection with a tiny receive window, so loopback buffers cannot hide a slow reader"""
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect((self.host, self.port))
+
+
+def slow_download_loop(port, stop, chunk_size=4096, delay=0.05):
+    """A phone on bad Wi-Fi pulling the large Flutter bundle slowly"""
+    while not stop.is_set():
+        try:
+            conn = SlowConnection('127.0.0.1', port, timeout=30)
+            conn.request('GET', LARGE_STATIC_PATH)
+            response = conn.getresponse()
+            while not stop.is_set() and response.read(chunk_size):
+                time.sleep(delay)
+            conn.close()
+        except (OSError, http.client.HTTPException):
+            time.sleep(delay)
+
+
+def process_cpu_seconds(pid):
+    """User+system CPU seconds consumed by a process (Linux /proc), or None"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def process_peak_rss_mb(pid):
+    """Peak resident set size of a process in MB (Linux /proc), or None"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def process_rss_mb(pid):
+    """Current resident set size of a process in MB (Linux /proc), or None"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+class ShedError(RuntimeError):
+    """The server turned the request away (503 or 429) instead of serving it"""
+
+
+def cold_load(port, headers=None):
+    """Fetch every file of a Flutter web cold load over one connection; returns bytes received"""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    received = 0
+    for path in COLD_LOAD_PATHS:
+        conn.request('GET', path, headers=headers or {})
+        response = conn.getresponse()
+        body = response.read()
+        received += response_size(response, body)
+        if response.status in (429, 503):
+            conn.close()
+            raise ShedError(f'{path}: HTTP {response.status}')
+        if response.status not in (200, 206, 304):
+            raise RuntimeError(f'{path}: HTTP {response.status}')
+    conn.close()
+    return received
+
+
+def run_revisit(server_args):
+    """A cold load, then the same page load again sending the validators it got back.
+
+    Also fetches the large bundle in two ranged halves to check resumed
+    downloads reassemble to the full file.
+    """
+    with ServerProcess(server_args) as server:
+        conn = http.client.HTTPConnection('127.0.0.1', server.port, timeout=60)
+        validators, first, second, statuses = {}, 0, 0, {}
+        for path in COLD_LOAD_PATHS:
+            conn.request('GET', path)
+            response = conn.getresponse()
+            body = response.read()
+            first += response_size(response, body)
+            validators[path] = response.getheader('ETag'), response.getheader('Last-Modified')
+        for path in COLD_LOAD_PATHS:
+            etag, last_modified = validators[path]
+            headers = {'If-None-Match': etag} if etag else {'If-Modified-Since': last_modified}
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+            body = response.read()
+            second += response_size(response, body)
+            statuses[response.status] = statuses.get(response.status, 0) + 1
+
+        conn.request('GET', LARGE_STATIC_PATH)
+        full = conn.getresponse().read()
+        half = len(full) // 2
+        parts = []
+        for byte_range in (f'bytes=0-{half - 1}', f'bytes={half}-'):
+            conn.request('GET', LARGE_STATIC_PATH, headers={'Range': byte_range})
+            response = conn.getresponse()
+            parts.append((response.status, response.read()))
+        conn.request('GET', LARGE_STATIC_PATH, headers={'Range': f'bytes={len(full)}-'})
+        response = conn.getresponse()
+        response.read()
+        unsatisfiable = response.status
+        conn.close()
+    return {
+        'first_load_KB': first / 1024,
+        'revisit_KB': second / 1024,
+        'revisit_pct': 100.0 * second / first if first else 0.0,
+        'revisit_statuses': ' '.join(f'{code}x{n}' for code, n in sorted(statuses.items())),
+        'range_resume_ok': all(status == 206 for status, _ in parts) and b''.join(b for _, b in parts) == full,
+        'range_416_ok': unsatisfiable == 416,
+    }
+
+
+def write_test_png(path, width, height, seed):
+    """A gradient PNG written with the standard library, standing in for a product photo"""
+    row = bytearray(width * 3)
+    row[0::3] = bytes(x * 255 // width for x in range(width))
+    row[2::3] = bytes((x * 7 + seed) & 255 for x in range(width))
+    raw = bytearray()
+    for y in range(height):
+        row[1::3] = bytes([(y * 255 // height + seed) & 255]) * width
+        raw += b'\0' + row
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+                + chunk(b'IDAT', zlib.compress(bytes(raw), 6)) + chunk(b'IEND', b''))
+
+
+def _get_image(port, path):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    start = time.perf_counter()
+    conn.request('GET', path, headers={'Accept': 'image/webp'})
+    response = conn.getresponse()
+    body = response.read()
+    conn.close()
+    return response.status, len(body), time.perf_counter() - start
+
+
+def run_images(sources, clients, hits, server_args):
+    """Resize throughput, coalescing of identical requests and cache-hit latency for /img/"""
+    with ServerProcess(server_args) as server:
+        image_dir = os.path.join(server.workdir, 'images')
+        os.makedirs(image_dir, exist_ok=True)
+        for i in range(sources):
+            write_test_png(os.path.join(image_dir, f'photo{i}.png'), 1600, 1200, i)
+        status = _get_image(server.port, '/img/photo0.png?w=8')[0]
+        if status == 501:
+            return {'error': 'the server has no Pillow; pip install Pillow'}
+
+        def images_stats():
+            conn = http.client.HTTPConnection('127.0.0.1', server.port, timeout=10)
+            conn.request('GET', '/health')
+            stats = json.loads(conn.getresponse().read())['images']
+            conn.close()
+            return stats
+
+        # Every request is a new variant: resize throughput with `clients` in parallel
+        paths = [f'/img/photo{i}.png?w={width}' for i in range(sources) for width in (200, 400, 800)]
+        variants = len(paths)
+        results = []
+        lock = threading.Lock()
+
+        def fetch(queue):
+            while True:
+                with lock:
+                    if not queue:
+                        return
+                    path = queue.pop()
+                result = _get_image(server.port, path)
+                with lock:
+                    results.append(result)
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=fetch, args=(paths,)) for _ in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        resize_wall = time.perf_counter() - start
+        resized = sum(1 for status, _, _ in results if status == 200)
+
+        # Identical requests arriving together share one resize
+        before = images_stats()
+        burst = [threading.Thread(target=_get_image, args=(server.port, '/img/photo0.png?w=321'))
+                 for _ in range(clients)]
+        for thread in burst:
+            thread.start()
+        for thread in burst:
+            thread.join()
+        after = images_stats()
+
+        latencies = [_get_image(server.port, '/img/photo0.png?w=200')[2] for _ in range(hits)]
+    # Resizing processes the server ran: one per core unless --image-workers says otherwise
+    workers = os.cpu_count() or 1
+    if '--image-workers' in server_args:
+        workers = int(server_args[server_args.index('--image-workers') + 1])
+    return {
+        'variants': variants,
+        'resized_ok': resized,
+        'resizes_per_s': resized / resize_wall,
+        'resizes_per_s_per_worker': resized / resize_wall / workers,
+        'workers': workers,
+        'burst_requests': clients,
+        'burst_resizes': after['misses'] - before['misses'],
+        'hit_p50_ms': percentile(latencies, 50) * 1000,
+        'hit_p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+
+def run_cold_loads(clients, loads, server_args, headers=None):
+    """`clients` browsers each doing `loads` cold loads at once, sending `headers` with every request"""
+    with ServerProcess(server_args) as server:
+        latencies, received, errors = [], [], []
+        cpu_before = process_cpu_seconds(server.process.pid)
+
+        def browser():
+            for _ in range(loads):
+                start = time.perf_counter()
+                try:
+                    received.append(cold_load(server.port, headers))
+                    latencies.append(time.perf_counter() - start)
+                except (OSError, http.client.HTTPException, RuntimeError) as e:
+                    errors.append(str(e))
+
+        threads = [threading.Thread(target=browser) for _ in range(clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        peak_rss = process_peak_rss_mb(server.process.pid)
+        cpu_after = process_cpu_seconds(server.process.pid)
+    cpu = cpu_after - cpu_before if cpu_before is not None and cpu_after is not None else None
+    return {
+        'clients': clients,
+        'cold_loads': len(latencies),
+        'errors': len(errors),
+        'MB_per_load': (sum(received) / len(received) / 1e6) if received else 0.0,
+        'MB_per_s': sum(received) / elapsed / 1e6,
+        'p50_load_ms': percentile(latencies, 50) * 1000,
+        'p99_load_ms': percentile(latencies, 99) * 1000,
+        'server_peak_rss_MB': peak_rss if peak_rss is not None else 'n/a',
+        'server_cpu_s': cpu if cpu is not None else 'n/a',
+    }
+
+
+def response_size(response, body):
+    """Approximate bytes on the wire for a response: status line, headers and body"""
+    return len(f'HTTP/1.1 {response.status} {response.reason}\r\n') + len(str(response.msg)) + len(body)
+
+
+def run_conditional_polls(polls, conditional):
+    """Poll the API `polls` times over one connection, optionally with If-None-Match"""
+    with ServerProcess() as server:
+        conn = http.client.HTTPConnection('127.0.0.1', server.port, timeout=30)
+        etag = None
+        bytes_received = 0
+        statuses = {}
+        cpu_before = process_cpu_seconds(server.process.pid)
+        start = time.perf_counter()
+        for _ in range(polls):
+            headers = {'If-None-Match': etag} if conditional and etag else {}
+            conn.request('GET', API_PATH, headers=headers)
+            response = conn.getresponse()
+            body = response.read()
+            etag = response.getheader('ETag') or etag
+            bytes_received += response_size(response, body)
+            statuses[response.status] = statuses.get(response.status, 0) + 1
+        elapsed = time.perf_counter() - start
+        cpu_after = process_cpu_seconds(server.process.pid)
+        conn.close()
+    cpu = cpu_after - cpu_before if cpu_before is not None and cpu_after is not None else None
+    return {
+        'mode': 'If-None-Match' if conditional else 'unconditional',
+        'polls': polls,
+        'bytes': bytes_received,
+        'bytes_per_poll': bytes_received / polls,
+        'server_cpu_s': cpu if cpu is not None else 'n/a',
+        'wall_s': elapsed,
+        'statuses': ' '.join(f'{k}x{v}' for k, v in sorted(statuses.items())),
+    }
+
+
+def post_document(port, document):
+    """Upload a full document; returns the version the server assigned"""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    conn.request('POST', API_PATH, body=json.dumps(document),
+                 headers={'Content-Type': 'application/json'})
+    result = json.loads(conn.getresponse().read())
+    conn.close()
+    return result.get('version')
+
+
+def grow_document(document, items):
+    """`document` with every array section grown to `items` entries, as merchandising does over time"""
+    grown = dict(document)
+    for key, value in document.items():
+        if isinstance(value, list) and value and isinstance(value[0], dict):
+            grown[key] = [dict(value[i % len(value)], id=str(i + 1)) for i in range(max(items, len(value)))]
+    return grown
+
+
+def run_formats(items, repeats):
+    """Size and encode/decode time of the document as JSON, MessagePack and CBOR, and what the server sends"""
+    sys.path.insert(0, SCRIPT_DIR)
+    import web_server
+    with open(os.path.join(SCRIPT_DIR, 'initial_customization_data.json')) as f:
+        document = grow_document(json.load(f), items)
+
+    codecs = [
+        ('json', 'application/json',
+         lambda data: json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8'),
+         lambda body: json.loads(body)),
+        ('msgpack', web_server.MSGPACK_MEDIA_TYPE, web_server.msgpack_encode, web_server.msgpack_decode),
+        ('cbor', web_server.CBOR_MEDIA_TYPE, web_server.cbor_encode, web_server.cbor_decode),
+    ]
+    json_bytes = len(codecs[0][2](document))
+    rows = []
+    with ServerProcess() as server:
+        post_document(server.port, document)
+        conn = http.client.HTTPConnection('127.0.0.1', server.port, timeout=30)
+        for name, media_type, encode, decode in codecs:
+            body = encode(document)
+            encode_s = min(_timed(encode, document) for _ in range(repeats))
+            decode_s = min(_timed(decode, body) for _ in range(repeats))
+            conn.request('GET', API_PATH, headers={'Accept': media_type, 'Accept-Encoding': 'gzip'})
+            response = conn.getresponse()
+            wire = response.read()
+            wire_body = gzip.decompress(wire) if response.getheader('Content-Encoding') == 'gzip' else wire
+            rows.append({
+                'format': name,
+                'bytes': len(body),
+                'vs_json_pct': 100.0 * len(body) / json_bytes,
+                'gzip_bytes': len(wire),
+                'encode_ms': encode_s * 1000,
+                'decode_ms': decode_s * 1000,
+                'served_ok': decode(wire_body) == document,
+            })
+        conn.close()
+    return rows
+
+
+def _timed(fn, arg):
+    start = time.perf_counter()
+    fn(arg)
+    return time.perf_counter() - start
+
+
+class FeedSubscribers:
+    """N SSE or long-poll subscribers driven from a single selector thread.
+
+    Records, per document version, the moment each subscriber received it.
+    """
+
+    def __init__(self, port, count, mode):
+        self.port = port
+        self.mode = mode
+        self.selector = selectors.DefaultSelector()
+        self.received = {}
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.version = None
+        for _ in range(count):
+            self._connect(self.version)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _connect(self, version):
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        if self.mode == 'sse':
+            path = f'{API_PATH}/stream'
+        else:
+            path = f'{API_PATH}?wait={version}' if version is not None else API_PATH
+        sock.sendall(f'GET {path} HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n\r\n'.encode())
+        sock.setblocking(False)
+        self.selector.register(sock, selectors.EVENT_READ, bytearray())
+
+    def _record(self, version):
+        now = time.perf_counter()
+        with self.lock:
+            self.received.setdefault(version, []).append(now)
+
+    def _run(self):
+        while not self.stop.is_set():
+            for key, _ in self.selector.select(timeout=0.2):
+                buffer = key.data
+                try:
+                    chunk = key.fileobj.recv(65536)
+                except BlockingIOError:
+                    continue
+                except OSError:
+                    chunk = b''
+                if chunk:
+                    buffer += chunk
+                    if self.mode == 'sse':
+                        self._parse_events(buffer)
+                    continue
+                # Connection closed: a complete long-poll response
+                self.selector.unregister(key.fileobj)
+                key.fileobj.close()
+                if self.mode == 'longpoll':
+                    version = self._response_version(buffer)
+                    if version is not None:
+                        self._record(version)
+                    if not self.stop.is_set():
+                        self._connect(version)
+
+    def _parse_events(self, buffer):
+        while b'\n\n' in buffer:
+            frame, _, rest = bytes(buffer).partition(b'\n\n')
+            buffer[:] = rest
+            for line in frame.split(b'\n'):
+                if line.startswith(b'id: '):
+                    self._record(int(line[4:]))
+
+    @staticmethod
+    def _response_version(buffer):
+        head = bytes(buffer).split(b'\r\n\r\n', 1)[0].decode('latin-1')
+        for line in head.split('\r\n'):
+            name, _, value = line.partition(':')
+            if name.lower() == 'x-customization-version':
+                return int(value.strip())
+        return None
+
+    def wait_for(self, version, count, timeout):
+        """Block until `count` subscribers have received `version`"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self.lock:
+                if len(self.received.get(version, ())) >= count:
+                    return True
+            time.sleep(0.01)
+        return False
+
+    def close(self):
+        self.stop.set()
+        self.thread.join(timeout=5)
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+
+
+def run_soak(subscribers, updates, mode, server_args):
+    """Measure how long an update takes to reach every subscriber"""
+    raise_open_file_limit()
+    with open(os.path.join(SCRIPT_DIR, 'initial_customization_data.json')) as f:
+        document = json.load(f)
+    with ServerProcess(server_args) as server:
+        feed = FeedSubscribers(server.port, subscribers, mode)
+        # Wait until every subscriber is connected and current
+        if mode == 'sse':
+            time.sleep(1)
+            version = max(feed.received) if feed.received else 0
+            feed.wait_for(version, subscribers, timeout=30)
+        else:
+            # Long-pollers need a version to wait on: give them one
+            version = post_document(server.port, document)
+            feed.wait_for(version, subscribers, timeout=30)
+        latencies, missed = [], 0
+        for i in range(updates):
+            document['promotionalBannerText'] = f'Soak update {i}'
+            time.sleep(0.5)
+            sent = time.perf_counter()
+            version = post_document(server.port, document)
+            if not feed.wait_for(version, subscribers, timeout=10):
+                missed += 1
+            with feed.lock:
+                latencies += [t - sent for t in feed.received.get(version, ())]
+        feed.close()
+    return {
+        'mode': mode,
+        'subscribers': subscribers,
+        'updates': updates,
+        'deliveries': len(latencies),
+        'incomplete_updates': missed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': max(latencies, default=0) * 1000,
+    }
+
+
+def patch_loop(port, writer, patches, latencies, errors):
+    """One admin sending small merge patches back to back"""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    for i in range(patches):
+        body = json.dumps({'promotionalBannerText': f'Writer {writer} edit {i}'})
+        start = time.perf_counter()
+        conn.request('PATCH', API_PATH, body=body,
+                     headers={'Content-Type': 'application/merge-patch+json'})
+        response = conn.getresponse()
+        response.read()
+        latencies.append(time.perf_counter() - start)
+        if response.status != 200:
+            errors.append(response.status)
+    conn.close()
+
+
+def run_writes(writers, patches, server_args):
+    """Concurrent admin write bursts: throughput and latency of durable writes"""
+    with ServerProcess(server_args) as server:
+        latencies, errors = [], []
+        threads = [threading.Thread(target=patch_loop, args=(server.port, w, patches, latencies, errors))
+                   for w in range(writers)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        conn = http.client.HTTPConnection('127.0.0.1', server.port, timeout=30)
+        conn.request('GET', '/health')
+        log_stats = json.loads(conn.getresponse().read()).get('log', {})
+        conn.close()
+    return {
+        'writers': writers,
+        'writes': len(latencies),
+        'errors': len(errors),
+        'writes_per_s': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'fsyncs': log_stats.get('syncs', 'n/a'),
+    }
+
+
+def run_store_stress(readers, writers, duration):
+    """Hammer a CustomizationStore in-process from reader and writer threads.
+
+    Every write bumps three fields together (`counter`, `mirror` and an array
+    item), alternating merge patches and JSON Patches. Readers check that
+    every snapshot they take is internally consistent, matches its
+    serialized body and that versions never go backwards. Writers check that
+    no update was lost.
+    """
+    workdir = tempfile.mkdtemp(prefix='goeye-stress-')
+    try:
+        sys.path.insert(0, SCRIPT_DIR)
+        import web_server
+        log_path = os.path.join(workdir, 'stress.wal')
+        store = web_server.CustomizationStore(web_server.CustomizationLog(log_path, export_path=None),
+                                              web_server.DeltaHistory())
+        base = store.replace({'counter': 0, 'mirror': 0, 'items': [{'id': 'a', 'n': 0}]}).version
+        store.start_log()
+
+        stop = threading.Event()
+        violations, reads, writes = [], [0] * readers, [0] * writers
+
+        def bump(data, json_patch):
+            n = data['counter'] + 1
+            if json_patch:
+                return web_server.apply_json_patch(data, [
+                    {'op': 'replace', 'path': '/counter', 'value': n},
+                    {'op': 'replace', 'path': '/items/id=a/n', 'value': n},
+                    {'op': 'replace', 'path': '/mirror', 'value': n},
+                ])
+            return web_server.apply_merge_patch(data, {'counter': n, 'mirror': n, 'items': {'id=a': {'n': n}}})
+
+        def writer(index):
+            while not stop.is_set():
+                store.update(lambda data: bump(data, writes[index] % 2 == 0))
+                writes[index] += 1
+
+        def reader(index):
+            last_version = 0
+            while not stop.is_set():
+                snapshot = store.snapshot
+                data = snapshot.data
+                n = data['counter']
+                if not (n == data['mirror'] == data['items'][0]['n'] == snapshot.version - base):
+                    violations.append(f'torn state at version {snapshot.version}: {data}')
+                if reads[index] % 50 == 0 and json.loads(snapshot.body) != data:
+                    violations.append(f'body does not match data at version {snapshot.version}')
+                if snapshot.version < last_version:
+                    violations.append(f'version went backwards: {last_version} -> {snapshot.version}')
+                last_version = snapshot.version
+                reads[index] += 1
+
+        threads = [threading.Thread(target=writer, args=(i,)) for i in range(writers)]
+        threads += [threading.Thread(target=reader, args=(i,)) for i in range(readers)]
+        for thread in threads:
+            thread.start()
+        time.sleep(duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        final = store.snapshot
+        if final.data['counter'] != sum(writes):
+            violations.append(f'lost updates: {sum(writes)} writes, counter is {final.data["counter"]}')
+        recovered = web_server.CustomizationLog(log_path, export_path=None).recover()[0]
+        if recovered != final.data:
+            violations.append('log replay does not reproduce the final document')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        'readers': readers,
+        'writers': writers,
+        'reads': sum(reads),
+        'writes': sum(writes),
+        'violations': len(violations),
+        'first_violation': violations[0] if violations else '-',
+    }
+
+
+def run_load(server_args, clients, slow_clients, duration, module_command=None):
+    """Run pollers and slow downloaders against one server configuration"""
+    with ServerProcess(server_args, module_command=module_command) as server:
+        stop = threading.Event()
+        latencies, errors = [], []
+        threads = [threading.Thread(target=slow_download_loop, args=(server.port, stop), daemon=True)
+                   for _ in range(slow_clients)]
+        threads += [threading.Thread(target=poll_loop, args=(server.port, stop, latencies, errors), daemon=True)
+                    for _ in range(clients)]
+        for thread in threads:
+            thread.start()
+        time.sleep(duration)
+        stop.set()
+        for thread in threads:
+            thread.join(timeout=35)
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'rps': len(latencies) / duration,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+
+def _poll_process(port, clients, duration, results):
+    """A load-generator process: the client is GIL-bound too, so one process can't saturate N cores"""
+    stop = threading.Event()
+    latencies, errors = [], []
+    threads = [threading.Thread(target=poll_loop, args=(port, stop, latencies, errors), daemon=True)
+               for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join(timeout=35)
+    results.put((latencies, len(errors)))
+
+
+def count_stale_reads(port, probes):
+    """Write through one connection, then read on fresh connections (spread over the workers)"""
+    version = post_document(port, {'showPromotionalBanner': True, 'probe': time.time()})
+    stale = 0
+    for _ in range(probes):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        conn.request('GET', API_PATH)
+        response = conn.getresponse()
+        response.read()
+        if int(response.getheader('X-Customization-Version')) < version:
+            stale += 1
+        conn.close()
+    return stale
+
+
+def run_scaling(processes, client_processes, clients, duration):
+    """GET throughput of one server started with --processes `processes`"""
+    with ServerProcess(['--processes', str(processes)]) as server:
+        results = multiprocessing.Queue()
+        generators = [multiprocessing.Process(target=_poll_process, args=(server.port, clients, duration, results))
+                      for _ in range(client_processes)]
+        for generator in generators:
+            generator.start()
+        latencies, errors = [], 0
+        for _ in generators:
+            generator_latencies, generator_errors = results.get()
+            latencies += generator_latencies
+            errors += generator_errors
+        for generator in generators:
+            generator.join()
+        stale = count_stale_reads(server.port, 4 * processes)
+    return {
+        'processes': processes,
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': len(latencies) / duration,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'stale_reads': stale,
+    }
+
+
+def replication_delays(primary_port, replica_ports, writes):
+    """Seconds from each of `writes` patches being acknowledged by the primary to every replica serving it"""
+    delays = []
+    for i in range(writes):
+        conn = http.client.HTTPConnection('127.0.0.1', primary_port, timeout=30)
+        conn.request('PATCH', API_PATH, body=json.dumps({'promotionalBannerText': f'Replicated edit {i}'}),
+                     headers={'Content-Type': 'application/merge-patch+json'})
+        version = json.loads(conn.getresponse().read())['version']
+        conn.close()
+        start = time.perf_counter()
+        for port in replica_ports:
+            # A long-poll on the previous version returns as soon as the replica has this one
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+            conn.request('GET', f'{API_PATH}?wait={version - 1}')
+            response = conn.getresponse()
+            response.read()
+            conn.close()
+            if int(response.getheader('X-Customization-Version')) < version:
+                raise RuntimeError(f'replica on port {port} did not receive version {version}')
+        delays.append(time.perf_counter() - start)
+    return delays
+
+
+def run_replicas(replicas, client_processes, clients, duration, writes):
+    """GET throughput of a primary and `replicas` read replicas, with the pollers spread over all of them"""
+    with contextlib.ExitStack() as stack:
+        primary = stack.enter_context(ServerProcess())
+        nodes = [primary] + [
+            stack.enter_context(ServerProcess(['--replicate-from', f'http://127.0.0.1:{primary.port}',
+                                               '--replica-name', f'replica{i + 1}']))
+            for i in range(replicas)]
+        results = multiprocessing.Queue()
+        generators = [multiprocessing.Process(target=_poll_process,
+                                              args=(nodes[i % len(nodes)].port, clients, duration, results))
+                      for i in range(max(client_processes, len(nodes)))]
+        for generator in generators:
+            generator.start()
+        latencies, errors = [], 0
+        for _ in generators:
+            generator_latencies, generator_errors = results.get()
+            latencies += generator_latencies
+            errors += generator_errors
+        for generator in generators:
+            generator.join()
+        delays = replication_delays(primary.port, [node.port for node in nodes[1:]], writes) if replicas else []
+    return {
+        'replicas': replicas,
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': len(latencies) / duration,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'replication_p50_ms': percentile(delays, 50) * 1000 if delays else 'n/a',
+        'replication_max_ms': max(delays) * 1000 if delays else 'n/a',
+    }
+
+
+def measure_import(runs):
+    """Milliseconds to import web_server in fresh interpreters (median, min), and whether asyncio/PIL came along"""
+    workdir = tempfile.mkdtemp(prefix='goeye-import-')
+    code = ('import sys, time; started = time.perf_counter(); import web_server; '
+            'print((time.perf_counter() - started) * 1000, "asyncio" in sys.modules or "PIL" in sys.modules)')
+    try:
+        results = [subprocess.run([sys.executable, '-c', code], cwd=workdir, env=server_env(), check=True,
+                                  capture_output=True, text=True).stdout.split()[-2:] for _ in range(runs)]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    times = [float(ms) for ms, _ in results]
+    return percentile(times, 50), min(times), any(heavy == 'True' for _, heavy in results)
+
+
+def seed_document(workdir, document, source):
+    """Put `document` where web_server.py loads it from: customization_data.json, or a write-ahead log"""
+    sys.path.insert(0, SCRIPT_DIR)
+    import web_server
+    path = os.path.join(workdir, 'customization_data.json')
+    web_server.save_customization_data(document, path)
+    if source == 'log':
+        log = web_server.CustomizationLog(os.path.join(workdir, web_server.WAL_PATH), export_path=None)
+        log.start(document, 1)
+        log.close()
+
+
+def run_startup(items, source, runs):
+    """Launch-to-healthy time of web_server.py with a document of `items` extra items loaded from `source`"""
+    with open(os.path.join(SCRIPT_DIR, 'initial_customization_data.json')) as f:
+        document = grow_document(json.load(f), items)
+    startups, loads = [], []
+    for _ in range(runs):
+        with ServerProcess(prepare=lambda workdir: seed_document(workdir, document, source)) as server:
+            startups.append(server.startup_seconds)
+            conn = http.client.HTTPConnection('127.0.0.1', server.port, timeout=30)
+            conn.request('GET', '/health')
+            loaded = json.loads(conn.getresponse().read())['document_file']
+            conn.close()
+            if loaded['source'] != source:
+                raise RuntimeError(f"loaded from {loaded['source']}, expected {source}")
+            loads.append(loaded['load_ms'])
+    return {
+        'items': items,
+        'source': source,
+        'document_kb': len(json.dumps(document, separators=(',', ':'))) / 1024,
+        'startup_p50_ms': percentile(startups, 50) * 1000,
+        'startup_max_ms': max(startups) * 1000,
+        'load_p50_ms': percentile(loads, 50),
+    }
+
+
+def run_reload(mode, edits, pollers):
+    """Time from saving customization_data.json to the edit being served, with devices polling throughout"""
+    with ServerProcess(['--watch', mode]) as server:
+        path = os.path.join(server.workdir, 'customization_data.json')
+        stop = threading.Event()
+        latencies, errors = [], []
+        threads = [threading.Thread(target=poll_loop, args=(server.port, stop, latencies, errors))
+                   for _ in range(pollers)]
+        for thread in threads:
+            thread.start()
+        delays = []
+        conn = http.client.HTTPConnection('127.0.0.1', server.port, timeout=60)
+        for i in range(edits):
+            conn.request('GET', API_PATH)
+            response = conn.getresponse()
+            document = json.loads(response.read())
+            version = int(response.getheader('X-Customization-Version'))
+            document['promotionalBannerText'] = f'Edited on disk {i}'
+            # Saved the way editors and deploy scripts do it: a new file renamed over the old one
+            with open(path + '.edit', 'w') as f:
+                json.dump(document, f, indent=2)
+            start = time.perf_counter()
+            os.replace(path + '.edit', path)
+            conn.request('GET', f'{API_PATH}?wait={version}')
+            response = conn.getresponse()
+            served = json.loads(response.read())
+            if served.get('promotionalBannerText') != document['promotionalBannerText']:
+                raise RuntimeError(f'edit {i} was not served within the long-poll timeout')
+            delays.append(time.perf_counter() - start)
+        conn.request('GET', '/health')
+        watcher = json.loads(conn.getresponse().read())['document_file']
+        conn.close()
+        stop.set()
+        for thread in threads:
+            thread.join()
+    return {
+        'watch': watcher['watch'],
+        'edits': edits,
+        'reload_p50_ms': percentile(delays, 50) * 1000,
+        'reload_max_ms': max(delays) * 1000,
+        'poll_requests': len(latencies),
+        'poll_errors': len(errors),
+    }
+
+
+def seed_tenants(workdir, count):
+    """`count` tenants on disk, each with a copy of the seed document (as an admin would provision them)"""
+    for i in range(count):
+        directory = os.path.join(workdir, 'tenants', f'tenant{i:04d}')
+        os.makedirs(directory)
+        shutil.copy(os.path.join(workdir, 'initial_customization_data.json'),
+                    os.path.join(directory, 'customization_data.json'))
+
+
+def _timed_get(conn, path):
+    start = time.perf_counter()
+    conn.request('GET', path)
+    response = conn.getresponse()
+    response.read()
+    if response.status != 200:
+        raise RuntimeError(f'GET {path} answered {response.status}')
+    return time.perf_counter() - start
+
+
+def tenant_read_latencies(port, path, duration, writer_path=None):
+    """GET `path` back to back for `duration`s, while another connection PATCHes `writer_path` if given"""
+    stop = threading.Event()
+    writes = []
+
+    def write_loop():
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        while not stop.is_set():
+            conn.request('PATCH', writer_path, body=json.dumps({'promotionalBannerText': f'Edit {len(writes)}'}),
+                         headers={'Content-Type': 'application/merge-patch+json'})
+            conn.getresponse().read()
+            writes.append(1)
+        conn.close()
+
+    writer = threading.Thread(target=write_loop) if writer_path else None
+    if writer is not None:
+        writer.start()
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    latencies = []
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        latencies.append(_timed_get(conn, path))
+    conn.close()
+    stop.set()
+    if writer is not None:
+        writer.join()
+    return latencies, len(writes)
+
+
+def run_tenants(tenants, budget_bytes, duration):
+    """Startup time and memory with `tenants` provisioned, cold and warm GETs, and read isolation"""
+    server_args = ['--tenant-budget-bytes', str(budget_bytes)]
+    with ServerProcess(server_args, prepare=lambda workdir: seed_tenants(workdir, tenants)) as server:
+        idle_rss = process_rss_mb(server.process.pid)
+        conn = http.client.HTTPConnection('127.0.0.1', server.port, timeout=30)
+        names = [f'tenant{i:04d}' for i in range(tenants)]
+        # First GET of each tenant loads it from disk; then the last one, now resident, again and again
+        cold = [_timed_get(conn, f'/api/t/{name}/customizations') for name in names]
+        warm = [_timed_get(conn, f'/api/t/{names[-1]}/customizations') for _ in range(200)] if names else []
+        conn.request('GET', '/health')
+        tenant_stats = json.loads(conn.getresponse().read())['tenants']
+        conn.close()
+        rss = process_rss_mb(server.process.pid)
+        # Reads of one tenant, alone and while another takes durable writes back to back
+        quiet, isolated = [], []
+        writes = 0
+        if tenants >= 2:
+            reader, writer = f'/api/t/{names[0]}/customizations', f'/api/t/{names[1]}/customizations'
+            quiet, _ = tenant_read_latencies(server.port, reader, duration)
+            isolated, writes = tenant_read_latencies(server.port, reader, duration, writer)
+    return {
+        'tenants': tenants,
+        'startup_ms': server.startup_seconds * 1000,
+        'idle_rss_mb': idle_rss if idle_rss is not None else 'n/a',
+        'cold_get_p50_ms': percentile(cold, 50) * 1000 if cold else 'n/a',
+        'cold_get_p99_ms': percentile(cold, 99) * 1000 if cold else 'n/a',
+        'warm_get_p50_ms': percentile(warm, 50) * 1000 if warm else 'n/a',
+        'resident': tenant_stats['resident'],
+        'resident_kb': tenant_stats['resident_bytes'] / 1024,
+        'evicted': sum(tenant_stats['evictions'].values()),
+        'rss_mb': rss if rss is not None else 'n/a',
+        'read_p99_ms': percentile(quiet, 99) * 1000 if quiet else 'n/a',
+        'read_p99_writing_ms': percentile(isolated, 99) * 1000 if isolated else 'n/a',
+        'other_tenant_writes': writes,
+    }
+
+
+class Fleet:
+    """Virtual devices behaving like the Flutter SyncService, plus admins and browsers.
+
+    Each device keeps one keep-alive connection and GETs the document every
+    `poll_interval` seconds on a fixed grid (Timer.periodic). A tick that
+    arrives while the previous sync is still running is skipped, as the
+    app's _isSyncing flag does. With probability `upload_rate` a sync is
+    followed by an upload of the full document. Every `admin_interval`
+    seconds an admin sends `admin_burst` merge patches back to back, and
+    browsers start Flutter web cold loads at `cold_loads_per_min`. With
+    `storm`, every device starts within the first 200 ms (the app pushed
+    to everyone, or a Wi-Fi blip), so their timers stay in step. With
+    `follow_advice`, devices behave like current app builds instead: the
+    next sync is X-Poll-Interval (or Retry-After) seconds after this one.
+
+    Events come off one schedule, served by `client_threads` threads, so
+    thousands of devices don't need thousands of threads. Requests the
+    server sheds (503/429) are counted apart from errors.
+    """
+
+    def __init__(self, port, devices, poll_interval, upload_rate, admin_interval, admin_burst,
+                 cold_loads_per_min, client_threads, seed, storm=False, follow_advice=False):
+        self.port = port
+        self.poll_interval = poll_interval
+        self.upload_rate = upload_rate
+        self.follow_advice = follow_advice
+        self.advice = threading.local()
+        self.admin_burst = admin_burst
+        self.client_threads = client_threads
+        self.rng = random.Random(seed)
+        self.latencies = {kind: [] for kind in FLEET_KINDS}
+        self.errors = {kind: [] for kind in FLEET_KINDS}
+        self.shed = {kind: 0 for kind in FLEET_KINDS}
+        self.lag = []
+        self.skipped_polls = 0
+        self.connections = {}
+        self.schedule = []
+        self.cond = threading.Condition()
+        self.stop = threading.Event()
+        with open(os.path.join(SCRIPT_DIR, 'initial_customization_data.json')) as f:
+            self.document = json.load(f)
+        start = time.perf_counter()
+        # Devices start at random points in their poll period, like phones opened over time
+        spread = 0.2 if storm else poll_interval
+        for device in range(devices):
+            self._add(start + self.rng.uniform(0, spread), 'poll', device)
+        if admin_interval > 0 and admin_burst > 0:
+            self._add(start + admin_interval, 'admin', admin_interval)
+        if cold_loads_per_min > 0:
+            self._add(start + self.rng.expovariate(cold_loads_per_min / 60.0), 'coldload', cold_loads_per_min)
+
+    def _add(self, due, kind, arg):
+        heapq.heappush(self.schedule, (due, kind, arg))
+
+    def run(self, duration):
+        threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(self.client_threads)]
+        for thread in threads:
+            thread.start()
+        time.sleep(duration)
+        self.stop.set()
+        with self.cond:
+            self.cond.notify_all()
+        for thread in threads:
+            thread.join(timeout=35)
+        for conn in self.connections.values():
+            conn.close()
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                while not self.stop.is_set():
+                    delay = self.schedule[0][0] - time.perf_counter() if self.schedule else 1.0
+                    if delay <= 0:
+                        break
+                    self.cond.wait(delay)
+                if self.stop.is_set():
+                    return
+                due, kind, arg = heapq.heappop(self.schedule)
+            self.lag.append(time.perf_counter() - due)
+            follow_up = getattr(self, f'_{kind}')(due, arg)
+            with self.cond:
+                self._add(*follow_up)
+                self.cond.notify()
+
+    def _timed(self, kind, conn, method, path, body=None, headers=None):
+        """One request on `conn`; returns the open connection or None if it failed"""
+        start = time.perf_counter()
+        reused = conn.sock is not None
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            response = conn.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            if reused and method == 'GET' and isinstance(e, (http.client.RemoteDisconnected, ConnectionError)):
+                # The server closed the idle keep-alive connection first; like
+                # browsers and the Dart client, retry the GET on a new one
+                return self._timed(kind, http.client.HTTPConnection('127.0.0.1', self.port, timeout=30),
+                                   method, path, body, headers)
+            self.errors[kind].append(type(e).__name__)
+            return None
+        self.advice.seconds = response.getheader('X-Poll-Interval') or response.getheader('Retry-After')
+        if response.status in (429, 503):
+            self.shed[kind] += 1
+        else:
+            self.latencies[kind].append(time.perf_counter() - start)
+            if response.status >= 400:
+                self.errors[kind].append(response.status)
+        if response.getheader('Connection', '').lower() == 'close':
+            conn.close()
+            return None
+        return conn
+
+    def _connection(self, device):
+        conn = self.connections.pop(device, None)
+        return conn or http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+
+    def _poll(self, due, device):
+        self.advice.seconds = None
+        conn = self._timed('poll', self._connection(device), 'GET', API_PATH)
+        advice = self.advice.seconds
+        if conn is not None and self.rng.random() < self.upload_rate:
+            body = json.dumps(dict(self.document, lastUploadedBy=f'device-{device}'))
+            conn = self._timed('upload', conn, 'POST', API_PATH, body, {'Content-Type': 'application/json'})
+        if conn is not None:
+            self.connections[device] = conn
+        if self.follow_advice and advice:
+            return time.perf_counter() + float(advice), 'poll', device
+        # Timer.periodic keeps its grid; ticks that fired mid-sync were skipped
+        next_due = due + self.poll_interval
+        now = time.perf_counter()
+        if next_due < now:
+            missed = int((now - next_due) // self.poll_interval) + 1
+            self.skipped_polls += missed
+            next_due += missed * self.poll_interval
+        return next_due, 'poll', device
+
+    def _admin(self, due, admin_interval):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+        for i in range(self.admin_burst):
+            body = json.dumps({'promotionalBannerText': f'Admin edit {due:.0f}.{i}'})
+            conn = self._timed('admin', conn, 'PATCH', API_PATH, body,
+                               {'Content-Type': 'application/merge-patch+json'})
+            if conn is None:
+                conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+        conn.close()
+        return due + admin_interval, 'admin', admin_interval
+
+    def _coldload(self, due, cold_loads_per_min):
+        start = time.perf_counter()
+        try:
+            cold_load(self.port)
+            self.latencies['coldload'].append(time.perf_counter() - start)
+        except ShedError:
+            self.shed['coldload'] += 1
+        except (OSError, http.client.HTTPException, RuntimeError) as e:
+            self.errors['coldload'].append(str(e))
+        # Browsers arrive independently of each other (a Poisson process)
+        return due + self.rng.expovariate(cold_loads_per_min / 60.0), 'coldload', cold_loads_per_min
+
+
+def run_fleet(devices, duration, poll_interval, upload_rate, admin_interval, admin_burst,
+              cold_loads_per_min, client_threads, seed, storm, follow_advice, server_args):
+    """Drive one server with a simulated device fleet; returns (summary, per-kind rows)"""
+    raise_open_file_limit()
+    with ServerProcess(server_args) as server:
+        fleet = Fleet(server.port, devices, poll_interval, upload_rate, admin_interval, admin_burst,
+                      cold_loads_per_min, client_threads, seed, storm, follow_advice)
+        fleet.run(duration)
+        peak_rss = process_peak_rss_mb(server.process.pid)
+    rows = []
+    summary = {'devices': devices, 'duration_s': duration}
+    for kind in FLEET_KINDS:
+        latencies, errors = fleet.latencies[kind], fleet.errors[kind]
+        row = {
+            'kind': kind,
+            'requests': len(latencies) + len(errors) + fleet.shed[kind],
+            'errors': len(errors),
+            'shed': fleet.shed[kind],
+            'rps': len(latencies) / duration,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+        }
+        rows.append(row)
+        for stat in ('p50', 'p95', 'p99'):
+            summary[f'{kind}_{stat}_ms'] = row[f'{stat}_ms']
+    requests = sum(row['requests'] for row in rows)
+    errors = sum(row['errors'] for row in rows)
+    shed = sum(row['shed'] for row in rows)
+    summary.update({
+        'requests': requests,
+        'errors': errors,
+        'error_pct': 100.0 * errors / requests if requests else 0.0,
+        'shed': shed,
+        'shed_pct': 100.0 * shed / requests if requests else 0.0,
+        'rps': sum(row['rps'] for row in rows),
+        'skipped_polls': fleet.skipped_polls,
+        'schedule_lag_p99_ms': percentile(fleet.lag, 99) * 1000,
+        'server_peak_rss_MB': peak_rss,
+    })
+    return summary, rows
+
+
+def compare_to_baseline(results, baseline, tolerance_pct):
+    """Rows comparing `results` to a saved baseline, and whether any metric regressed"""
+    rows, regressed = [], False
+    for name, direction, floor in FLEET_BASELINE_METRICS:
+        old, new = baseline['summary'].get(name), results['summary'].get(name)
+        if old is None or new is None:
+            continue
+        change = new - old
+        change_pct = 100.0 * change / old if old else (0.0 if not change else float('inf'))
+        worse = change * direction < 0
+        if worse and abs(change) > floor and abs(change_pct) > tolerance_pct:
+            verdict, regressed = 'REGRESSED', True
+        elif not worse and abs(change) > floor and abs(change_pct) > tolerance_pct:
+            verdict = 'improved'
+        else:
+            verdict = 'ok'
+        rows.append({'metric': name, 'baseline': old, 'current': new, 'change_pct': change_pct, 'verdict': verdict})
+    return rows, regressed
+
+
+def print_table(rows):
+    """Print results as an aligned table"""
+    headers = list(rows[0].keys())
+    widths = [max(len(h), *(len(_fmt(r[h])) for r in rows)) for h in headers]
+    print('  '.join(h.ljust(w) for h, w in zip(headers, widths)))
+    for row in rows:
+        print('  '.join(_fmt(row[h]).ljust(w) for h, w in zip(headers, widths)))
+
+
+def _fmt(value):
+    return f"{value:.1f}" if isinstance(value, float) else str(value)
+
+
+def cmd_load(args):
+    rows = []
+    for engine in args.engines:
+        print(f"🏋️ {engine}: {args.clients} pollers + {args.slow_clients} slow downloads for {args.duration}s")
+        result = run_load(['--engine', engine, '--workers', str(args.workers)],
+                          args.clients, args.slow_clients, args.duration)
+        rows.append({'engine': engine, **result})
+    print_table(rows)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+
+
+def cmd_scaling(args):
+    rows = []
+    print(f"🧮 {os.cpu_count()} CPUs; load from {args.client_processes} processes x {args.clients} pollers")
+    for processes in args.processes:
+        print(f"🏭 --processes {processes} for {args.duration}s")
+        rows.append(run_scaling(processes, args.client_processes, args.clients, args.duration))
+    for row in rows:
+        row['speedup'] = row['rps'] / rows[0]['rps'] if rows[0]['rps'] else 0.0
+    print_table(rows)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    if any(row['stale_reads'] or row['errors'] for row in rows):
+        sys.exit(1)
+
+
+def cmd_replicas(args):
+    rows = []
+    print(f"🪞 {os.cpu_count()} CPUs; load from {args.client_processes} processes x {args.clients} pollers "
+          f"spread over the primary and its replicas")
+    for replicas in args.replicas:
+        print(f"🏭 1 primary + {replicas} replicas for {args.duration}s")
+        rows.append(run_replicas(replicas, args.client_processes, args.clients, args.duration, args.writes))
+    for row in rows:
+        row['speedup'] = row['rps'] / rows[0]['rps'] if rows[0]['rps'] else 0.0
+    print_table(rows)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    if any(row['errors'] for row in rows):
+        sys.exit(1)
+
+
+def cmd_startup(args):
+    try:
+        # Time a deployed server, not the compiler: imports never refresh a stale cache
+        # under PYTHONDONTWRITEBYTECODE or in a read-only checkout
+        py_compile.compile(SERVER_SCRIPT, doraise=True)
+    except (OSError, py_compile.PyCompileError) as e:
+        print(f"⚠️ Could not byte-compile web_server.py ({e}); times include compiling it")
+    print(f"⏱️ Import time of web_server over {args.runs * 3} fresh interpreters")
+    import_p50, import_min, heavy = measure_import(args.runs * 3)
+    print_table([{'import_p50_ms': import_p50, 'import_min_ms': import_min, 'asyncio_or_pil_imported': heavy}])
+    rows = []
+    for items in args.items:
+        for source in ('file', 'log'):
+            print(f"🚀 {args.runs} cold starts with +{items} items loaded from {source}")
+            rows.append(run_startup(items, source, args.runs))
+    print_table(rows)
+    if args.json:
+        print(json.dumps({'import_p50_ms': import_p50, 'import_min_ms': import_min, 'startups': rows}, indent=2))
+    over = [row for row in rows if row['startup_p50_ms'] > args.startup_budget_ms]
+    if import_p50 > args.import_budget_ms or over:
+        print(f"❌ Over budget: import {import_p50:.1f} ms (budget {args.import_budget_ms} ms), "
+              f"{len(over)} startups over {args.startup_budget_ms} ms")
+        sys.exit(1)
+
+
+def cmd_reload(args):
+    rows = []
+    for mode in args.modes:
+        print(f"👀 --watch {mode}: {args.edits} edits to customization_data.json with {args.pollers} devices polling")
+        rows.append(run_reload(mode, args.edits, args.pollers))
+    print_table(rows)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    if any(row['poll_errors'] for row in rows):
+        sys.exit(1)
+
+
+def cmd_tenants(args):
+    rows = []
+    print(f"🏷️ Tenant documents with a {args.budget_bytes / 1024 / 1024:.1f} MB resident budget")
+    for tenants in args.tenants:
+        print(f"🗂️ {tenants} tenants provisioned on disk")
+        rows.append(run_tenants(tenants, args.budget_bytes, args.duration))
+    print_table(rows)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+
+
+def cmd_interfaces(args):
+    rows = []
+    for name, server_args, module_command, requirement in INTERFACES:
+        if requirement and importlib.util.find_spec(requirement) is None:
+            print(f"⏭️ {name}: {requirement} is not installed")
+            continue
+        print(f"🔌 {name}: {args.clients} pollers for {args.duration}s")
+        result = run_load(server_args, args.clients, 0, args.duration, module_command)
+        rows.append({'server': name, **result})
+    print_table(rows)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+
+
+def cmd_fleet(args):
+    server_args = ['--engine', args.engine, '--workers', str(args.workers), '--access-log', 'off',
+                   *shlex.split(args.server_args)]
+    print(f"📱 {args.devices} devices polling every {args.poll_interval}s"
+          f"{' (in step: reconnect storm)' if args.storm else ''}, admin bursts of {args.admin_burst} "
+          f"every {args.admin_interval}s, {args.cold_loads_per_min} cold loads/min for {args.duration}s "
+          f"({args.engine} engine)")
+    summary, rows = run_fleet(args.devices, args.duration, args.poll_interval, args.upload_rate,
+                              args.admin_interval, args.admin_burst, args.cold_loads_per_min,
+                              args.client_threads, args.seed, args.storm, args.follow_advice, server_args)
+    print_table(rows)
+    print_table([{key: summary[key] for key in ('requests', 'errors', 'error_pct', 'shed_pct', 'rps',
+                                                  'skipped_polls', 'schedule_lag_p99_ms', 'server_peak_rss_MB')}])
+    if summary['schedule_lag_p99_ms'] > 100:
+        print("⚠️ Events started late: raise --client-threads, or the server is holding connections")
+    results = {
+        'benchmark': 'fleet',
+        'config': {key: getattr(args, key) for key in FLEET_CONFIG_KEYS if key != 'server_args'},
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        },
+        'summary': summary,
+        'kinds': rows,
+    }
+    results['config']['server_args'] = server_args
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"💾 Results written to {args.output}")
+    if args.json:
+        print(json.dumps(results, indent=2))
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        mismatched = [key for key in FLEET_CONFIG_KEYS
+                      if baseline.get('config', {}).get(key) != results['config'][key]]
+        if mismatched:
+            print(f"⚠️ Baseline was recorded with different settings: {', '.join(mismatched)}")
+        comparison, regressed = compare_to_baseline(results, baseline, args.tolerance)
+        print(f"📏 Compared with {args.baseline} (tolerance {args.tolerance:.0f}%)")
+        print_table(comparison)
+        if regressed:
+            sys.exit(1)
+    if summary['error_pct'] > args.max_error_pct:
+        sys.exit(1)
+
+
+def cmd_etag(args):
+    print(f"🏷️ {args.polls} polls with and without If-None-Match")
+    rows = [run_conditional_polls(args.polls, conditional) for conditional in (False, True)]
+    print_table(rows)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+
+
+def cmd_images(args):
+    print(f"🖼️ /img/ resizing: {args.sources} source images, {args.clients} concurrent clients")
+    row = run_images(args.sources, args.clients, args.hits, shlex.split(args.server_args))
+    print_table([row])
+    if args.json:
+        print(json.dumps(row, indent=2))
+
+
+def cmd_formats(args):
+    print(f"📦 The document as JSON, MessagePack and CBOR ({args.items} items per array section)")
+    rows = run_formats(args.items, args.repeats)
+    print_table(rows)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+
+
+def cmd_writes(args):
+    rows = []
+    for writers in args.writers:
+        print(f"✍️ {writers} concurrent admins x {args.patches} patches")
+        rows.append(run_writes(writers, args.patches, []))
+    print_table(rows)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+
+
+def cmd_coldload(args):
+    print(f"🧊 {args.clients} browsers x {args.loads} Flutter web cold loads")
+    row = run_cold_loads(args.clients, args.loads, [])
+    print_table([row])
+    if args.json:
+        print(json.dumps(row, indent=2))
+
+
+def cmd_compression(args):
+    print(f"🗜️ {args.clients} browsers x {args.loads} Flutter web cold loads per Accept-Encoding")
+    if not args.skip_build:
+        print("   precompressing the web build first (brotli takes a while on a fresh checkout)")
+        precompress_web_root()
+    rows = []
+    for accept in COLD_LOAD_ENCODINGS:
+        row = run_cold_loads(args.clients, args.loads, [], {'Accept-Encoding': accept} if accept else None)
+        rows.append({'accept_encoding': accept or '(none)', **row})
+    identity = rows[0]['MB_per_load']
+    for row in rows:
+        row['x_fewer_bytes'] = identity / row['MB_per_load'] if row['MB_per_load'] else 0.0
+    print_table(rows)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+
+
+def cmd_revisit(args):
+    print("🔁 Flutter web revisit with cached validators")
+    row = run_revisit([])
+    print_table([row])
+    if args.json:
+        print(json.dumps(row, indent=2))
+    if row['revisit_pct'] > args.max_revisit_pct or not row['range_resume_ok'] or not row['range_416_ok']:
+        sys.exit(1)
+
+
+def cmd_stress(args):
+    print(f"🧪 {args.readers} readers / {args.writers} writers on one store for {args.duration}s")
+    row = run_store_stress(args.readers, args.writers, args.duration)
+    print_table([row])
+    if row['violations']:
+        sys.exit(1)
+
+
+def cmd_soak(args):
+    rows = []
+    for mode in args.modes:
+        print(f"📡 {mode}: {args.subscribers} subscribers, {args.updates} updates ({args.engine} engine)")
+        rows.append(run_soak(args.subscribers, args.updates, mode, ['--engine', args.engine]))
+    print_table(rows)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the GoEye customization sync server')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    load = sub.add_parser('load', help='requests/s and p99 latency per serving engine')
+    load.add_argument('--engines', nargs='+', default=['single', 'threaded', 'asyncio'])
+    load.add_argument('--clients', type=int, default=50, help='concurrent polling devices')
+    load.add_argument('--slow-clients', type=int, default=4, help='slow static downloads')
+    load.add_argument('--workers', type=int, default=32)
+    load.add_argument('--duration', type=float, default=10)
+    load.add_argument('--json', action='store_true', help='also print results as JSON')
+    load.set_defaults(func=cmd_load)
+
+    fleet = sub.add_parser('fleet', help='simulated device fleet, admins and browsers; compare to a baseline')
+    fleet.add_argument('--devices', type=int, default=500, help='virtual phones running SyncService')
+    fleet.add_argument('--poll-interval', type=float, default=5.0, help='seconds between device syncs')
+    fleet.add_argument('--upload-rate', type=float, default=0.002,
+                       help='chance that a sync is followed by an upload of the full document')
+    fleet.add_argument('--admin-interval', type=float, default=10.0, help='seconds between admin write bursts')
+    fleet.add_argument('--admin-burst', type=int, default=20, help='patches per admin burst')
+    fleet.add_argument('--cold-loads-per-min', type=float, default=30.0, help='Flutter web cold loads per minute')
+    fleet.add_argument('--duration', type=float, default=30)
+    fleet.add_argument('--client-threads', type=int, default=64, help='load-generator threads')
+    fleet.add_argument('--seed', type=int, default=1, help='random seed, for repeatable runs')
+    fleet.add_argument('--engine', default='asyncio',
+                       help='devices keep their connection open between syncs, so the threaded engine '
+                            'needs --workers of at least --devices')
+    fleet.add_argument('--workers', type=int, default=32)
+    fleet.add_argument('--storm', action='store_true',
+                       help='start every device at once, so their syncs stay in step (reconnect storm)')
+    fleet.add_argument('--follow-advice', action='store_true',
+                       help='devices wait X-Poll-Interval (or Retry-After) seconds between syncs, like current '
+                            'app builds, instead of a fixed --poll-interval')
+    fleet.add_argument('--server-args', default='', metavar='ARGS',
+                       help='extra web_server.py options, e.g. "--max-queue 64 --rate-limit 2"')
+    fleet.add_argument('--output', metavar='PATH', help='write machine-readable results (JSON) here')
+    fleet.add_argument('--baseline', metavar='PATH',
+                       help='results from an earlier --output; exit 1 if a metric regressed')
+    fleet.add_argument('--tolerance', type=float, default=15.0,
+                       help='percent change allowed before a baseline metric counts as regressed')
+    fleet.add_argument('--max-error-pct', type=float, default=1.0, help='exit 1 above this error rate')
+    fleet.add_argument('--json', action='store_true', help='also print results as JSON')
+    fleet.set_defaults(func=cmd_fleet)
+
+    etag = sub.add_parser('etag', help='bytes sent and server CPU per N polls, with and without ETags')
+    etag.add_argument('--polls', type=int, default=10000)
+    etag.add_argument('--json', action='store_true', help='also print results as JSON')
+    etag.set_defaults(func=cmd_etag)
+
+    images = sub.add_parser('images', help='/img/ resize throughput per worker process, coalescing and cache-hit latency')
+    images.add_argument('--sources', type=int, default=8, help='1600x1200 source images to generate')
+    images.add_argument('--clients', type=int, default=16)
+    images.add_argument('--hits', type=int, default=500, help='requests for an already cached variant')
+    images.add_argument('--server-args', default='', help='extra web_server.py arguments, e.g. "--image-workers 2"')
+    images.add_argument('--json', action='store_true', help='also print results as JSON')
+    images.set_defaults(func=cmd_images)
+
+    formats = sub.add_parser('formats', help='payload size and encode/decode time: JSON vs MessagePack vs CBOR')
+    formats.add_argument('--items', type=int, default=0,
+                         help='grow every array section to this many items (0 keeps the sample document)')
+    formats.add_argument('--repeats', type=int, default=20, help='timing runs per codec (the best is reported)')
+    formats.add_argument('--json', action='store_true', help='also print results as JSON')
+    formats.set_defaults(func=cmd_formats)
+
+    writes = sub.add_parser('writes', help='durable write throughput with concurrent admins (group commit)')
+    writes.add_argument('--writers', type=int, nargs='+', default=[1, 4, 16])
+    writes.add_argument('--patches', type=int, default=200, help='patches per writer')
+    writes.add_argument('--json', action='store_true', help='also print results as JSON')
+    writes.set_defaults(func=cmd_writes)
+
+    interfaces = sub.add_parser('interfaces', help='the same app on http.server, WSGI and ASGI servers')
+    interfaces.add_argument('--clients', type=int, default=50, help='concurrent polling devices')
+    interfaces.add_argument('--duration', type=float, default=10)
+    interfaces.add_argument('--json', action='store_true', help='also print results as JSON')
+    interfaces.set_defaults(func=cmd_interfaces)
+
+    scaling = sub.add_parser('scaling', help='GET throughput with N worker processes (--processes)')
+    scaling.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4])
+    scaling.add_argument('--client-processes', type=int, default=max(2, os.cpu_count() or 1),
+                         help='load-generator processes')
+    scaling.add_argument('--clients', type=int, default=16, help='pollers per load-generator process')
+    scaling.add_argument('--duration', type=float, default=10)
+    scaling.add_argument('--json', action='store_true', help='also print results as JSON')
+    scaling.set_defaults(func=cmd_scaling)
+
+    replicas = sub.add_parser('replicas', help='GET throughput as read replicas (--replicate-from) are added')
+    replicas.add_argument('--replicas', type=int, nargs='+', default=[0, 1, 2, 3])
+    replicas.add_argument('--client-processes', type=int, default=max(2, os.cpu_count() or 1),
+                          help='load-generator processes (at least one per server)')
+    replicas.add_argument('--clients', type=int, default=16, help='pollers per load-generator process')
+    replicas.add_argument('--duration', type=float, default=10)
+    replicas.add_argument('--writes', type=int, default=20,
+                          help='patches to the primary afterwards, timed until every replica serves them')
+    replicas.add_argument('--json', action='store_true', help='also print results as JSON')
+    replicas.set_defaults(func=cmd_replicas)
+
+    startup = sub.add_parser('startup', help='import time and launch-to-healthy time against a cold-start budget')
+    startup.add_argument('--items', type=int, nargs='+', default=[0, 2000],
+                         help='extra items added to the seed document')
+    startup.add_argument('--runs', type=int, default=5, help='cold starts per document size and source')
+    startup.add_argument('--import-budget-ms', type=float, default=150,
+                         help='fail if importing web_server takes longer than this (median)')
+    startup.add_argument('--startup-budget-ms', type=float, default=1000,
+                         help='fail if launch to first healthy answer takes longer than this (median)')
+    startup.add_argument('--json', action='store_true', help='also print results as JSON')
+    startup.set_defaults(func=cmd_startup)
+
+    reload_ = sub.add_parser('reload', help='edit-to-served latency of customization_data.json edits (--watch)')
+    reload_.add_argument('--modes', nargs='+', choices=['inotify', 'poll'], default=['inotify', 'poll'])
+    reload_.add_argument('--edits', type=int, default=10)
+    reload_.add_argument('--pollers', type=int, default=8, help='devices polling while the file is edited')
+    reload_.add_argument('--json', action='store_true', help='also print results as JSON')
+    reload_.set_defaults(func=cmd_reload)
+
+    tenants = sub.add_parser('tenants',
+                             help='startup and memory with N tenants provisioned; lazy loads, eviction, isolation')
+    tenants.add_argument('--tenants', type=int, nargs='+', default=[0, 1000])
+    tenants.add_argument('--budget-bytes', type=int, default=4 * 1024 * 1024,
+                         help='--tenant-budget-bytes for the server, small enough to see eviction')
+    tenants.add_argument('--duration', type=float, default=3,
+                         help='seconds of reads of one tenant, alone and while another is written')
+    tenants.add_argument('--json', action='store_true', help='also print results as JSON')
+    tenants.set_defaults(func=cmd_tenants)
+
+    coldload = sub.add_parser('coldload', help='concurrent Flutter web cold loads: throughput and server RSS')
+    coldload.add_argument('--clients', type=int, default=32)
+    coldload.add_argument('--loads', type=int, default=3, help='cold loads per client')
+    coldload.add_argument('--json', action='store_true', help='also print results as JSON')
+    coldload.set_defaults(func=cmd_coldload)
+
+    compression = sub.add_parser('compression',
+                                 help='cold-load bytes and server CPU by Accept-Encoding, from .br/.gz sidecars')
+    compression.add_argument('--clients', type=int, default=8)
+    compression.add_argument('--loads', type=int, default=3, help='cold loads per client')
+    compression.add_argument('--skip-build', action='store_true',
+                             help="don't run web_server.py --precompress-only first")
+    compression.add_argument('--json', action='store_true', help='also print results as JSON')
+    compression.set_defaults(func=cmd_compression)
+
+    revisit = sub.add_parser('revisit', help='second page load is answered with 304s; ranged downloads resume')
+    revisit.add_argument('--max-revisit-pct', type=float, default=5.0,
+                         help='fail if the revisit transfers more than this share of the first load')
+    revisit.add_argument('--json', action='store_true', help='also print results as JSON')
+    revisit.set_defaults(func=cmd_revisit)
+
+    stress = sub.add_parser('stress', help='readers never see a partially applied update (in-process)')
+    stress.add_argument('--readers', type=int, default=16)
+    stress.add_argument('--writers', type=int, default=8)
+    stress.add_argument('--duration', type=float, default=5)
+    stress.set_defaults(func=cmd_stress)
+
+    soak = sub.add_parser('soak', help='update delivery latency to N change-feed subscribers')
+    soak.add_argument('--modes', nargs='+', choices=['sse', 'longpoll'], default=['sse', 'longpoll'])
+    soak.add_argument('--subscribers', type=int, default=1000)
+    soak.add_argument('--updates', type=int, default=10)
+    soak.add_argument('--engine', default='threaded')
+    soak.add_argument('--json', action='store_true', help='also print results as JSON')
+    soak.set_defaults(func=cmd_soak)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,14 +6,24 @@ import 'package:flutter/foundation.dart';
 import '../providers/header_customization_provider.dart';
 
 class SyncService {
-  // Connect to Vercel deployment for real-time sync (using main page for now)
-  static const String _baseUrl = 'https://go-eye-app-duplicate-2025-nz2jzupv5-voyageeyewears-projects.vercel.app';
-  static const String _syncEndpoint = '/';
-  static const Duration _syncInterval = Duration(seconds: 5); // Sync every 5 seconds
+  // The sync server (web_server.py), e.g. flutter run --dart-define=SYNC_SERVER_URL=http://192.168.0.104:8082.
+  // Only it sends X-Poll-Interval; without it the app falls back to the Vercel deployment (using main page
+  // for now), which doesn't, so the app keeps the default interval
+  static const bool _hasSyncServer = bool.hasEnvironment('SYNC_SERVER_URL');
+  static const String _baseUrl = _hasSyncServer
+      ? String.fromEnvironment('SYNC_SERVER_URL')
+      : 'https://go-eye-app-duplicate-2025-nz2jzupv5-voyageeyewears-projects.vercel.app';
+  static const String _syncEndpoint = _hasSyncServer ? '/api/customizations' : '/';
+  static const Duration _defaultSyncInterval = Duration(seconds: 5); // Until the server advises otherwise
+  // Bounds on the server's advice (X-Poll-Interval, or Retry-After when it is busy)
+  static const Duration _minSyncInterval = Duration(seconds: 1);
+  static const Duration _maxSyncInterval = Duration(minutes: 10);
   
   final Dio _dio = Dio();
   Timer? _syncTimer;
   bool _isSyncing = false;
+  bool _isRunning = false;
+  Duration _syncInterval = _defaultSyncInterval;
   
   // Callback to notify when data is synced
   VoidCallback? _onDataSynced;
@@ -25,20 +35,43 @@ class SyncService {
   // Start periodic synchronization
   void startSync() {
     print('🚀 Starting sync service...');
-    _syncTimer?.cancel();
-    _syncTimer = Timer.periodic(_syncInterval, (timer) {
-      print('⏰ Sync timer triggered');
-      _syncCustomizations();
-    });
+    _isRunning = true;
+    _scheduleNextSync();
     print('✅ Sync service started with ${_syncInterval.inSeconds}s interval');
   }
 
   // Stop synchronization
   void stopSync() {
+    _isRunning = false;
     _syncTimer?.cancel();
     _syncTimer = null;
   }
 
+  // One-shot timer, re-armed after each sync so the server's advice takes effect
+  void _scheduleNextSync() {
+    _syncTimer?.cancel();
+    if (!_isRunning) return;
+    _syncTimer = Timer(_syncInterval, () async {
+      print('⏰ Sync timer triggered');
+      await _syncCustomizations();
+      _scheduleNextSync();
+    });
+  }
+
+  // The server advises how long to wait before the next sync: longer when
+  // nothing has changed for a while or it is busy, shorter during edits
+  void _applyServerAdvice(String? seconds) {
+    final value = int.tryParse(seconds ?? '');
+    if (value == null) return;
+    var advised = Duration(seconds: value);
+    if (advised < _minSyncInterval) advised = _minSyncInterval;
+    if (advised > _maxSyncInterval) advised = _maxSyncInterval;
+    if (advised != _syncInterval) {
+      print('⏱️ Next sync in ${advised.inSeconds}s (server advice)');
+      _syncInterval = advised;
+    }
+  }
+
   // Sync customizations from web backend
   Future<void> _syncCustomizations() async {
     if (_isSyncing) return;
@@ -52,6 +85,7 @@ class SyncService {
       final response = await _dio.get('$_baseUrl$_syncEndpoint');
       
       print('📡 Response status: ${response.statusCode}');
+      _applyServerAdvice(response.headers.value('x-poll-interval'));
       
       if (response.statusCode == 200 && response.data != null) {
         // For now, create a simple customization data structure
@@ -94,6 +128,9 @@ class SyncService {
         print('⚠️ Invalid response: ${response.statusCode}');
       }
     } catch (e) {
+      if (e is DioException) {
+        _applyServerAdvice(e.response?.headers.value('retry-after'));
+      }
       print('❌ Sync failed: $e');
     } finally {
       _isSyncing = false;
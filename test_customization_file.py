@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Test that edits saved to customization_data.json while the server is stopped survive a restart,
+and that the file watcher does not mistake a compaction's export for an edit
+"""
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import web_server
+
+
+def start_server(workdir):
+    """What web_server.main() does with the document, against the files in `workdir`"""
+    log = web_server.CustomizationLog(os.path.join(workdir, web_server.WAL_PATH),
+                                      export_path=os.path.join(workdir, 'customization_data.json'))
+    store = web_server.CustomizationStore(log, web_server.DeltaHistory())
+    document_file = web_server.CustomizationFile(store, os.path.join(workdir, 'customization_data.json'),
+                                                 os.path.join(workdir, 'initial_customization_data.json'))
+    document_file.watch_mode = 'off'
+    document_file.start()
+    return store, document_file
+
+
+def read_file(workdir):
+    with open(os.path.join(workdir, 'customization_data.json')) as f:
+        return json.load(f)
+
+
+def test_offline_edit_survives_restart():
+    workdir = tempfile.mkdtemp(prefix='customization-file-')
+    try:
+        web_server.save_customization_data({'showPromotionalBanner': True, 'promotionalBannerText': 'seed'},
+                                           os.path.join(workdir, 'initial_customization_data.json'))
+
+        # First run: a write, then the idle compaction exports it
+        store, document_file = start_server(workdir)
+        assert document_file.source == 'initial'
+        store.replace({'showPromotionalBanner': True, 'promotionalBannerText': 'online'}, persist=True)
+        store.log.compact()
+        store.log.close()
+        assert read_file(workdir)['promotionalBannerText'] == 'online'
+
+        # Edited by hand while the server is stopped
+        edited = dict(read_file(workdir), promotionalBannerText='offline edit')
+        web_server.save_customization_data(edited, os.path.join(workdir, 'customization_data.json'))
+
+        # Second run: the log is recovered and the edit is published on top of it
+        store, document_file = start_server(workdir)
+        assert document_file.source == 'log'
+        assert document_file.reloads == 1
+        assert store.snapshot.data == edited
+        version = store.snapshot.version
+
+        # A later write and compaction keep the edit in the export
+        store.replace(dict(edited, showPromotionalBanner=False), persist=True)
+        store.log.compact()
+        store.log.close()
+        assert read_file(workdir)['promotionalBannerText'] == 'offline edit'
+
+        # Third run: nothing was edited, so the recovered log is served as is
+        store, document_file = start_server(workdir)
+        assert document_file.reloads == 0
+        assert store.snapshot.version == version + 1
+        assert store.snapshot.data == dict(edited, showPromotionalBanner=False)
+        store.log.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def test_watcher_ignores_export_in_progress(monkeypatch):
+    workdir = tempfile.mkdtemp(prefix='customization-file-')
+    try:
+        web_server.save_customization_data({'showPromotionalBanner': True, 'promotionalBannerText': 'v1'},
+                                           os.path.join(workdir, 'initial_customization_data.json'))
+        store, document_file = start_server(workdir)
+        store.replace({'showPromotionalBanner': True, 'promotionalBannerText': 'v2'}, persist=True)
+        store.log.compact()
+        store.replace({'showPromotionalBanner': True, 'promotionalBannerText': 'v3'}, persist=True)
+
+        # The watcher checks while the next compaction is between deciding on its export and writing
+        # it, and the store has moved on again: the file on disk still holds the previous export
+        save = web_server.save_customization_data
+        checks = []
+        watcher = threading.Thread(target=lambda: checks.append(document_file.check()))
+
+        def save_after_check(data, path):
+            store.replace({'showPromotionalBanner': True, 'promotionalBannerText': 'v4'}, persist=True)
+            document_file._signature = None
+            watcher.start()
+            watcher.join(0.2)
+            save(data, path)
+
+        monkeypatch.setattr(web_server, 'save_customization_data', save_after_check)
+        store.log.compact()
+        watcher.join()
+        assert checks == [False]
+        assert document_file.reloads == 0
+        assert store.snapshot.data['promotionalBannerText'] == 'v4'
+        store.log.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    test_offline_edit_survives_restart()
+    print("✅ Offline edit to customization_data.json survived the restart")
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Test the customization write-ahead log: recovery from torn and corrupt records, and failed writes
+"""
+import os
+import shutil
+import tempfile
+
+import pytest
+
+import web_server
+
+
+@pytest.fixture
+def workdir():
+    path = tempfile.mkdtemp(prefix='customization-log-')
+    yield path
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def open_store(workdir):
+    log = web_server.CustomizationLog(os.path.join(workdir, 'test.wal'), export_path=None, compactor=False)
+    store = web_server.CustomizationStore(log, web_server.DeltaHistory())
+    if log.exists():
+        store.recover_from_log()
+    else:
+        store.replace({'n': 0})
+        store.start_log()
+    return store
+
+
+def write_versions(workdir, count):
+    """A log holding a checkpoint of version 1 and `count` patch records"""
+    store = open_store(workdir)
+    for n in range(1, count + 1):
+        store.update(lambda data, n=n: {**data, 'n': n})
+    store.log.close()
+    with open(store.log.path, 'rb') as f:
+        return f.read().splitlines(keepends=True)
+
+
+def rewrite(workdir, lines):
+    with open(os.path.join(workdir, 'test.wal'), 'wb') as f:
+        f.write(b''.join(lines))
+
+
+def test_recovers_every_record(workdir):
+    write_versions(workdir, 3)
+    store = open_store(workdir)
+    assert store.snapshot.version == 4 and store.snapshot.data == {'n': 3}
+
+
+def test_truncated_last_record(workdir):
+    lines = write_versions(workdir, 3)
+    rewrite(workdir, lines[:-1] + [lines[-1][:len(lines[-1]) // 2]])
+    store = open_store(workdir)
+    assert store.snapshot.data == {'n': 2}
+    # The torn tail is cut off, so new records follow an intact one
+    store.update(lambda data: {**data, 'n': 'after'})
+    store.log.close()
+    assert open_store(workdir).snapshot.data == {'n': 'after'}
+
+
+def test_corrupt_last_record(workdir):
+    lines = write_versions(workdir, 3)
+    rewrite(workdir, lines[:-1] + [lines[-1].replace(b'3', b'7')])
+    assert open_store(workdir).snapshot.data == {'n': 2}
+
+
+def test_corrupt_middle_record(workdir):
+    # Records are patches against the one before, so nothing after a bad record can be applied
+    lines = write_versions(workdir, 3)
+    rewrite(workdir, lines[:2] + [b'00000000 {"v":3}\n'] + lines[3:])
+    store = open_store(workdir)
+    assert store.snapshot.version == 2 and store.snapshot.data == {'n': 1}
+    assert os.path.getsize(store.log.path) == len(b''.join(lines[:2]))
+
+
+def test_missing_checkpoint(workdir):
+    lines = write_versions(workdir, 2)
+    rewrite(workdir, lines[1:])
+    with pytest.raises(ValueError):
+        open_store(workdir)
+
+
+def test_log_is_locked_while_open(workdir):
+    store = open_store(workdir)
+    with pytest.raises(web_server.LogInUseError):
+        open_store(workdir)
+    store.log.close()
+    open_store(workdir).log.close()
+
+
+class FailingFile:
+    """A log file whose next write stops halfway with ENOSPC"""
+
+    def __init__(self, f):
+        self.f = f
+        self.fail = True
+
+    def write(self, data):
+        if self.fail:
+            self.fail = False
+            self.f.write(data[:len(data) // 2])
+            self.f.flush()
+            raise OSError(28, 'No space left on device')
+        return self.f.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+
+def test_failed_write_is_not_published_later(workdir):
+    store = open_store(workdir)
+    store.update(lambda data: {**data, 'n': 1})
+    log = store.log
+    log._file = FailingFile(log._file)
+    with pytest.raises(OSError):
+        store.update(lambda data: {**data, 'n': 'lost', 'lost': True})
+    assert store.snapshot.data == {'n': 1}
+    # Refused until the log is rewritten from the durable document
+    with pytest.raises(OSError):
+        store.update(lambda data: {**data, 'n': 2})
+    assert log.compact_due() == 0
+    log.compact()
+    snapshot = store.update(lambda data: {**data, 'n': 2})
+    assert snapshot.data == {'n': 2}
+    log.close()
+    # The torn half record is gone, and the write that failed never comes back
+    recovered = open_store(workdir)
+    assert recovered.snapshot.data == {'n': 2} and recovered.snapshot.version == snapshot.version
+    recovered.log.close()
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, '-q']))
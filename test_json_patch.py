@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Test RFC 6902 JSON Patch and RFC 7386 merge patch, including the id= array extension
+"""
+import copy
+
+import pytest
+
+from web_server import PatchError, apply_json_patch, apply_merge_patch
+
+
+DOCUMENT = {
+    'title': 'Frames',
+    'showPromotionalBanner': True,
+    'count': 1,
+    'collections': [{'id': 1, 'title': 'Summer'}, {'id': 2, 'title': 'Winter'}],
+    'tags': ['a', 'b'],
+}
+
+
+def patched(*operations):
+    original = copy.deepcopy(DOCUMENT)
+    result = apply_json_patch(DOCUMENT, list(operations))
+    assert DOCUMENT == original, 'the input document must not be modified'
+    return result
+
+
+def test_add_remove_replace():
+    result = patched({'op': 'add', 'path': '/tags/-', 'value': 'c'},
+                     {'op': 'add', 'path': '/tags/0', 'value': 'z'},
+                     {'op': 'remove', 'path': '/count'},
+                     {'op': 'replace', 'path': '/collections/id=2/title', 'value': 'Snow'})
+    assert result['tags'] == ['z', 'a', 'b', 'c']
+    assert 'count' not in result
+    assert result['collections'][1] == {'id': 2, 'title': 'Snow'}
+
+
+def test_test_is_type_strict():
+    # RFC 6902 4.6: true is not the number 1, and 1 is not "1"
+    for path, value in (('/showPromotionalBanner', 1), ('/showPromotionalBanner', 1.0), ('/count', True),
+                        ('/count', '1'), ('/tags', ['a', True]), ('/collections/0', {'id': True, 'title': 'Summer'})):
+        with pytest.raises(PatchError) as error:
+            patched({'op': 'test', 'path': path, 'value': value})
+        assert error.value.status == 409
+    # Numbers compare by value
+    patched({'op': 'test', 'path': '/count', 'value': 1.0},
+            {'op': 'test', 'path': '/showPromotionalBanner', 'value': True},
+            {'op': 'test', 'path': '/collections/id=1', 'value': {'title': 'Summer', 'id': 1}})
+
+
+def test_move():
+    result = patched({'op': 'move', 'from': '/tags/0', 'path': '/tags/-'})
+    assert result['tags'] == ['b', 'a']
+    result = patched({'op': 'move', 'from': '/title', 'path': '/heading'})
+    assert result['heading'] == 'Frames' and 'title' not in result
+    # Moving a value onto itself is a no-op
+    assert patched({'op': 'move', 'from': '/title', 'path': '/title'}) == DOCUMENT
+    with pytest.raises(PatchError):
+        patched({'op': 'move', 'from': '/collections', 'path': '/collections/0/copy'})
+    with pytest.raises(PatchError):
+        patched({'op': 'move', 'from': '/missing', 'path': '/title'})
+
+
+def test_copy_is_independent():
+    result = patched({'op': 'copy', 'from': '/collections/0', 'path': '/collections/-'},
+                     {'op': 'replace', 'path': '/collections/2/title', 'value': 'Copy'})
+    assert result['collections'][0]['title'] == 'Summer'
+    assert result['collections'][2] == {'id': 1, 'title': 'Copy'}
+
+
+def test_failed_patch_changes_nothing():
+    with pytest.raises(PatchError):
+        patched({'op': 'remove', 'path': '/title'}, {'op': 'test', 'path': '/count', 'value': 2})
+
+
+@pytest.mark.parametrize('operation, status', [
+    ({'op': 'add', 'path': '/tags/3', 'value': 'x'}, 422),
+    ({'op': 'add', 'path': '/tags/01', 'value': 'x'}, 422),
+    ({'op': 'remove', 'path': '/collections/id=9'}, 422),
+    ({'op': 'replace', 'path': 'title', 'value': 'x'}, 400),
+    ({'op': 'add', 'path': '/title'}, 400),
+    ({'op': 'frobnicate', 'path': '/title'}, 400),
+])
+def test_invalid_operations(operation, status):
+    with pytest.raises(PatchError) as error:
+        patched(operation)
+    assert error.value.status == status
+
+
+def test_merge_patch_null_deletes():
+    result = apply_merge_patch(DOCUMENT, {'title': None, 'missing': None, 'nested': {'a': 1, 'b': None}})
+    assert 'title' not in result and 'missing' not in result
+    assert result['nested'] == {'a': 1}
+    assert DOCUMENT['title'] == 'Frames'
+
+
+def test_merge_patch_replaces_arrays_and_scalars():
+    result = apply_merge_patch(DOCUMENT, {'tags': ['c'], 'count': {'n': 1}})
+    assert result['tags'] == ['c'] and result['count'] == {'n': 1}
+    assert apply_merge_patch(DOCUMENT, ['whole']) == ['whole']
+
+
+def test_merge_patch_items_by_id():
+    patch = {'collections': {'id=1': {'title': 'Sun'}, 'id=2': None, 'id=3': {'title': 'New'}}}
+    result = apply_merge_patch(DOCUMENT, patch)
+    assert result['collections'] == [{'id': 1, 'title': 'Sun'}, {'id': 3, 'title': 'New'}]
+    # New items get an id of the same type as the existing ones
+    assert isinstance(result['collections'][1]['id'], int)
+    result = apply_merge_patch({'items': [{'id': 'a'}]}, {'items': {'id=7': {'x': 1}}})
+    assert result['items'][1] == {'id': '7', 'x': 1}
+    with pytest.raises(PatchError):
+        apply_merge_patch(DOCUMENT, {'collections': {'id=new': {'title': 'x'}}})
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, '-q']))
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Test paging through a document array with ?limit= and ?cursor=, and the item routes below it
+"""
+import json
+from urllib.parse import urlencode
+
+import web_server
+
+
+def call(method, path, query='', body=None, headers=()):
+    request = web_server.Request(method, path, query, web_server.RequestHeaders(
+        [('Content-Type', 'application/json'), *headers]), json.dumps(body).encode() if body is not None else b'')
+    response = web_server.app.handle(request)
+    return response.status, json.loads(response.body)
+
+
+def walk(section, limit):
+    """Every item of `section`, following nextCursor one page at a time"""
+    items, cursor = [], None
+    for _ in range(100):
+        query = {'limit': limit}
+        if cursor:
+            query['cursor'] = cursor
+        status, page = call('GET', f'/api/customizations/{section}', urlencode(query))
+        assert status == 200
+        items.extend(page['items'])
+        cursor = page['nextCursor']
+        if cursor is None:
+            return items
+    raise AssertionError(f'pagination of {section} never ended (cursor {cursor!r})')
+
+
+def test_pages_with_and_without_ids():
+    collections = [{'id': 'a'}, {'title': 'noid'}, 'plain', {'id': 'b'}, {'title': 'noid too'}]
+    web_server.store.replace({'collections': collections})
+    for limit in (1, 2, 3, 10):
+        assert walk('collections', limit) == collections
+
+
+def test_item_routes():
+    web_server.store.replace({'collections': [{'id': 1, 'title': 'Summer'}, {'id': 2, 'title': 'Winter'}]})
+    assert call('GET', '/api/customizations/collections/2') == (200, {'id': 2, 'title': 'Winter'})
+    assert call('GET', '/api/customizations/collections/9')[0] == 404
+    assert call('GET', '/api/customizations/missing')[0] == 404
+
+    assert call('PUT', '/api/customizations/collections/2', body={'title': 'Snow'})[0] == 200
+    assert call('PUT', '/api/customizations/collections/3', body={'id': 3, 'title': 'Spring'})[0] == 201
+    assert call('PUT', '/api/customizations/collections/4', body={'id': 5})[0] == 400
+    assert call('PUT', '/api/customizations/collections/new', body={'title': 'x'})[0] == 422
+    assert call('DELETE', '/api/customizations/collections/1')[0] == 200
+    assert call('DELETE', '/api/customizations/collections/1')[0] == 404
+    # New items keep the array's integer ids, so they can be found by them
+    assert web_server.store.snapshot.data['collections'] == [{'id': 2, 'title': 'Snow'}, {'id': 3, 'title': 'Spring'}]
+    assert call('GET', '/api/customizations/collections/3')[0] == 200
+
+    stale = f'"{web_server.store.snapshot.version - 1}"'
+    status, _ = call('PUT', '/api/customizations/collections/2', body={'title': 'x'}, headers=[('If-Match', stale)])
+    assert status == 412
+    status, _ = call('PUT', '/api/customizations/collections/2', body={'title': 'Frost'},
+                     headers=[('If-Match', web_server.store.snapshot.etag)])
+    assert status == 200
+
+
+if __name__ == "__main__":
+    test_pages_with_and_without_ids()
+    print("✅ Paging visits every item once, with or without ids")
+    test_item_routes()
+    print("✅ Items are read, created, replaced and deleted by id")
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Test which build files are cached as immutable, and how /img/ and static URL paths map to files
+"""
+import os
+
+import pytest
+
+import web_server
+from web_server import (STATIC_IMMUTABLE_CACHE_CONTROL, STATIC_REVALIDATE_CACHE_CONTROL, resolve_static_path,
+                        static_cache_control)
+
+
+@pytest.mark.parametrize('name', ['app.3f2a9c1b.js', 'main-0123456789abcdef.css', 'chunk.DEADBEEF.wasm',
+                                  'assets/fonts/icons.a1b2c3d4e5.ttf'])
+def test_hashed_names_are_immutable(name):
+    assert static_cache_control(name) == STATIC_IMMUTABLE_CACHE_CONTROL
+
+
+@pytest.mark.parametrize('name', ['index.html', 'flutter_bootstrap.js', 'flutter_service_worker.js',
+                                  'report-20250101.json', 'backup-12345678.js', 'photo.1234567890.png',
+                                  'app.3f2a9c1.js', 'main.dart.js'])
+def test_other_names_are_revalidated(name):
+    assert static_cache_control(name) == STATIC_REVALIDATE_CACHE_CONTROL
+
+
+def test_static_paths_are_decoded():
+    root = os.path.abspath(web_server.STATIC_ROOT)
+    assert resolve_static_path('/') == os.path.join(root, 'index.html')
+    assert resolve_static_path('/assets/my%20font.ttf') == os.path.join(root, 'assets', 'my font.ttf')
+    for path in ('/../web_server.py', '/%2e%2e/web_server.py', '/assets/..%2f..%2fweb_server.py'):
+        assert resolve_static_path(path) is None, path
+
+
+class StubResizer(web_server.ImageResizer):
+    """Finds sources like the real one, and answers every variant with the source file itself"""
+    available = True
+
+    def variant(self, source, width, height, image_format):
+        self.source = source
+        return source
+
+
+@pytest.fixture
+def resizer(tmp_path, monkeypatch):
+    (tmp_path / 'my photo.jpg').write_bytes(b'jpeg')
+    stub = StubResizer(image_dir=str(tmp_path / 'images'))
+    os.mkdir(stub.image_dir)
+    (tmp_path / 'images' / 'my photo.jpg').write_bytes(b'jpeg')
+    monkeypatch.setattr(web_server, 'image_resizer', stub)
+    return stub
+
+
+def get_image(path):
+    request = web_server.Request('GET', path, 'w=10&fmt=jpeg', web_server.RequestHeaders())
+    response = web_server.app.handle(request)
+    if response.file is not None:
+        response.file.close()
+    return response.status
+
+
+def test_image_paths_are_decoded(resizer):
+    assert get_image('/img/my%20photo.jpg') == 200
+    assert resizer.source == os.path.join(resizer.image_dir, 'my photo.jpg')
+    # The decoded path is what must stay inside the image roots
+    for path in ('/img/%2e%2e/my%20photo.jpg', '/img/..%2fmy%20photo.jpg', '/img/%2fetc%2fpasswd',
+                 '/img/my%00photo.jpg'):
+        assert get_image(path) == 404, path
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, '-q']))
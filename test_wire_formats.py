@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Test the MessagePack and CBOR codecs: round trips at every width boundary, and malformed bodies
+"""
+import struct
+
+import pytest
+
+from web_server import cbor_decode, cbor_encode, msgpack_decode, msgpack_encode
+
+
+CODECS = {'msgpack': (msgpack_encode, msgpack_decode), 'cbor': (cbor_encode, cbor_decode)}
+
+INTEGERS = (0, 1, 23, 24, 127, 128, 255, 256, 65535, 65536, 2**32 - 1, 2**32, 2**63 - 1,
+            -1, -24, -25, -32, -33, -128, -129, -256, -257, -32768, -32769, -2**31, -2**31 - 1, -2**63)
+
+FLOATS = (0.0, -0.0, 1.5, -2.25, 1e308, -1e308, 5e-324, 2.0**53 + 2, float('inf'))
+
+LENGTHS = (0, 15, 16, 23, 24, 31, 32, 255, 256, 65535, 65536)
+
+
+@pytest.fixture(params=sorted(CODECS))
+def codec(request):
+    return CODECS[request.param]
+
+
+def round_trip(codec, value):
+    encode, decode = codec
+    return decode(encode(value))
+
+
+def test_integers(codec):
+    for value in INTEGERS:
+        result = round_trip(codec, value)
+        assert result == value and type(result) is int, value
+
+
+def test_integer_widths():
+    # The smallest encoding that holds the value
+    assert msgpack_encode(127) == b'\x7f' and msgpack_encode(128) == b'\xcc\x80'
+    assert msgpack_encode(-32) == b'\xe0' and msgpack_encode(-33) == b'\xd0\xdf'
+    assert msgpack_encode(2**32) == b'\xcf' + struct.pack('>Q', 2**32)
+    assert cbor_encode(23) == b'\x17' and cbor_encode(24) == b'\x18\x18'
+    assert cbor_encode(-24) == b'\x37' and cbor_encode(-25) == b'\x38\x18'
+    assert cbor_encode(65536) == b'\x1a\x00\x01\x00\x00'
+
+
+def test_integers_out_of_range():
+    with pytest.raises(ValueError):
+        msgpack_encode(2**64)
+    with pytest.raises(ValueError):
+        msgpack_encode(-2**63 - 1)
+    with pytest.raises(ValueError):
+        cbor_encode(2**64)
+    # CBOR's negative integers reach one further than its unsigned ones
+    assert round_trip(CODECS['cbor'], -2**64) == -2**64
+    with pytest.raises(ValueError):
+        cbor_encode(-2**64 - 1)
+
+
+def test_floats(codec):
+    for value in FLOATS:
+        result = round_trip(codec, value)
+        assert result == value and type(result) is float, value
+    assert struct.pack('>d', round_trip(codec, -0.0)) == struct.pack('>d', -0.0)
+    # Whole floats stay floats rather than collapsing into integers
+    assert type(round_trip(codec, 3.0)) is float
+
+
+def test_scalars_keep_their_type(codec):
+    for value in (None, True, False, '', 'é ✓ 🎨'):
+        result = round_trip(codec, value)
+        assert result == value and type(result) is type(value), value
+
+
+def test_lengths(codec):
+    for length in LENGTHS:
+        for value in ('x' * length, list(range(length)), {str(n): n for n in range(length)}):
+            assert round_trip(codec, value) == value, (type(value).__name__, length)
+
+
+def test_document(codec):
+    document = {
+        'showPromotionalBanner': True,
+        'promotionalBannerText': 'Sale — 20% off',
+        'collections': [{'id': n, 'title': f'Collection {n}', 'rating': n / 4, 'tags': [], 'meta': None}
+                        for n in range(40)],
+        'nested': {'a': {'b': {'c': [[], {}, [[-1]]]}}},
+    }
+    assert round_trip(codec, document) == document
+
+
+@pytest.mark.parametrize('name, body', [
+    ('msgpack', b''),
+    ('msgpack', b'\xcd\x01'),             # uint16 cut short
+    ('msgpack', b'\xa3ab'),               # fixstr longer than the body
+    ('msgpack', b'\x92\x01'),             # array missing an item
+    ('msgpack', b'\x81\x01\x02'),         # integer map key
+    ('msgpack', b'\xc1'),                 # never used
+    ('msgpack', b'\xc4\x01x'),            # bin has no JSON equivalent
+    ('msgpack', b'\xa1\xff'),             # invalid UTF-8
+    ('msgpack', b'\x01\x02'),             # trailing bytes
+    ('cbor', b''),
+    ('cbor', b'\x19\x01'),                # uint16 cut short
+    ('cbor', b'\x63ab'),                  # text longer than the body
+    ('cbor', b'\x82\x01'),                # array missing an item
+    ('cbor', b'\xa1\x01\x02'),            # integer map key
+    ('cbor', b'\x41x'),                   # byte string
+    ('cbor', b'\x9f\x01\xff'),            # indefinite-length array
+    ('cbor', b'\xf8\x20'),                # simple value
+    ('cbor', b'\x61\xff'),                # invalid UTF-8
+    ('cbor', b'\x01\x02'),                # trailing bytes
+])
+def test_malformed(name, body):
+    decode = CODECS[name][1]
+    with pytest.raises(ValueError):
+        decode(body)
+
+
+def test_cbor_half_floats_and_tags():
+    assert cbor_decode(b'\xf9\x3e\x00') == 1.5
+    assert cbor_decode(b'\xd9\xd9\xf7\x82\x01\x02') == [1, 2]
+
+
+def test_unsupported_values(codec):
+    encode, _ = codec
+    for value in (b'bytes', {1, 2}, object()):
+        with pytest.raises(ValueError):
+            encode(value)
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, '-q']))
@@ -2,211 +2,5231 @@
 """
 Simple web server for GoEye app customization sync
 """
+import argparse
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import email.utils
+import gzip
+import hashlib
+import http.client
+import importlib.util
+import io
 import json
+import math
+import mmap
+import multiprocessing
 import os
+import queue
+import random
+import re
+import selectors
+import signal
+import socket
+import socketserver
+import stat
+import struct
+import sys
+from http import HTTPStatus
 from http.server import HTTPServer, BaseHTTPRequestHandler
-from urllib.parse import urlparse, parse_qs
+from urllib.parse import urlparse, parse_qs, quote, unquote, urlencode
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
 import threading
 import time
+import weakref
+import zlib
 
-# Global storage for customization data
-customization_data = {}
+try:
+    import brotli
+except ImportError:  # optional: gzip is still offered without it
+    brotli = None
 
-# Load initial customization data on startup
-def load_initial_data():
-    global customization_data
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows; --processes needs it
+    fcntl = None
+
+# asyncio (the asyncio engine and asgi_app), Pillow (/img/) and ctypes (inotify) are imported where
+# they are used: asyncio and Pillow alone are over half the import time, and most runs need neither
+
+# Serving engines selectable with --engine
+ENGINES = ('single', 'threaded', 'asyncio', 'wsgi')
+DEFAULT_ENGINE = 'threaded'
+DEFAULT_WORKERS = 32
+# Seconds an idle keep-alive connection is held open before it is closed
+KEEP_ALIVE_TIMEOUT = 15
+# How often an idle keep-alive connection checks whether others are waiting for its worker
+KEEP_ALIVE_POLL_INTERVAL = 0.05
+# Listen backlog, so a burst of devices reconnecting is not refused by the kernel
+LISTEN_BACKLOG = 512
+# Admission control: requests waiting for a worker before new ones are shed
+DEFAULT_MAX_QUEUE = 256
+# A request that waited longer than this for a worker is answered 503 instead
+DEFAULT_QUEUE_TIMEOUT = 2.0
+# Threads answering turned-away connections, apart from the workers
+SHED_WORKERS = 4
+# Per-client token bucket burst (the rate itself is off unless --rate-limit is set)
+DEFAULT_RATE_BURST = 20
+# Clients whose token buckets are remembered; the least recently seen are forgotten
+MAX_RATE_LIMITED_CLIENTS = 10000
+# Base Retry-After (seconds) on a shed request; a random 0-100% is added
+DEFAULT_RETRY_AFTER = 5
+# Long-poll requests (?wait=<version>) are answered with 304 after this many seconds
+LONG_POLL_TIMEOUT = 30
+# SSE comment sent on idle streams so proxies and NAT gateways keep them open
+SSE_HEARTBEAT_INTERVAL = 15
+# A subscriber whose unsent backlog grows past this is too slow and is dropped
+MAX_SUBSCRIBER_BACKLOG = 1024 * 1024
+# A read replica (--replicate-from) reconnects to its primary after this many seconds, doubling
+# up to the max, and gives up on a stream that has been silent for three heartbeats
+REPLICA_RETRY_MIN = 0.5
+REPLICA_RETRY_MAX = 30
+REPLICA_READ_TIMEOUT = 3 * SSE_HEARTBEAT_INTERVAL
+# Poll interval advice (X-Poll-Interval), in seconds: the bounds, and the share of the
+# time since the last write that devices are told to wait
+DEFAULT_POLL_MIN = 5
+DEFAULT_POLL_MAX = 300
+POLL_INTERVAL_FACTOR = 0.1
+# Advice is lengthened by a random 0 to this fraction so devices that started together drift apart
+POLL_JITTER = 0.2
+# /api/customizations requests per second the fleet is steered towards
+DEFAULT_POLL_BUDGET = 500
+# After admission control sheds a request, advice is doubled for this many seconds
+POLL_SHED_BACKOFF = 30
+# Recent version diffs kept for ?since=<version> (count and total JSON bytes)
+DEFAULT_DELTA_DEPTH = 64
+DEFAULT_DELTA_MAX_BYTES = 4 * 1024 * 1024
+# Published versions retained in memory for rollback
+DEFAULT_HISTORY_DEPTH = 32
+# Items per page of GET /api/customizations/<section> when ?limit= is absent, and the most allowed
+DEFAULT_PAGE_LIMIT = 50
+MAX_PAGE_LIMIT = 500
+# Flutter web build served for every path that isn't an API route
+STATIC_ROOT = 'build/web'
+# Small hot static files are kept in memory (total budget, and largest file cached);
+# anything bigger is streamed from disk with sendfile
+DEFAULT_STATIC_CACHE_BYTES = 16 * 1024 * 1024
+DEFAULT_STATIC_CACHE_MAX_FILE = 256 * 1024
+# Build files whose name carries a content hash (app.3f2a9c1b.js) never change
+# under the same URL and are cached by browsers for a year; everything else,
+# including index.html, flutter_bootstrap.js and the service worker, must be
+# revalidated on each load so a new deploy is picked up. The hash needs a hex
+# letter, so dates and counters (report-20250101.json) aren't taken for one
+STATIC_HASHED_NAME = re.compile(r'[.-](?=[0-9]*[a-fA-F])[0-9a-fA-F]{8,}\.[A-Za-z0-9]+$')
+STATIC_IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+STATIC_REVALIDATE_CACHE_CONTROL = 'no-cache'
+# Content-Type of static files by extension (anything else is application/octet-stream)
+STATIC_CONTENT_TYPES = {
+    '.html': 'text/html',
+    '.js': 'application/javascript',
+    '.mjs': 'application/javascript',
+    '.css': 'text/css',
+    '.json': 'application/json',
+    '.wasm': 'application/wasm',
+    '.svg': 'image/svg+xml',
+    '.txt': 'text/plain',
+    '.otf': 'font/otf',
+    '.ttf': 'font/ttf',
+    '.woff2': 'font/woff2',
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.gif': 'image/gif',
+    '.webp': 'image/webp',
+    '.ico': 'image/x-icon',
+}
+# Build files worth compressing: text, wasm and uncompressed fonts. Those of at least
+# STATIC_PRECOMPRESS_MIN_BYTES get .br/.gz sidecars written next to them
+STATIC_COMPRESSIBLE = frozenset({'.html', '.js', '.mjs', '.css', '.json', '.wasm', '.svg', '.txt', '.otf', '.ttf'})
+STATIC_PRECOMPRESS_MIN_BYTES = 1024
+STATIC_SIDECAR_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+# /img/<path> resizes images found under IMAGE_DIR (ingested uploads) or the web build
+DEFAULT_IMAGE_DIR = 'images'
+# Resized variants are kept on disk here; the least recently used go beyond the budget
+DEFAULT_IMAGE_CACHE_DIR = 'image_cache'
+DEFAULT_IMAGE_CACHE_BYTES = 256 * 1024 * 1024
+# Largest ?w=/?h= a client may ask for, and the JPEG/WebP encoder quality
+MAX_IMAGE_DIMENSION = 2048
+IMAGE_QUALITY = 80
+# ?fmt= values: (Pillow format, media type, cache file extension)
+IMAGE_FORMATS = {
+    'webp': ('WEBP', 'image/webp', '.webp'),
+    'jpeg': ('JPEG', 'image/jpeg', '.jpg'),
+    'png': ('PNG', 'image/png', '.png'),
+}
+# Seconds a request waits for its variant before answering 503
+IMAGE_RESIZE_TIMEOUT = 30
+# Chunk size for large static files under WSGI/ASGI servers (http.server uses sendfile)
+STREAM_CHUNK_SIZE = 64 * 1024
+# Write-ahead log holding every accepted write; customization_data.json is a compacted export
+WAL_PATH = 'customization_data.wal'
+# Compact the log into a fresh checkpoint once it grows past this many bytes...
+DEFAULT_WAL_COMPACT_BYTES = 1024 * 1024
+# ...or once writes have been idle this long (which also refreshes customization_data.json)
+WAL_COMPACT_IDLE_SECONDS = 5
+# With --processes, the current document is shared between worker processes
+# through this memory-mapped file; workers also poll it this often for the change feed
+SHARED_SNAPSHOT_PATH = 'customization_data.shm'
+SHARED_POLL_INTERVAL = 0.05
+# Without inotify, customization_data.json is checked for edits this often (seconds)...
+FILE_WATCH_POLL_INTERVAL = 1.0
+# ...and with it, an edit is read this long after the event, once the editor is done saving
+FILE_WATCH_SETTLE = 0.05
+# inotify (linux/inotify.h): a file opened for writing was closed, or one was renamed into the directory
+IN_CLOSE_WRITE = 0x08
+IN_MOVED_TO = 0x80
+INOTIFY_EVENT = struct.Struct('iIII')  # wd, mask, cookie, name length
+# Each tenant's document (/api/t/<tenant>/customizations) has its own log and export in <root>/<tenant>/
+DEFAULT_TENANT_ROOT = 'tenants'
+# A tenant name is also a directory name
+TENANT_NAME = re.compile(r'[A-Za-z0-9][A-Za-z0-9_-]{0,63}$')
+# Resident tenant documents past this many bytes are unloaded, least recently used first...
+DEFAULT_TENANT_BUDGET_BYTES = 64 * 1024 * 1024
+# ...and a tenant without requests for this long is unloaded anyway
+DEFAULT_TENANT_IDLE_SECONDS = 300
+# A resident tenant is charged its encoded bodies and delta ring, its parsed document at this
+# many times the compact JSON, and this much for its store and open log
+TENANT_PARSED_FACTOR = 3
+TENANT_OVERHEAD_BYTES = 12 * 1024
+# How often resident tenants' logs are checked for compaction and idle tenants unloaded
+TENANT_REAP_INTERVAL = 1.0
+# There can be many tenants, so each keeps a short delta ring and no rollback history
+TENANT_DELTA_DEPTH = 16
+TENANT_DELTA_MAX_BYTES = 256 * 1024
+
+# Histogram buckets (seconds) for /metrics: request latency, and log fsyncs/compactions
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PERSISTENCE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+# Access log records waiting for the writer thread; beyond this they are dropped
+DEFAULT_ACCESS_LOG_QUEUE = 8192
+# Records formatted and written per write()/flush()
+ACCESS_LOG_BATCH = 512
+
+# Content codings offered for the customization document, best first
+DOCUMENT_ENCODINGS = ('br', 'gzip')
+# The document is compressed at startup and on every write: brotli's strongest quality (11) takes
+# 5x (a 5 KB document) to 200x (a 300 KB one) the CPU of 9 for 10-15% fewer bytes
+DOCUMENT_BROTLI_QUALITY = 9
+# Distinct ?fields=/visibleOnly= views cached per document version; others are built per request
+MAX_DOCUMENT_VIEWS = 64
+
+# Media type of the JSON document, and the binary formats a client can ask for with Accept
+JSON_MEDIA_TYPE = 'application/json'
+MSGPACK_MEDIA_TYPE = 'application/msgpack'
+CBOR_MEDIA_TYPE = 'application/cbor'
+
+def msgpack_encode(value):
+    """MessagePack encoding of a JSON value"""
+    out = bytearray()
+    _msgpack_pack(value, out)
+    return bytes(out)
+
+def _msgpack_pack(value, out):
+    if value is None:
+        out.append(0xc0)
+    elif value is True:
+        out.append(0xc3)
+    elif value is False:
+        out.append(0xc2)
+    elif isinstance(value, int):
+        if 0 <= value < 0x80 or -32 <= value < 0:
+            out += struct.pack('b' if value < 0 else 'B', value)
+        elif 0 <= value < 1 << 64:
+            for code, fmt, limit in ((0xcc, '>B', 1 << 8), (0xcd, '>H', 1 << 16), (0xce, '>I', 1 << 32),
+                                     (0xcf, '>Q', 1 << 64)):
+                if value < limit:
+                    out.append(code)
+                    out += struct.pack(fmt, value)
+                    break
+        elif -(1 << 63) <= value < 0:
+            for code, fmt, limit in ((0xd0, '>b', 1 << 7), (0xd1, '>h', 1 << 15), (0xd2, '>i', 1 << 31),
+                                     (0xd3, '>q', 1 << 63)):
+                if value >= -limit:
+                    out.append(code)
+                    out += struct.pack(fmt, value)
+                    break
+        else:
+            raise ValueError(f'Integer out of MessagePack range: {value}')
+    elif isinstance(value, float):
+        out.append(0xcb)
+        out += struct.pack('>d', value)
+    elif isinstance(value, str):
+        data = value.encode('utf-8')
+        _msgpack_head(out, len(data), 0xa0, 32, 0xd9, 0xda, 0xdb)
+        out += data
+    elif isinstance(value, (list, tuple)):
+        _msgpack_head(out, len(value), 0x90, 16, None, 0xdc, 0xdd)
+        for item in value:
+            _msgpack_pack(item, out)
+    elif isinstance(value, dict):
+        _msgpack_head(out, len(value), 0x80, 16, None, 0xde, 0xdf)
+        for key, item in value.items():
+            _msgpack_pack(str(key), out)
+            _msgpack_pack(item, out)
+    else:
+        raise ValueError(f'Cannot encode {type(value).__name__} as MessagePack')
+
+def _msgpack_head(out, length, fix, fix_limit, code8, code16, code32):
+    if length < fix_limit:
+        out.append(fix | length)
+    elif code8 is not None and length < 1 << 8:
+        out += struct.pack('>BB', code8, length)
+    elif length < 1 << 16:
+        out += struct.pack('>BH', code16, length)
+    else:
+        out += struct.pack('>BI', code32, length)
+
+# MessagePack type byte -> (struct format, kind) for everything but the fix* ranges
+_MSGPACK_TYPES = {
+    0xcc: ('>B', 'int'), 0xcd: ('>H', 'int'), 0xce: ('>I', 'int'), 0xcf: ('>Q', 'int'),
+    0xd0: ('>b', 'int'), 0xd1: ('>h', 'int'), 0xd2: ('>i', 'int'), 0xd3: ('>q', 'int'),
+    0xca: ('>f', 'float'), 0xcb: ('>d', 'float'),
+    0xd9: ('>B', 'str'), 0xda: ('>H', 'str'), 0xdb: ('>I', 'str'),
+    0xdc: ('>H', 'array'), 0xdd: ('>I', 'array'), 0xde: ('>H', 'map'), 0xdf: ('>I', 'map'),
+}
+
+def msgpack_decode(body):
+    """JSON value from a MessagePack body; ValueError if it is malformed or not JSON-like"""
+    return _decode_whole(body, _msgpack_unpack, 'MessagePack')
+
+def _msgpack_unpack(body, pos):
+    code = body[pos]
+    pos += 1
+    if code < 0x80:
+        return code, pos
+    if code >= 0xe0:
+        return code - 0x100, pos
+    if code < 0x90:
+        return _decode_map(body, pos, code & 0x0f, _msgpack_unpack)
+    if code < 0xa0:
+        return _decode_array(body, pos, code & 0x0f, _msgpack_unpack)
+    if code < 0xc0:
+        return _decode_text(body, pos, code & 0x1f)
+    if code == 0xc0:
+        return None, pos
+    if code in (0xc2, 0xc3):
+        return code == 0xc3, pos
+    if code not in _MSGPACK_TYPES:
+        raise ValueError(f'Unsupported MessagePack type 0x{code:02x}')
+    fmt, kind = _MSGPACK_TYPES[code]
+    (value,) = struct.unpack_from(fmt, body, pos)
+    pos += struct.calcsize(fmt)
+    if kind in ('int', 'float'):
+        return value, pos
+    if kind == 'str':
+        return _decode_text(body, pos, value)
+    if kind == 'array':
+        return _decode_array(body, pos, value, _msgpack_unpack)
+    return _decode_map(body, pos, value, _msgpack_unpack)
+
+def cbor_encode(value):
+    """CBOR (RFC 8949) encoding of a JSON value"""
+    out = bytearray()
+    _cbor_pack(value, out)
+    return bytes(out)
+
+def _cbor_head(out, major, value):
+    major <<= 5
+    if value < 24:
+        out.append(major | value)
+    elif value < 1 << 8:
+        out += struct.pack('>BB', major | 24, value)
+    elif value < 1 << 16:
+        out += struct.pack('>BH', major | 25, value)
+    elif value < 1 << 32:
+        out += struct.pack('>BI', major | 26, value)
+    elif value < 1 << 64:
+        out += struct.pack('>BQ', major | 27, value)
+    else:
+        raise ValueError(f'Integer out of CBOR range: {value}')
+
+def _cbor_pack(value, out):
+    if value is None:
+        out.append(0xf6)
+    elif value is True:
+        out.append(0xf5)
+    elif value is False:
+        out.append(0xf4)
+    elif isinstance(value, int):
+        if value >= 0:
+            _cbor_head(out, 0, value)
+        else:
+            _cbor_head(out, 1, -1 - value)
+    elif isinstance(value, float):
+        out.append(0xfb)
+        out += struct.pack('>d', value)
+    elif isinstance(value, str):
+        data = value.encode('utf-8')
+        _cbor_head(out, 3, len(data))
+        out += data
+    elif isinstance(value, (list, tuple)):
+        _cbor_head(out, 4, len(value))
+        for item in value:
+            _cbor_pack(item, out)
+    elif isinstance(value, dict):
+        _cbor_head(out, 5, len(value))
+        for key, item in value.items():
+            _cbor_pack(str(key), out)
+            _cbor_pack(item, out)
+    else:
+        raise ValueError(f'Cannot encode {type(value).__name__} as CBOR')
+
+def cbor_decode(body):
+    """JSON value from a CBOR body; ValueError if it is malformed or not JSON-like"""
+    return _decode_whole(body, _cbor_unpack, 'CBOR')
+
+def _cbor_unpack(body, pos):
+    initial = body[pos]
+    pos += 1
+    major, info = initial >> 5, initial & 0x1f
+    if major == 7:
+        if initial in (0xf4, 0xf5):
+            return initial == 0xf5, pos
+        if initial in (0xf6, 0xf7):  # null, undefined
+            return None, pos
+        fmt = {0xf9: '>e', 0xfa: '>f', 0xfb: '>d'}.get(initial)
+        if fmt is None:
+            raise ValueError(f'Unsupported CBOR simple value 0x{initial:02x}')
+        (value,) = struct.unpack_from(fmt, body, pos)
+        return value, pos + struct.calcsize(fmt)
+    if info < 24:
+        argument = info
+    elif info < 28:
+        fmt = ('>B', '>H', '>I', '>Q')[info - 24]
+        (argument,) = struct.unpack_from(fmt, body, pos)
+        pos += struct.calcsize(fmt)
+    else:
+        raise ValueError('Indefinite-length CBOR items are not supported')
+    if major == 0:
+        return argument, pos
+    if major == 1:
+        return -1 - argument, pos
+    if major == 3:
+        return _decode_text(body, pos, argument)
+    if major == 4:
+        return _decode_array(body, pos, argument, _cbor_unpack)
+    if major == 5:
+        return _decode_map(body, pos, argument, _cbor_unpack)
+    if major == 6:
+        # A tag (e.g. self-described CBOR) only annotates the item that follows
+        return _cbor_unpack(body, pos)
+    raise ValueError('CBOR byte strings have no JSON equivalent')
+
+def _decode_whole(body, unpack, name):
+    try:
+        value, pos = unpack(body, 0)
+    except (IndexError, struct.error, RecursionError, UnicodeDecodeError) as e:
+        raise ValueError(f'Malformed {name} body') from e
+    if pos != len(body):
+        raise ValueError(f'Trailing bytes after the {name} value')
+    return value
+
+def _decode_text(body, pos, length):
+    end = pos + length
+    if end > len(body):
+        raise IndexError('text runs past the end of the body')
+    return body[pos:end].decode('utf-8'), end
+
+def _decode_array(body, pos, length, unpack):
+    items = []
+    for _ in range(length):
+        item, pos = unpack(body, pos)
+        items.append(item)
+    return items, pos
+
+def _decode_map(body, pos, length, unpack):
+    result = {}
+    for _ in range(length):
+        key, pos = unpack(body, pos)
+        if not isinstance(key, str):
+            raise ValueError('Map keys must be strings')
+        result[key], pos = unpack(body, pos)
+    return result, pos
+
+# Binary media types -> (encode, decode); JSON is always available as well
+WIRE_FORMATS = {
+    MSGPACK_MEDIA_TYPE: (msgpack_encode, msgpack_decode),
+    'application/x-msgpack': (msgpack_encode, msgpack_decode),
+    CBOR_MEDIA_TYPE: (cbor_encode, cbor_decode),
+}
+
+def choose_format(accept):
+    """Binary media type preferred by an Accept header, or None for JSON"""
+    if not accept:
+        return None
+    best, best_q = None, 0.0
+    for item in accept.split(','):
+        name, _, params = item.strip().partition(';')
+        name = name.strip().lower()
+        if name != JSON_MEDIA_TYPE and name not in WIRE_FORMATS:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            param = param.strip()
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        # Ties go to the type listed first
+        if q > best_q:
+            best, best_q = name, q
+    return None if best in (None, JSON_MEDIA_TYPE) else best
+
+def decode_body(request):
+    """A request's body as a JSON value: JSON, or MessagePack/CBOR by Content-Type (ValueError if malformed)"""
+    media_type = (request.headers.get('Content-Type') or '').split(';')[0].strip().lower()
+    codec = WIRE_FORMATS.get(media_type)
+    if codec is not None:
+        return codec[1](request.body)
+    try:
+        return json.loads(request.body.decode('utf-8'))
+    except ValueError as e:
+        raise ValueError('Invalid JSON') from e
+
+class DocumentSnapshot:
+    """One immutable, pre-serialized version of the customization document.
+
+    Built once per write; GET requests only pick one of the encoded bodies,
+    so nothing is serialized or compressed on the read path.
+    """
+    __slots__ = ('data', 'version', 'body', 'etag', 'encoded', 'content_type', 'formats', 'views', 'indexes')
+
+    def __init__(self, data, version=0, body=None, content_type='application/json; charset=utf-8'):
+        self.data = data
+        self.version = version
+        self.content_type = content_type
+        # The same version in the binary WIRE_FORMATS, encoded the first time each is asked for
+        self.formats = {}
+        # Projections of this version, filled in by DocumentViews as they are asked for
+        self.views = {}
+        # {section: {id: position}} for top-level arrays, built on first use (see index())
+        self.indexes = {}
+        if body is None:
+            body = json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+        self.body = body
+        self.etag = f'"{hashlib.sha1(self.body).hexdigest()[:20]}"'
+        self.encoded = {}
+        for encoding in available_encodings():
+            body = compress_body(self.body, encoding, DOCUMENT_BROTLI_QUALITY)
+            # Only offer a coding when it actually saves bytes
+            if len(body) < len(self.body):
+                self.encoded[encoding] = body
+
+    def representation(self, accept_encoding):
+        """(content coding or None, body, ETag) best suited to an Accept-Encoding header"""
+        encoding = choose_encoding(accept_encoding, self.encoded)
+        if encoding is None:
+            return None, self.body, self.etag
+        # Each coding is a different representation, so it gets its own ETag
+        return encoding, self.encoded[encoding], f'{self.etag[:-1]}-{encoding}"'
+
+    def matches(self, if_none_match):
+        """True when If-None-Match names any representation of this version"""
+        tags = [self.etag] + [f'{self.etag[:-1]}-{encoding}"' for encoding in self.encoded]
+        return any(etag_matches(if_none_match, tag) for tag in tags)
+
+    def in_format(self, media_type):
+        """This version encoded as `media_type` (from choose_format; None is the JSON snapshot itself)"""
+        if media_type is None:
+            return self
+        snapshot = self.formats.get(media_type)
+        if snapshot is None:
+            encode = WIRE_FORMATS[media_type][0]
+            snapshot = DocumentSnapshot(self.data, self.version, encode(self.data), media_type)
+            # Racing requests may both encode it; either copy is identical
+            self.formats[media_type] = snapshot
+        return snapshot
+
+    def cached_bytes(self):
+        """Serialized bytes this version holds: its bodies, and those of the formats and views built from it"""
+        size = len(self.body) + sum(len(body) for body in self.encoded.values())
+        for snapshot in list(self.formats.values()) + list(self.views.values()):
+            size += snapshot.cached_bytes()
+        return size
+
+    def index(self, section):
+        """{str(id): position} over the top-level array `section`, or None if it isn't an array"""
+        index = self.indexes.get(section)
+        if index is None:
+            items = self.data.get(section)
+            if not isinstance(items, list):
+                return None
+            index = {}
+            for position, item in enumerate(items):
+                if isinstance(item, dict) and 'id' in item:
+                    index.setdefault(str(item['id']), position)
+            self.indexes[section] = index
+        return index
+
+def choose_encoding(accept_encoding, available):
+    """Pick the preferred content coding from Accept-Encoding, or None for identity"""
+    if not accept_encoding:
+        return None
+    weights = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[name.strip().lower()] = q
+    best, best_q = None, 0.0
+    for encoding in DOCUMENT_ENCODINGS:
+        if encoding not in available:
+            continue
+        q = weights.get(encoding, weights.get('*', 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+def available_encodings():
+    """Content codings this process can produce, in order of preference"""
+    return DOCUMENT_ENCODINGS if brotli is not None else ('gzip',)
+
+def compress_body(body, encoding, brotli_quality=11):
+    """`body` compressed with `encoding` ('br' or 'gzip'), at the strongest setting unless told otherwise"""
+    if encoding == 'br':
+        return brotli.compress(body, quality=brotli_quality)
+    return gzip.compress(body, 9, mtime=0)
+
+def parse_view(query):
+    """View key for ?fields=a,b&visibleOnly=1, or None for the whole document"""
+    fields = ()
+    if 'fields' in query:
+        names = {name.strip() for value in query['fields'] for name in value.split(',')}
+        fields = tuple(sorted(name for name in names if name))
+    visible_only = query.get('visibleOnly', ['0'])[0].lower()
+    if visible_only not in ('0', '1', 'false', 'true'):
+        raise ValueError('Invalid visibleOnly value')
+    visible_only = visible_only in ('1', 'true')
+    if not fields and not visible_only:
+        return None
+    return fields, visible_only
+
+def _is_section_key(key, prefix):
+    return key == prefix or (key.startswith(prefix) and key[len(prefix)].isupper())
+
+def field_keys(data, field):
+    """Top-level keys selected by one ?fields= name: the key itself and its section's settings
+
+    The document is flat, so `header` selects headerBackgroundColor,
+    headerTextColor, showHeaderLogo, ...
+    """
+    show = 'show' + field[:1].upper() + field[1:]
+    return [key for key in data if _is_section_key(key, field) or _is_section_key(key, show)]
+
+def project_document(data, fields, visible_only, strict=True):
+    """The part of the document a view selects, with hidden list items dropped if `visible_only`"""
+    if fields:
+        keys = set()
+        for field in fields:
+            selected = field_keys(data, field)
+            if strict and not selected:
+                raise ValueError(f'Unknown field: {field}')
+            keys.update(selected)
+        data = {key: value for key, value in data.items() if key in keys}
+    if visible_only:
+        data = {key: [item for item in value if not (isinstance(item, dict) and item.get('isVisible') is False)]
+                if isinstance(value, list) else value
+                for key, value in data.items()}
+    return data
+
+class DocumentViews:
+    """Field projections and visibility-filtered views of the published document.
+
+    A view is serialized and compressed the first time it is asked for and
+    kept on its DocumentSnapshot, so a write invalidates every view at once
+    and hot screens are then served precomputed bytes like the full
+    document. At most `limit` views are kept per version; rarer ones are
+    built per request.
+    """
+
+    def __init__(self, limit=MAX_DOCUMENT_VIEWS):
+        self.limit = limit
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.builds = 0
+        self.uncached = 0
+
+    def get(self, snapshot, view, strict=True):
+        """The snapshot of `view` (from parse_view) for a document version.
+
+        Raises ValueError for a field the document doesn't have, unless
+        `strict` is false (a parked long-poll whose field a later write removed).
+        """
+        if view is None:
+            return snapshot
+        cached = snapshot.views.get(view)
+        if cached is not None:
+            with self._lock:
+                self.hits += 1
+            return cached
+        cached = DocumentSnapshot(project_document(snapshot.data, *view, strict), snapshot.version)
+        with self._lock:
+            if view in snapshot.views:
+                # Another request built it first
+                self.hits += 1
+                return snapshot.views[view]
+            if len(snapshot.views) < self.limit:
+                snapshot.views[view] = cached
+                self.builds += 1
+            else:
+                self.uncached += 1
+        return cached
+
+    def stats(self, snapshot):
+        """Counters for every store's views; `cached` is the number kept for `snapshot`"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'builds': self.builds,
+                'uncached': self.uncached,
+                'limit': self.limit,
+                'cached': len(snapshot.views),
+            }
+
+def select_document(snapshot, view=None, media_type=None, strict=True):
+    """The representation of a version a request asked for: a view (parse_view) in a format (choose_format)"""
+    return document_views.get(snapshot, view, strict).in_format(media_type)
+
+def etag_matches(if_none_match, etag):
+    """True when an If-None-Match header value covers the given ETag"""
+    if not if_none_match or etag is None:
+        return False
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*' or candidate.removeprefix('W/') == etag:
+            return True
+    return False
+
+def sse_event(snapshot):
+    """Server-Sent Events frame carrying one document version"""
+    return b'id: %d\nevent: customizations\ndata: %s\n\n' % (snapshot.version, snapshot.body)
+
+def replication_event(base, snapshot):
+    """SSE frame bringing a replica that has version `base` up to `snapshot`.
+
+    The first data line is metadata (the version's ETag and when it was
+    sent); the second is the JSON Patch from `base` while the delta history
+    still has it, or else the whole document.
+    """
+    patch = delta_history.delta_since(base, snapshot.version) if base else None
+    meta = {'etag': snapshot.etag, 'sent': round(time.time(), 6)}
+    if patch is None:
+        kind, payload = b'snapshot', snapshot.body
+    else:
+        kind, payload = b'patch', patch
+        meta['base'] = base
+    return b'id: %d\nevent: %s\ndata: %s\ndata: %s\n\n' % (
+        snapshot.version, kind, json.dumps(meta, separators=(',', ':')).encode(), payload)
+
+def replica_base(headers):
+    """Version a connecting replica has (Last-Event-ID, vouched for by its ETag in If-None-Match), or 0"""
+    try:
+        version = int(headers.get('Last-Event-ID') or 0)
+    except ValueError:
+        return 0
+    snapshot = store.get_version(version)
+    if snapshot is None or not etag_matches(headers.get('If-None-Match'), snapshot.etag):
+        return 0
+    return version
+
+def long_poll_response(snapshot, accept_encoding):
+    """Complete HTTP response answering a parked ?wait= request"""
+    encoding, body, etag = snapshot.representation(accept_encoding)
+    headers = [
+        'HTTP/1.1 200 OK',
+        f'Content-type: {snapshot.content_type}',
+        f'Content-Length: {len(body)}',
+        f'ETag: {etag}',
+        f'X-Customization-Version: {snapshot.version}',
+        f'X-Poll-Interval: {poll_advisor.advise(count=False)}',
+        'Vary: Accept, Accept-Encoding',
+        'Access-Control-Allow-Origin: *',
+        'Access-Control-Expose-Headers: ETag, X-Customization-Version, X-Poll-Interval',
+        'Connection: close',
+    ]
+    if encoding:
+        headers.append(f'Content-Encoding: {encoding}')
+    return ('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1') + body
+
+def long_poll_timeout_response(snapshot):
+    """304 sent when a long-poll times out without a new version"""
+    return (
+        'HTTP/1.1 304 Not Modified\r\n'
+        f'ETag: {snapshot.etag}\r\n'
+        f'X-Customization-Version: {snapshot.version}\r\n'
+        f'X-Poll-Interval: {poll_advisor.advise(count=False)}\r\n'
+        'Access-Control-Allow-Origin: *\r\n'
+        'Access-Control-Expose-Headers: ETag, X-Customization-Version, X-Poll-Interval\r\n'
+        'Connection: close\r\n\r\n'
+    ).encode('latin-1')
+
+
+class _Subscriber:
+    """A parked connection waiting for document versions newer than `version`"""
+    __slots__ = ('sock', 'stream', 'version', 'pending', 'accept_encoding', 'view', 'media_type',
+                 'deadline', 'closing', 'last_write', 'events', 'replica')
+
+    def __init__(self, sock, stream, version, pending=b'', accept_encoding=None, view=None, media_type=None,
+                 deadline=None, replica=None):
+        self.sock = sock
+        self.stream = stream
+        self.version = version
+        # Name of the read replica on the other end of a replication stream (see replication_event)
+        self.replica = replica
+        self.pending = pending
+        self.accept_encoding = accept_encoding
+        self.view = view
+        self.media_type = media_type
+        self.deadline = deadline
+        self.closing = False
+        self.last_write = time.monotonic()
+        self.events = selectors.EVENT_READ
+
+
+class ChangeFeed:
+    """Fans new document versions out to SSE streams and long-poll requests.
+
+    Handlers hand their socket over with add_stream()/add_waiter() and return,
+    so an idle subscriber costs a registered file descriptor rather than a
+    thread. A single selector thread writes every new version to all of them.
+    """
+
+    def __init__(self, current_snapshot):
+        self._current_snapshot = current_snapshot
+        self._lock = threading.Lock()
+        self._incoming = []
+        self._changed = False
+        self._subscribers = {}
+        self._thread = None
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def add_stream(self, sock, version, initial=b'', replica=None):
+        """Park an SSE connection; `initial` is written before any new version.
+
+        With `replica` (its name) the stream carries replication_event frames.
+        """
+        self._hand_over(_Subscriber(sock, True, version, initial, replica=replica))
+
+    def replicas(self):
+        """(name, version sent) of each read replica streaming from this server"""
+        return sorted((subscriber.replica, subscriber.version) for subscriber in list(self._subscribers.values())
+                      if subscriber.replica is not None and not subscriber.closing)
+
+    def add_waiter(self, sock, version, accept_encoding=None, view=None, media_type=None,
+                   timeout=LONG_POLL_TIMEOUT):
+        """Park a long-poll until a version newer than `version` is published (see select_document)"""
+        self._hand_over(_Subscriber(sock, False, version, accept_encoding=accept_encoding, view=view,
+                                    media_type=media_type, deadline=time.monotonic() + timeout))
+
+    def notify_changed(self):
+        """Called after a new snapshot is published"""
+        with self._lock:
+            if self._thread is None:
+                return
+            self._changed = True
+        self._wake()
+
+    def _hand_over(self, subscriber):
+        subscriber.sock.setblocking(False)
+        with self._lock:
+            if self._thread is None:
+                self._start()
+            self._incoming.append(subscriber)
+        self._wake()
+
+    def _start(self):
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+        self._thread = threading.Thread(target=self._run, name='change-feed', daemon=True)
+        self._thread.start()
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b'\0')
+        except OSError:
+            pass  # a wake-up is already pending
+
+    def _run(self):
+        next_housekeeping = time.monotonic() + 1
+        while True:
+            for key, events in self._selector.select(timeout=1):
+                if key.fileobj is self._wake_r:
+                    try:
+                        while self._wake_r.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                subscriber = key.data
+                try:
+                    if events & selectors.EVENT_READ and not self._client_alive(subscriber):
+                        self._drop(subscriber)
+                    elif events & selectors.EVENT_WRITE:
+                        self._flush(subscriber)
+                except Exception as e:
+                    self._fail(subscriber, e)
+
+            with self._lock:
+                incoming, self._incoming = self._incoming, []
+                changed, self._changed = self._changed, False
+            snapshot = self._current_snapshot()
+            for subscriber in list(incoming):
+                try:
+                    self._selector.register(subscriber.sock, subscriber.events, subscriber)
+                    self._subscribers[subscriber.sock.fileno()] = subscriber
+                except Exception as e:
+                    incoming.remove(subscriber)
+                    self._fail(subscriber, e)
+            if changed:
+                self._deliver(list(self._subscribers.values()), snapshot)
+            elif incoming:
+                self._deliver(incoming, snapshot)
+
+            now = time.monotonic()
+            if now >= next_housekeeping:
+                self._housekeeping(now, snapshot)
+                next_housekeeping = now + 1
+
+    def _deliver(self, subscribers, snapshot):
+        event = None
+        responses = {}
+        frames = {}
+        for subscriber in subscribers:
+            if subscriber.closing:
+                continue
+            try:
+                if subscriber.version >= snapshot.version:
+                    if subscriber.pending:
+                        self._flush(subscriber)
+                    continue
+                base, subscriber.version = subscriber.version, snapshot.version
+                if subscriber.replica is not None:
+                    # Replicas are usually all at the same version, so they share one frame
+                    if base not in frames:
+                        frames[base] = replication_event(base, snapshot)
+                    subscriber.pending += frames[base]
+                elif subscriber.stream:
+                    if event is None:
+                        event = sse_event(snapshot)
+                    subscriber.pending += event
+                else:
+                    # Build each long-poll response once per view, format and content coding
+                    key = (subscriber.view, subscriber.media_type, subscriber.accept_encoding)
+                    if key not in responses:
+                        document = select_document(snapshot, subscriber.view, subscriber.media_type, strict=False)
+                        responses[key] = long_poll_response(document, subscriber.accept_encoding)
+                    subscriber.pending = responses[key]
+                    subscriber.closing = True
+                self._flush(subscriber)
+            except Exception as e:
+                self._fail(subscriber, e)
+
+    def _housekeeping(self, now, snapshot):
+        for subscriber in list(self._subscribers.values()):
+            if subscriber.closing:
+                continue
+            try:
+                if not subscriber.stream and now >= subscriber.deadline:
+                    subscriber.pending = long_poll_timeout_response(
+                        select_document(snapshot, subscriber.view, subscriber.media_type, strict=False))
+                    subscriber.closing = True
+                    self._flush(subscriber)
+                elif subscriber.stream and now - subscriber.last_write >= SSE_HEARTBEAT_INTERVAL:
+                    subscriber.pending += b': ping\n\n'
+                    self._flush(subscriber)
+            except Exception as e:
+                self._fail(subscriber, e)
+
+    def _client_alive(self, subscriber):
+        try:
+            return bool(subscriber.sock.recv(4096))  # anything the client sends is ignored
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+
+    def _flush(self, subscriber):
+        try:
+            while subscriber.pending:
+                sent = subscriber.sock.send(subscriber.pending)
+                subscriber.pending = subscriber.pending[sent:]
+                subscriber.last_write = time.monotonic()
+        except BlockingIOError:
+            pass
+        except OSError:
+            self._drop(subscriber)
+            return
+        if subscriber.pending:
+            if len(subscriber.pending) > MAX_SUBSCRIBER_BACKLOG:
+                self._drop(subscriber)
+                return
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE
+        elif subscriber.closing:
+            self._drop(subscriber)
+            return
+        else:
+            events = selectors.EVENT_READ
+        if events != subscriber.events:
+            subscriber.events = events
+            self._selector.modify(subscriber.sock, events, subscriber)
+
+    def _drop(self, subscriber):
+        if self._subscribers.pop(subscriber.sock.fileno(), None) is not None:
+            self._selector.unregister(subscriber.sock)
+        try:
+            subscriber.sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        subscriber.sock.close()
+
+    def _fail(self, subscriber, error):
+        """Drop a subscriber whose update couldn't be built or sent; the others are unaffected"""
+        print(f"❌ Error updating a change feed subscriber: {error!r}")
+        self._drop(subscriber)
+
+
+class VersionWaiters:
+    """Lets WSGI and ASGI requests wait for a version newer than the one they have.
+
+    The built-in server parks long-polls and SSE streams on the ChangeFeed
+    selector instead. Under WSGI each waiting request holds a server thread,
+    which blocks in wait(); under ASGI it awaits wait_async(), a future that
+    the store listener resolves on the request's event loop.
+    """
+
+    def __init__(self, current_snapshot):
+        self._current_snapshot = current_snapshot
+        self._cond = threading.Condition()
+        self._futures = []
+
+    def notify_changed(self):
+        with self._cond:
+            self._cond.notify_all()
+            futures, self._futures = self._futures, []
+        for loop, future in futures:
+            loop.call_soon_threadsafe(_resolve_waiter, future)
+
+    def wait(self, version, timeout):
+        """Block until a version other than `version` is current or `timeout` passes; returns the current snapshot"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                snapshot = self._current_snapshot()
+                remaining = deadline - time.monotonic()
+                if snapshot.version != version or remaining <= 0:
+                    return snapshot
+                self._cond.wait(remaining)
+
+    async def wait_async(self, version, timeout):
+        """wait() for an event loop"""
+        import asyncio
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._cond:
+            snapshot = self._current_snapshot()
+            if snapshot.version != version:
+                return snapshot
+            self._futures.append((loop, future))
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._cond:
+                if (loop, future) in self._futures:
+                    self._futures.remove((loop, future))
+        return self._current_snapshot()
+
+class PollAdvisor:
+    """Recommends how long a device should wait before its next poll (X-Poll-Interval).
+
+    Right after a write, while admins are editing a campaign, the advice is
+    min_interval. It then grows with the time since the last write,
+    reaching max_interval overnight. When the API request rate is above
+    budget the advice is stretched by the same ratio, and it is doubled for
+    a while after admission control sheds a request. Every answer is
+    jittered so devices that started together drift apart.
+    """
+
+    def __init__(self, min_interval=DEFAULT_POLL_MIN, max_interval=DEFAULT_POLL_MAX, budget=DEFAULT_POLL_BUDGET):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.budget = budget
+        self._last_write = time.monotonic()
+        self._second = int(time.monotonic())
+        self._count = 0
+        self._rate = 0.0
+        self._shed_seen = 0
+        self._backoff_until = 0.0
+        self._lock = threading.Lock()
+
+    def notify_changed(self):
+        self._last_write = time.monotonic()
+
+    def _roll(self, now):
+        """Once a second: take the request rate and check for shedding"""
+        with self._lock:
+            second = int(now)
+            if second == self._second:
+                return
+            self._rate = self._count / (second - self._second)
+            self._second, self._count = second, 0
+        shed = sum(admission.shed.values())
+        if shed != self._shed_seen:
+            self._shed_seen = shed
+            self._backoff_until = now + POLL_SHED_BACKOFF
+
+    def interval(self, now=None):
+        """Un-jittered advice in seconds"""
+        now = time.monotonic() if now is None else now
+        advice = max(self.min_interval, (now - self._last_write) * POLL_INTERVAL_FACTOR)
+        if self.budget and self._rate > self.budget:
+            advice *= self._rate / self.budget
+        if now < self._backoff_until:
+            advice *= 2
+        return min(advice, self.max_interval)
+
+    def advise(self, count=True):
+        """Jittered advice in whole seconds for one response; `count` it towards the request rate"""
+        now = time.monotonic()
+        if count:
+            # Under the lock _roll() takes and resets the count with, or increments get lost
+            with self._lock:
+                self._count += 1
+        if int(now) != self._second:
+            self._roll(now)
+        return max(1, round(self.interval(now) * random.uniform(1, 1 + POLL_JITTER)))
+
+    def stats(self):
+        now = time.monotonic()
+        return {'interval': round(self.interval(now), 1), 'seconds_since_write': round(now - self._last_write, 1),
+                'request_rate': self._rate, 'min': self.min_interval, 'max': self.max_interval,
+                'budget': self.budget}
+
+def _resolve_waiter(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class PatchError(ValueError):
+    """A PATCH that cannot be applied; `status` is the HTTP status to answer with"""
+
+    def __init__(self, message, status=422):
+        super().__init__(message)
+        self.status = status
+
+# Array items can be addressed by id instead of position, e.g. /collections/id=2/title
+ID_TOKEN_PREFIX = 'id='
+
+def _is_id_token(token):
+    return isinstance(token, str) and token.startswith(ID_TOKEN_PREFIX)
+
+def _find_by_id(items, token):
+    item_id = token[len(ID_TOKEN_PREFIX):]
+    for index, item in enumerate(items):
+        if isinstance(item, dict) and str(item.get('id')) == item_id:
+            return index
+    return None
+
+def new_item_id(items, item_id):
+    """The id for a new item addressed as `item_id` (a string from a path): an int when the array's ids are"""
+    for item in items:
+        if isinstance(item, dict) and 'id' in item:
+            existing = item['id']
+            if isinstance(existing, int) and not isinstance(existing, bool):
+                try:
+                    number = int(item_id)
+                except ValueError:
+                    number = None
+                # The id must read back the same, or the item could not be addressed by it again
+                if number is None or str(number) != item_id:
+                    raise PatchError(f'Item ids in this array are numbers, not {item_id!r}')
+                return number
+            break
+    return item_id
+
+def find_item(items, item_id, index, exact=False):
+    """Position of the item with `item_id` in `items`, or None, through an id index.
+
+    `index` (see DocumentSnapshot.index) may describe an older version of
+    the array, so a hit is checked and a miss falls back to a scan unless
+    the index is `exact`ly for `items`.
+    """
+    position = index.get(item_id)
+    if position is not None and position < len(items):
+        item = items[position]
+        if isinstance(item, dict) and str(item.get('id')) == item_id:
+            return position
+    if exact:
+        return None
+    return _find_by_id(items, ID_TOKEN_PREFIX + item_id)
+
+def apply_merge_patch(target, patch):
+    """RFC 7386 JSON Merge Patch, returning a new document.
+
+    Only the objects on the patched paths are copied; untouched subtrees are
+    shared with the previous version. As an extension, an object whose keys
+    are all `id=<id>` tokens patches items of an array by id (null removes
+    the item, an unknown id appends a new one).
+    """
+    if not isinstance(patch, dict):
+        return patch
+    if isinstance(target, list) and patch and all(_is_id_token(key) for key in patch):
+        return _merge_patch_items(target, patch)
+    result = dict(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = apply_merge_patch(result.get(key), value)
+    return result
+
+def _merge_patch_items(items, patch):
+    items = list(items)
+    removed = set()
+    for token, value in patch.items():
+        index = _find_by_id(items, token)
+        if value is None:
+            if index is not None:
+                removed.add(index)
+        elif index is None:
+            item = apply_merge_patch({}, value)
+            if isinstance(item, dict) and 'id' not in item:
+                item['id'] = new_item_id(items, token[len(ID_TOKEN_PREFIX):])
+            items.append(item)
+        else:
+            items[index] = apply_merge_patch(items[index], value)
+    return [item for index, item in enumerate(items) if index not in removed]
+
+def _parse_pointer(pointer):
+    """Split an RFC 6901 JSON Pointer into unescaped reference tokens"""
+    if not isinstance(pointer, str) or (pointer and not pointer.startswith('/')):
+        raise PatchError(f'Invalid JSON pointer: {pointer!r}', 400)
+    if pointer == '':
+        return []
+    return [token.replace('~1', '/').replace('~0', '~') for token in pointer[1:].split('/')]
+
+def _resolve_token(container, token, for_add=False):
+    """Key or index for `token` inside `container`"""
+    if isinstance(container, dict):
+        if not for_add and token not in container:
+            raise PatchError(f'Path not found: {token}')
+        return token
+    if isinstance(container, list):
+        if _is_id_token(token):
+            index = _find_by_id(container, token)
+            if index is None:
+                raise PatchError(f'No array item with {token}')
+            return index
+        if for_add and token == '-':
+            return len(container)
+        if not token.isdigit() or (len(token) > 1 and token.startswith('0')):
+            raise PatchError(f'Invalid array index: {token}')
+        index = int(token)
+        if index > len(container) or (not for_add and index == len(container)):
+            raise PatchError(f'Array index out of range: {token}')
+        return index
+    raise PatchError(f'Cannot address {token!r} inside a scalar value')
+
+class _CopyOnWriteDocument:
+    """Applies JSON Patch operations by copying only the containers on each path"""
+
+    def __init__(self, root):
+        self.root = root
+        self._owned = set()
+
+    def _own(self, container):
+        if id(container) in self._owned:
+            return container
+        owned = dict(container) if isinstance(container, dict) else list(container)
+        self._owned.add(id(owned))
+        return owned
+
+    def get(self, tokens):
+        node = self.root
+        for token in tokens:
+            node = node[_resolve_token(node, token)]
+        return node
+
+    def _parent(self, tokens):
+        """Writable parent container of the location `tokens` points at"""
+        if not isinstance(self.root, (dict, list)):
+            raise PatchError('Document root is not a container')
+        self.root = node = self._own(self.root)
+        for token in tokens[:-1]:
+            key = _resolve_token(node, token)
+            child = node[key]
+            if not isinstance(child, (dict, list)):
+                raise PatchError(f'Cannot address inside scalar at {token}')
+            node[key] = child = self._own(child)
+            node = child
+        return node
+
+    def add(self, tokens, value):
+        if not tokens:
+            self.root = value
+            return
+        parent = self._parent(tokens)
+        key = _resolve_token(parent, tokens[-1], for_add=True)
+        if isinstance(parent, list):
+            parent.insert(key, value)
+        else:
+            parent[key] = value
+
+    def remove(self, tokens):
+        if not tokens:
+            raise PatchError('Cannot remove the document root')
+        parent = self._parent(tokens)
+        key = _resolve_token(parent, tokens[-1])
+        value = parent[key]
+        del parent[key]
+        return value
+
+    def replace(self, tokens, value):
+        if not tokens:
+            self.root = value
+            return
+        parent = self._parent(tokens)
+        parent[_resolve_token(parent, tokens[-1])] = value
+
+def apply_json_patch(document, operations):
+    """RFC 6902 JSON Patch, returning a new document (the input is not modified)"""
+    if not isinstance(operations, list):
+        raise PatchError('A JSON Patch must be an array of operations', 400)
+    doc = _CopyOnWriteDocument(document)
+    for operation in operations:
+        if not isinstance(operation, dict) or 'op' not in operation or 'path' not in operation:
+            raise PatchError(f'Invalid patch operation: {operation!r}', 400)
+        op = operation['op']
+        path = _parse_pointer(operation['path'])
+        if op in ('add', 'replace', 'test') and 'value' not in operation:
+            raise PatchError(f'"{op}" needs a value', 400)
+        if op == 'add':
+            doc.add(path, operation['value'])
+        elif op == 'remove':
+            doc.remove(path)
+        elif op == 'replace':
+            doc.replace(path, operation['value'])
+        elif op in ('move', 'copy'):
+            source = _parse_pointer(operation.get('from'))
+            if op == 'move':
+                if path[:len(source)] == source and path != source:
+                    raise PatchError('Cannot move a value into one of its children')
+                value = doc.remove(source)
+            else:
+                # Copies must not share containers that later operations may modify
+                value = copy.deepcopy(doc.get(source))
+            doc.add(path, value)
+        elif op == 'test':
+            if not json_equal(doc.get(path), operation['value']):
+                raise PatchError(f'Test failed at {operation["path"]}', 409)
+        else:
+            raise PatchError(f'Unknown patch operation: {op}', 400)
+    return doc.root
+
+def json_equal(a, b):
+    """Equality of JSON values as RFC 6902 `test` defines it: like ==, except that true and false aren't numbers"""
+    if isinstance(a, bool) or isinstance(b, bool):
+        return type(a) is type(b) and a == b
+    if isinstance(a, dict):
+        return isinstance(b, dict) and a.keys() == b.keys() and all(json_equal(a[key], b[key]) for key in a)
+    if isinstance(a, list):
+        return isinstance(b, list) and len(a) == len(b) and all(map(json_equal, a, b))
+    return a == b
+
+def _escape_pointer_token(key):
+    return str(key).replace('~', '~0').replace('/', '~1')
+
+def diff_documents(old, new, pointer=''):
+    """JSON Patch operations turning `old` into `new`.
+
+    Subtrees shared between versions (see apply_merge_patch) are skipped by
+    identity, so diffing a small PATCH costs about the size of the change.
+    """
+    if old is new:
+        return []
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = []
+        for key, value in old.items():
+            path = f'{pointer}/{_escape_pointer_token(key)}'
+            if key not in new:
+                ops.append({'op': 'remove', 'path': path})
+            else:
+                ops += diff_documents(value, new[key], path)
+        for key, value in new.items():
+            if key not in old:
+                ops.append({'op': 'add', 'path': f'{pointer}/{_escape_pointer_token(key)}', 'value': value})
+        return ops
+    if isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        ops = []
+        for index, (a, b) in enumerate(zip(old, new)):
+            ops += diff_documents(a, b, f'{pointer}/{index}')
+        return ops
+    if isinstance(old, list) and isinstance(new, list):
+        # Items removed from or inserted into one place, the rest shared with the previous version
+        shortest = min(len(old), len(new))
+        prefix = 0
+        while prefix < shortest and old[prefix] is new[prefix]:
+            prefix += 1
+        suffix = 0
+        while suffix < shortest - prefix and old[-1 - suffix] is new[-1 - suffix]:
+            suffix += 1
+        if prefix + suffix == len(new):
+            return [{'op': 'remove', 'path': f'{pointer}/{prefix}'} for _ in range(len(old) - len(new))]
+        if prefix + suffix == len(old):
+            return [{'op': 'add', 'path': f'{pointer}/{index}', 'value': new[index]}
+                    for index in range(prefix, len(new) - suffix)]
+    if type(old) is type(new) and old == new:
+        return []
+    return [{'op': 'replace', 'path': pointer, 'value': new}]
+
+class DeltaHistory:
+    """Bounded ring of recent version diffs for ?since=<version> requests.
+
+    Each entry holds the JSON Patch between two consecutively published
+    versions. The ring is trimmed from the oldest end to stay within `depth`
+    entries and `max_bytes` of serialized patches; older bases get a full
+    snapshot instead.
+    """
+
+    def __init__(self, depth=DEFAULT_DELTA_DEPTH, max_bytes=DEFAULT_DELTA_MAX_BYTES):
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self._entries = collections.deque()  # (from_version, to_version, ops, size)
+        self._bytes = 0
+        self._cache = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, depth, max_bytes):
+        with self._lock:
+            self.depth = depth
+            self.max_bytes = max_bytes
+            self._trim()
+
+    def record(self, from_version, to_version, old_data, new_data):
+        """Remember the diff between two consecutively published versions"""
+        ops = diff_documents(old_data, new_data)
+        size = len(json.dumps(ops, separators=(',', ':')))
+        with self._lock:
+            if self._entries and self._entries[-1][1] != from_version:
+                # A gap means the history can no longer be chained
+                self._entries.clear()
+                self._bytes = 0
+            self._entries.append((from_version, to_version, ops, size))
+            self._bytes += size
+            self._cache.clear()
+            self._trim()
+
+    def _trim(self):
+        while self._entries and (len(self._entries) > self.depth or self._bytes > self.max_bytes):
+            self._bytes -= self._entries.popleft()[3]
+
+    def delta_since(self, since, current_version):
+        """Serialized JSON Patch from `since` to `current_version`, or None if it aged out"""
+        with self._lock:
+            key = (since, current_version)
+            if key in self._cache:
+                self.hits += 1
+                return self._cache[key]
+            start = next((i for i, entry in enumerate(self._entries) if entry[0] == since), None)
+            if start is None or self._entries[-1][1] != current_version:
+                self.misses += 1
+                return None
+            ops = []
+            for index, entry in enumerate(self._entries):
+                if index >= start:
+                    ops += entry[2]
+            body = json.dumps(ops, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+            self._cache[key] = body
+            self.hits += 1
+            return body
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'depth': self.depth,
+                'max_bytes': self.max_bytes,
+                'oldest_version': self._entries[0][0] if self._entries else None,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+def _fsync_directory(path):
+    """Make a rename inside `path`'s directory durable (a no-op where unsupported)"""
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
     try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+class Histogram:
+    """Bucketed durations for /metrics, for events too rare to need per-thread counters"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self._counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            self._sum += seconds
+
+    def snapshot(self):
+        """(per-bucket counts with +Inf last, sum of observations)"""
+        with self._lock:
+            return list(self._counts), self._sum
+
+class LogInUseError(RuntimeError):
+    """The write-ahead log is already open in another process"""
+
+class CustomizationLog:
+    """Crash-safe, append-only write-ahead log for the customization document.
+
+    Every line is `<crc32> <json record>`: a `checkpoint` record with the
+    full document starts the file, followed by `set` (full document) and
+    `patch` (JSON Patch) records, one per accepted write. Writers append in
+    memory and then call sync(); whoever gets there first writes and fsyncs
+    everything buffered so far, so a burst of writers shares one fsync
+    (group commit). A background thread compacts the log into a new
+    checkpoint and refreshes customization_data.json as a plain export;
+    with `compactor=False` the owner calls compact() when compact_due()
+    says so instead (TenantStores does, for many logs from one thread).
+    While open, the log holds an exclusive flock() on `<path>.lock`, so a
+    second process (another gunicorn or uvicorn worker) fails to open it
+    instead of interleaving its records; worker processes of --processes
+    share() it instead.
+    """
+
+    def __init__(self, path=WAL_PATH, compact_bytes=DEFAULT_WAL_COMPACT_BYTES, commit_delay=0.0,
+                 export_path='customization_data.json', compactor=True):
+        self.path = path
+        self.export_path = export_path
+        self.compact_bytes = compact_bytes
+        self.commit_delay = commit_delay
+        self.compactor = compactor
+        self._cond = threading.Condition()
+        self._file = None
+        self._buffer = []
+        self._flushing = False
+        self._size = 0
+        self._appended = None        # (version, data) of the newest record
+        self._durable_version = 0
+        self._durable = None         # (data, version) of the newest record on disk
+        self.failed = None           # the error of a failed write; appends are refused until a compaction succeeds
+        self.failures = 0
+        self._records_since_checkpoint = 0
+        self._last_append = 0.0
+        self._carry = None           # lines flushed to the old file while compacting
+        self._wake_compactor = threading.Event()
+        self._compactor_thread = None
+        self._lock_fd = None
+        self.shared = None           # SharedSnapshot when several worker processes write
+        self.exported = None         # document of the newest export, so a file watcher can tell it apart
+        self.export_lock = threading.Lock()  # held while exporting, and by the watcher while it compares
+        self.syncs = 0
+        self.sync_seconds = Histogram(PERSISTENCE_BUCKETS)
+        self.compact_seconds = Histogram(PERSISTENCE_BUCKETS)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    @property
+    def is_open(self):
+        return self._file is not None
+
+    @staticmethod
+    def _encode(record):
+        payload = json.dumps(record, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+        return b'%08x %s\n' % (zlib.crc32(payload), payload)
+
+    def recover(self):
+        """Replay the log; returns (data, version, records replayed).
+
+        A torn or corrupt tail (a crash mid-append) is cut off at the last
+        intact record, so recovery always ends in the same state.
+        """
+        self._take_lock()
+        try:
+            os.remove(self.path + '.tmp')  # an unfinished compaction; the log itself is intact
+        except FileNotFoundError:
+            pass
+        data, version, replayed, good_bytes, checkpoint = None, 0, 0, 0, None
+        with open(self.path, 'rb') as f:
+            for line in f:
+                record = self._decode(line)
+                if record is None:
+                    break
+                good_bytes += len(line)
+                if 'checkpoint' in record:
+                    data, version = record['checkpoint'], record['v']
+                    checkpoint = data
+                elif data is None:
+                    break  # records without a checkpoint before them can't be applied
+                elif record['v'] > version:
+                    data = record['set'] if 'set' in record else apply_json_patch(data, record['patch'])
+                    version = record['v']
+                    replayed += 1
+        if data is None:
+            raise ValueError(f'{self.path} has no checkpoint record')
+        if good_bytes != os.path.getsize(self.path):
+            print(f"⚠️ Discarding torn tail of {self.path} after byte {good_bytes}")
+            with open(self.path, 'r+b') as f:
+                f.truncate(good_bytes)
+                os.fsync(f.fileno())
+        if self.export_path:
+            # Compactions export their checkpoint, so this is what the file held when the server stopped
+            self.exported = checkpoint
+        self._open(data, version, good_bytes, replayed)
+        return data, version, replayed
+
+    def _decode(self, line):
+        if not line.endswith(b'\n'):
+            return None
+        crc, _, payload = line[:-1].partition(b' ')
+        try:
+            if int(crc, 16) != zlib.crc32(payload):
+                return None
+            return json.loads(payload)
+        except ValueError:
+            return None
+
+    def start(self, data, version):
+        """Begin a new log whose checkpoint is (data, version)"""
+        self._take_lock()
+        self._write_checkpoint(self.path, data, version, [])
+        self._open(data, version, os.path.getsize(self.path), 0)
+
+    def restart(self, data, version):
+        """Replace the log with a checkpoint of (data, version), even one older than its newest record"""
+        self.close()
+        self._take_lock()
+        tmp_path = self.path + '.tmp'
+        self._write_checkpoint(tmp_path, data, version, [])
+        os.replace(tmp_path, self.path)
+        _fsync_directory(self.path)
+        self._open(data, version, os.path.getsize(self.path), 0)
+
+    def _take_lock(self):
+        """Lock the log for this process until close(); LogInUseError if another process has it"""
+        if fcntl is None or self._lock_fd is not None:
+            return
+        fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            raise LogInUseError(f'{self.path} is already in use by another process: run a single '
+                                f'WSGI/ASGI worker, or web_server.py --processes N for more') from None
+        self._lock_fd = fd
+
+    def _open(self, data, version, size, records):
+        self._file = open(self.path, 'ab')
+        self._size = size
+        self._appended = (version, data)
+        self._durable_version = version
+        self._durable = (data, version)
+        self.failed = None
+        self._records_since_checkpoint = records
+        if self.compactor and self._compactor_thread is None:
+            self._compactor_thread = threading.Thread(target=self._compactor, name='wal-compactor', daemon=True)
+            self._compactor_thread.start()
+
+    def close(self):
+        """Stop the compactor and close the log (the supervisor does this before forking workers)"""
+        with self._cond:
+            f, self._file = self._file, None
+        self._wake_compactor.set()
+        if self._compactor_thread is not None:
+            self._compactor_thread.join()
+            self._compactor_thread = None
+        if f is not None:
+            f.close()
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def share(self, shared):
+        """Reopen the log in a worker process, coordinating with the other workers through `shared`.
+
+        Writers then hold the shared lock until their record is durable, and
+        compaction checkpoints the shared document under the same lock.
+        """
+        self.shared = shared
+        self._file = open(self.path, 'ab')
+        self._size = os.fstat(self._file.fileno()).st_size
+        version, body = shared.read()
+        self._appended = (version, json.loads(body))
+        self._durable_version = version
+        self._durable = (self._appended[1], version)
+        self._records_since_checkpoint = 0
+        self._compactor_thread = threading.Thread(target=self._compactor, name='wal-compactor', daemon=True)
+        self._compactor_thread.start()
+
+    def _reopen_if_replaced(self):
+        """Follow a compaction done by another worker process (the log file was renamed over)"""
+        try:
+            replaced = os.stat(self.path).st_ino != os.fstat(self._file.fileno()).st_ino
+        except FileNotFoundError:
+            replaced = False
+        if replaced:
+            self._file.close()
+            self._file = open(self.path, 'ab')
+        self._size = os.fstat(self._file.fileno()).st_size
+
+    def append(self, version, data, ops=None):
+        """Buffer the record producing `version`; callers append in version order"""
+        if self.shared is not None:
+            self._reopen_if_replaced()
+        record = {'v': version, 'set': data} if ops is None else {'v': version, 'patch': ops}
+        line = self._encode(record)
+        with self._cond:
+            if self.failed is not None:
+                raise OSError(f'{self.path} is not accepting writes after a failed write: {self.failed}')
+            self._buffer.append(line)
+            self._appended = (version, data)
+            self._records_since_checkpoint += 1
+            self._last_append = time.monotonic()
+
+    def sync(self, version):
+        """Block until the record for `version` is on disk"""
+        with self._cond:
+            while self._durable_version < version:
+                if self.failed is not None:
+                    raise OSError(f'Writing {self.path} failed: {self.failed}')
+                if self._flushing:
+                    self._cond.wait()
+                    continue
+                self._flushing = True
+                if self.commit_delay:
+                    # Let more writers join this commit
+                    self._cond.wait(self.commit_delay)
+                batch, self._buffer = self._buffer, []
+                batch_version, batch_data = self._appended
+                f = self._file
+                self._cond.release()
+                started = time.perf_counter()
+                try:
+                    f.write(b''.join(batch))
+                    f.flush()
+                    os.fsync(f.fileno())
+                    self.sync_seconds.observe(time.perf_counter() - started)
+                except BaseException as e:
+                    self._cond.acquire()
+                    self._fail(f, e)
+                    raise
+                self._cond.acquire()
+                self._flushing = False
+                self._durable_version = batch_version
+                self._durable = (batch_data, batch_version)
+                self._size += sum(len(line) for line in batch)
+                self.syncs += 1
+                if self._carry is not None:
+                    self._carry += batch
+                self._cond.notify_all()
+        self._wake_compactor.set()
+
+    def _fail(self, f, error):
+        """A batch didn't reach the disk (with _cond held): none of the records after the durable one ever will.
+
+        Later records were encoded against the failed ones, so they are
+        dropped too and their writers fail; a partly written batch is cut
+        off so nothing can be appended behind a torn line. Appends are
+        refused until the compactor has rewritten the log from the durable
+        document, and the store's next write starts over from that document
+        (see `failures`).
+        """
+        self.failed = error
+        self.failures += 1
+        self._buffer = []
+        self._appended = (self._durable[1], self._durable[0])
+        try:
+            f.truncate(self._size)
+        except (OSError, ValueError):
+            pass  # the compaction that clears the failure replaces the file anyway
+        self._flushing = False
+        self._cond.notify_all()
+        self._wake_compactor.set()
+        print(f"❌ Writing {self.path} failed, writes are refused until it is rewritten: {error}")
+
+    @property
+    def durable(self):
+        """(data, version) of the newest record on disk"""
+        with self._cond:
+            return self._durable
+
+    def compact_due(self):
+        """Seconds until the log should be compacted: 0 for now, None while there is nothing to compact"""
+        with self._cond:
+            if self._file is None or not (self._records_since_checkpoint or self.failed):
+                return None
+            if self._size >= self.compact_bytes or self.failed is not None:
+                return 0
+            return max(0, WAL_COMPACT_IDLE_SECONDS - (time.monotonic() - self._last_append))
+
+    def _compactor(self):
+        while True:
+            self._wake_compactor.clear()
+            with self._cond:
+                if self._file is None:
+                    return
+            due = self.compact_due()
+            if due == 0:
+                started = time.perf_counter()
+                try:
+                    self.compact()
+                    self.compact_seconds.observe(time.perf_counter() - started)
+                except OSError as e:
+                    print(f"❌ Log compaction failed: {e}")
+                    self._wake_compactor.wait(WAL_COMPACT_IDLE_SECONDS)
+                continue
+            self._wake_compactor.wait(due)
+
+    def compact(self):
+        """Replace the log with a checkpoint of the newest state, without blocking writers"""
+        if self.shared is not None:
+            self._compact_shared()
+            return
+        with self._cond:
+            # Records that aren't durable yet may still fail; they follow the checkpoint instead
+            data, version = self._durable
+            self._carry = []
+        tmp_path = self.path + '.tmp'
+        try:
+            self._write_checkpoint(tmp_path, data, version, [])
+            with self._cond:
+                while self._flushing:
+                    self._cond.wait()
+                # Records flushed to the old file after the checkpoint was taken move over;
+                # records still buffered will be flushed straight into the new file
+                carried = [line for line in self._carry if self._decode(line)['v'] > version]
+                with open(tmp_path, 'ab') as f:
+                    f.write(b''.join(carried))
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+                _fsync_directory(self.path)
+                self._file.close()
+                self._file = open(self.path, 'ab')
+                self._size = os.path.getsize(self.path)
+                self._records_since_checkpoint = len(carried) + len(self._buffer)
+                # Whatever a failed write left behind is gone with the old file
+                self.failed = None
+        finally:
+            with self._cond:
+                self._carry = None
+        if self.export_path:
+            with self.export_lock:
+                self.exported = data
+                save_customization_data(data, self.export_path)
+
+    def _compact_shared(self):
+        """compact() for worker processes: writers hold the shared lock until they are durable,
+        so under it the shared document is the newest state and nothing needs carrying over"""
+        with self.shared.lock():
+            version, body = self.shared.read()
+            data = json.loads(body)
+            tmp_path = self.path + '.tmp'
+            self._write_checkpoint(tmp_path, data, version, [])
+            os.replace(tmp_path, self.path)
+            _fsync_directory(self.path)
+            with self._cond:
+                self._file.close()
+                self._file = open(self.path, 'ab')
+                self._size = os.path.getsize(self.path)
+                self._records_since_checkpoint = 0
+                self._durable = (data, version)
+                self.failed = None
+            if self.export_path:
+                with self.export_lock:
+                    self.exported = data
+                    save_customization_data(data, self.export_path)
+
+    def _write_checkpoint(self, path, data, version, lines):
+        with open(path, 'wb') as f:
+            f.write(self._encode({'v': version, 'checkpoint': data}))
+            f.write(b''.join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+        _fsync_directory(path)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'bytes': self._size,
+                'records_since_checkpoint': self._records_since_checkpoint,
+                'durable_version': self._durable_version,
+                'failed': None if self.failed is None else str(self.failed),
+                'syncs': self.syncs,
+            }
+
+def save_customization_data(data, path='customization_data.json'):
+    """Export the document; the temp file + rename means a crash never leaves a torn file"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class SharedSnapshot:
+    """The current serialized document in a memory-mapped file shared by worker processes.
+
+    A 32-byte header (magic, sequence, version, length) is followed by the
+    compact JSON body. Writers hold lock(), make the sequence odd, write the
+    body, then publish the header with the next even sequence; readers copy
+    the body and retry unless the sequence was the same even number before
+    and after (a seqlock), so they never pick up a torn document. The file
+    only grows, and readers remap when the body outgrows their mapping.
+    """
+    MAGIC = b'GOEYESHM'
+    HEADER = struct.Struct('<8sQQQ')
+
+    def __init__(self, path=SHARED_SNAPSHOT_PATH):
+        self.path = path
+        self._fd = None
+        self._map = None
+        # flock() excludes other processes only; threads of one process also need this
+        self._lock = threading.Lock()
+
+    def create(self, version, body):
+        """Start a new shared file holding (version, body)"""
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.ftruncate(self._fd, mmap.PAGESIZE)
+        self._remap()
+        self._map[:self.HEADER.size] = self.HEADER.pack(self.MAGIC, 0, 0, 0)
+        with self.lock():
+            self.publish(version, body)
+
+    def attach(self):
+        """Open the file again in a forked worker: flock() locks belong to an open file, so
+        each worker needs its own for the lock to exclude the others"""
+        if self._fd is not None:
+            os.close(self._fd)
+        self._fd = os.open(self.path, os.O_RDWR)
+        self._lock = threading.Lock()
+        self._remap()
+        if self._map[:len(self.MAGIC)] != self.MAGIC:
+            raise ValueError(f'{self.path} is not a shared customization snapshot')
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self._map = None
+
+    def _remap(self):
+        self._map = mmap.mmap(self._fd, os.fstat(self._fd).st_size)
+
+    @contextlib.contextmanager
+    def lock(self):
+        """Exclusive across threads and worker processes; held by writers until they are durable"""
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def version(self):
+        """Newest published version: one read of the header, cheap enough for every request"""
+        return self.HEADER.unpack_from(self._map)[2]
+
+    def read(self):
+        """(version, body) of the newest published document"""
+        while True:
+            mm = self._map
+            _, sequence, version, length = self.HEADER.unpack_from(mm)
+            end = self.HEADER.size + length
+            if sequence & 1:
+                time.sleep(0)
+                continue
+            if end > len(mm):
+                self._remap()
+                continue
+            body = mm[self.HEADER.size:end]
+            if self.HEADER.unpack_from(mm)[1] == sequence:
+                return version, body
+
+    def publish(self, version, body):
+        """Make (version, body) current for every worker; the caller holds lock()"""
+        end = self.HEADER.size + len(body)
+        if end > len(self._map):
+            size = max(end, 2 * len(self._map))
+            os.ftruncate(self._fd, -(-size // mmap.PAGESIZE) * mmap.PAGESIZE)
+            self._remap()
+        mm = self._map
+        _, sequence, old_version, old_length = self.HEADER.unpack_from(mm)
+        mm[:self.HEADER.size] = self.HEADER.pack(self.MAGIC, sequence + 1, old_version, old_length)
+        mm[self.HEADER.size:end] = body
+        mm[:self.HEADER.size] = self.HEADER.pack(self.MAGIC, sequence + 2, version, len(body))
+
+class CustomizationStore:
+    """Versioned, copy-on-write home of the customization document.
+
+    Every write publishes a new immutable DocumentSnapshot with a higher
+    version number. Readers take `store.snapshot` (one attribute read, no
+    lock) and use that reference for the whole request, so they never see a
+    half-applied update. Writers are serialized. Documents share structure
+    between versions, so they must never be modified in place; derive a new
+    one with apply_merge_patch/apply_json_patch instead. The last
+    `history_depth` snapshots are kept for rollback.
+    """
+
+    def __init__(self, log=None, deltas=None, history_depth=DEFAULT_HISTORY_DEPTH):
+        self.snapshot = DocumentSnapshot({})
+        self.log = log
+        self.deltas = deltas
+        self._history = collections.deque(maxlen=history_depth)
+        # Newest accepted (data, version); runs ahead of the snapshot while its log record syncs
+        self._head = ({}, 0)
+        # Serializes writers so version numbers are handed out in order
+        self._write_lock = threading.Lock()
+        # Serializes snapshot installs so versions are only ever published in increasing order
+        self._publish_lock = threading.Lock()
+        self._listeners = []
+        # SharedSnapshot when the document is shared between worker processes (--processes)
+        self.shared = None
+        # CustomizationLog.failures already accounted for in _head
+        self._log_failures = 0
+
+    def add_listener(self, callback):
+        """Call `callback()` after every newly published version"""
+        self._listeners.append(callback)
+
+    def set_history_depth(self, depth):
+        with self._publish_lock:
+            self._history = collections.deque(self._history, maxlen=depth)
+
+    def history(self):
+        """Retained snapshots, oldest first"""
+        return list(self._history)
+
+    def get_version(self, version):
+        """The retained snapshot for `version`, or None if it has aged out"""
+        for snapshot in self.history():
+            if snapshot.version == version:
+                return snapshot
+        return None
+
+    def _publish(self, data, version, body=None, rewind=False):
+        """Install `version` as the current snapshot unless a newer one already is (or `rewind`)"""
+        with self._publish_lock:
+            previous = self.snapshot
+            if version <= previous.version and not rewind:
+                # A later write finished first; its snapshot already includes this one
+                return previous
+            snapshot = DocumentSnapshot(data, version, body)
+            for section, index in previous.indexes.items():
+                # An array the write didn't touch keeps its id index
+                if data.get(section) is previous.data.get(section):
+                    snapshot.indexes[section] = index
+            if previous.version and self.deltas is not None and version > previous.version:
+                self.deltas.record(previous.version, version, previous.data, data)
+            self._history.append(snapshot)
+            self.snapshot = snapshot
+        for callback in self._listeners:
+            callback()
+        return snapshot
+
+    def replace(self, data, persist=False):
+        """Replace the whole document"""
+        return self.update(lambda current: data, persist=persist, replace=True)
+
+    def update(self, change, if_match=None, persist=True, replace=False):
+        """Atomically derive a new version from the current one with change(data).
+
+        Concurrent writers are serialized, so no update is lost. With
+        `persist` the write is logged and only published once it is durable;
+        writers that arrive together share one fsync. When `if_match` is
+        given and does not name the current version, nothing is written and
+        a 412 PatchError is raised.
+        """
+        if self.shared is None:
+            return self._update(change, if_match, persist, replace)
+        # Another worker process may have written since; base the change on the
+        # newest version and keep the lock until this one is published to all
+        with self.shared.lock():
+            self.follow_shared()
+            snapshot = self._update(change, if_match, persist, replace)
+            self.shared.publish(snapshot.version, snapshot.body)
+        return snapshot
+
+    def _after_log_failure(self):
+        """With the write lock held: drop versions a failed log write lost, so nothing builds on them"""
+        if self.log is None or self.log.failures == self._log_failures:
+            return
+        self._log_failures = self.log.failures
+        # None of them was published; under --processes the snapshot is the newest durable version
+        self._head = self.log.durable if self.shared is None else (self.snapshot.data, self.snapshot.version)
+
+    def _update(self, change, if_match, persist, replace):
+        with self._write_lock:
+            self._after_log_failure()
+            current, version = self._head
+            snapshot = self.snapshot
+            if if_match is not None and (snapshot.version != version or not snapshot.matches(if_match)):
+                raise PatchError('Document has changed (If-Match failed)', 412)
+            data = change(current)
+            if not isinstance(data, dict):
+                raise PatchError('The customization document must stay a JSON object')
+            version += 1
+            logged = persist and self.log is not None and self.log.is_open
+            if logged:
+                self.log.append(version, data, None if replace else diff_documents(current, data))
+            self._head = (data, version)
+        if logged:
+            self.log.sync(version)
+        return self._publish(data, version)
+
+    def rollback(self, version):
+        """Publish the content of a retained earlier version as a new version"""
+        target = self.get_version(version)
+        if target is None:
+            raise PatchError(f'Version {version} is not in the history', 404)
+        return self.replace(target.data, persist=True)
+
+    def replicate(self, data, version, ops=None, body=None):
+        """Install `version` exactly as a primary sent it (see Replicator); `ops` is the JSON Patch applied.
+
+        The version number is the primary's, so it can skip ahead. One not
+        newer than ours means this copy diverged (a primary restored from an
+        older state, or a data directory that didn't come from it): the log
+        restarts from the primary's document and the version goes back.
+        """
+        with self._write_lock:
+            self._after_log_failure()
+            rewind = version <= self._head[1]
+            logged = self.log is not None and self.log.is_open
+            if logged and not rewind:
+                self.log.append(version, data, ops)
+            self._head = (data, version)
+        if logged:
+            if rewind:
+                self.log.restart(data, version)
+            else:
+                self.log.sync(version)
+        return self._publish(data, version, body, rewind=rewind)
+
+    def follow_shared(self):
+        """Install a newer version published by another worker process, if there is one"""
+        if self.shared is None or self.shared.version() <= self.snapshot.version:
+            return
+        version, body = self.shared.read()
+        data = json.loads(body)
+        with self._write_lock:
+            if version > self._head[1]:
+                self._head = (data, version)
+        self._publish(data, version, body)
+
+    def install_recovered(self, data, version):
+        """Make a document restored from the log current, keeping its version"""
+        with self._write_lock:
+            self._head = (data, version)
+        self._publish(data, version)
+
+    def recover_from_log(self):
+        """Replay the write-ahead log if there is one; True when the document was restored"""
+        if self.log is None:
+            return False
+        if self.log.is_open:
+            return True
+        if not self.log.exists():
+            return False
+        data, version, replayed = self.log.recover()
+        self.install_recovered(data, version)
+        print(f"📂 Recovered customization data from log: version {version} ({replayed} writes replayed)")
+        return True
+
+    def start_log(self):
+        """Begin the write-ahead log from the document loaded from JSON"""
+        if self.log is not None and not self.log.is_open:
+            data, version = self._head
+            self.log.start(data, version)
+
+delta_history = DeltaHistory()
+document_views = DocumentViews()
+storage = CustomizationLog()
+store = CustomizationStore(storage, delta_history)
+change_feed = ChangeFeed(lambda: store.snapshot)
+store.add_listener(change_feed.notify_changed)
+version_waiters = VersionWaiters(lambda: store.snapshot)
+store.add_listener(version_waiters.notify_changed)
+poll_advisor = PollAdvisor()
+store.add_listener(poll_advisor.notify_changed)
+
+class _Tenant:
+    """A tenant's slot in TenantStores; `store` is None while its document is only on disk"""
+    __slots__ = ('name', 'lock', 'store', 'users', 'last_used', 'bytes')
+
+    def __init__(self, name):
+        self.name = name
+        # Held while the store is loaded or unloaded, never while it serves requests
+        self.lock = threading.Lock()
+        self.store = None
+        self.users = 0
+        self.last_used = time.monotonic()
+        self.bytes = 0
+
+class TenantStores:
+    """Per-tenant CustomizationStores, loaded on first use and unloaded when idle or over budget.
+
+    Each tenant has a directory under `root` with its own write-ahead log
+    and customization_data.json export, and its own versions, ETags, encoded
+    bodies and delta ring. Nothing is read at startup, so a tenant only costs
+    memory while it is resident. Requests pin their tenant (open()) so it is
+    never unloaded under them; loading takes only that tenant's lock and a
+    write only that tenant's store locks, so tenants never wait on each
+    other. One reaper thread compacts the resident tenants' logs, unloads
+    tenants idle for `idle_seconds`, then the least recently used until the
+    resident documents fit in `budget_bytes`.
+    """
+
+    def __init__(self, root=DEFAULT_TENANT_ROOT, budget_bytes=DEFAULT_TENANT_BUDGET_BYTES,
+                 idle_seconds=DEFAULT_TENANT_IDLE_SECONDS):
+        self.root = root
+        self.budget_bytes = budget_bytes
+        self.idle_seconds = idle_seconds
+        # Off with --processes, where every worker would open the same logs
+        self.enabled = True
+        self._tenants = collections.OrderedDict()  # name -> _Tenant, least recently used first
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._wake = threading.Event()
+        self._reaper = None
+        self.loads = 0
+        self.created = 0
+        self.evictions = {'idle': 0, 'budget': 0}
+
+    @contextlib.contextmanager
+    def open(self, name, create=False):
+        """Pin tenant `name` and yield its store, loaded if need be; None when it doesn't exist (unless `create`)"""
+        with self._lock:
+            tenant = self._tenants.get(name)
+            if tenant is None:
+                tenant = self._tenants[name] = _Tenant(name)
+            else:
+                self._tenants.move_to_end(name)
+            tenant.users += 1
+        try:
+            if tenant.store is None:
+                with tenant.lock:
+                    if tenant.store is None:
+                        self._load(tenant, create)
+            yield tenant.store
+        finally:
+            if tenant.store is not None:
+                # Views and other formats are built by requests, after the version was published
+                self._resize(tenant, tenant.store)
+            with self._lock:
+                tenant.users -= 1
+                tenant.last_used = time.monotonic()
+                self._forget(tenant)
+                over_budget = self._bytes > self.budget_bytes
+            if over_budget:
+                self._wake.set()
+
+    def _forget(self, tenant):
+        """Drop the slot of a tenant that is neither resident nor in use (the caller holds _lock)"""
+        if tenant.store is None and not tenant.users and self._tenants.get(tenant.name) is tenant:
+            del self._tenants[tenant.name]
+
+    def _load(self, tenant, create):
+        """Read a tenant's document from disk, or start an empty one with `create` (the caller holds tenant.lock)"""
+        directory = os.path.join(self.root, tenant.name)
+        log = CustomizationLog(os.path.join(directory, WAL_PATH),
+                               export_path=os.path.join(directory, 'customization_data.json'), compactor=False)
+        tenant_store = CustomizationStore(log, DeltaHistory(TENANT_DELTA_DEPTH, TENANT_DELTA_MAX_BYTES),
+                                          history_depth=1)
+        created = False
+        if log.exists():
+            data, version, _ = log.recover()
+            tenant_store.install_recovered(data, version)
+        elif os.path.exists(log.export_path):
+            # A tenant seeded by copying in a customization_data.json
+            with open(log.export_path, 'r') as f:
+                tenant_store.replace(json.load(f))
+            tenant_store.start_log()
+        elif create:
+            os.makedirs(directory, exist_ok=True)
+            tenant_store.start_log()
+            created = True
+        else:
+            return
+        tenant_store.add_listener(lambda: self._resize(tenant, tenant_store))
+        with self._lock:
+            tenant.store = tenant_store
+            self.loads += 1
+            self.created += created
+            if self._reaper is None:
+                self._reaper = threading.Thread(target=self._reap, name='tenant-reaper', daemon=True)
+                self._reaper.start()
+        self._resize(tenant, tenant_store)
+
+    def _resize(self, tenant, tenant_store):
+        """Re-estimate a resident tenant's memory after it publishes a version or serves a request"""
+        snapshot = tenant_store.snapshot
+        size = (TENANT_PARSED_FACTOR * len(snapshot.body) + snapshot.cached_bytes()
+                + tenant_store.deltas.stats()['bytes'] + TENANT_OVERHEAD_BYTES)
+        with self._lock:
+            if tenant.store is tenant_store:
+                self._bytes += size - tenant.bytes
+                tenant.bytes = size
+
+    def _unload(self, tenant):
+        """Compact a tenant's log to a checkpoint and drop its store; False while it is in use or loading"""
+        with self._lock:
+            if tenant.users or tenant.store is None or not tenant.lock.acquire(blocking=False):
+                return False
+            tenant_store, tenant.store = tenant.store, None
+            self._bytes -= tenant.bytes
+            tenant.bytes = 0
+        # A request arriving now waits on tenant.lock and loads the tenant again once its log is closed
+        try:
+            if tenant_store.log.compact_due() is not None:
+                tenant_store.log.compact()
+        except OSError as e:
+            print(f"❌ Log compaction failed for tenant {tenant.name}: {e}")
+        finally:
+            tenant_store.log.close()
+            tenant.lock.release()
+        with self._lock:
+            self._forget(tenant)
+        return True
+
+    def _reap(self):
+        while True:
+            self._wake.wait(TENANT_REAP_INTERVAL)
+            self._wake.clear()
+            try:
+                self.reap()
+            except Exception as e:
+                print(f"❌ Error unloading tenants: {e}")
+
+    def reap(self):
+        """Compact resident tenants' logs that are due, unload idle tenants, then LRU ones past the budget"""
+        now = time.monotonic()
+        with self._lock:
+            resident = [tenant for tenant in self._tenants.values() if tenant.store is not None]
+        for tenant in resident:
+            tenant_store = tenant.store
+            if tenant_store is None:
+                continue
+            if now - tenant.last_used >= self.idle_seconds:
+                if self._unload(tenant):
+                    self.evictions['idle'] += 1
+            elif tenant_store.log.compact_due() == 0:
+                try:
+                    tenant_store.log.compact()
+                except OSError as e:
+                    print(f"❌ Log compaction failed for tenant {tenant.name}: {e}")
+        for tenant in resident:
+            if self._bytes <= self.budget_bytes:
+                break
+            if self._unload(tenant):
+                self.evictions['budget'] += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'resident': sum(1 for tenant in self._tenants.values() if tenant.store is not None),
+                'resident_bytes': self._bytes,
+                'budget_bytes': self.budget_bytes,
+                'views': sum(len(tenant.store.snapshot.views) for tenant in self._tenants.values()
+                             if tenant.store is not None),
+                'idle_seconds': self.idle_seconds,
+                'loads': self.loads,
+                'created': self.created,
+                'evictions': dict(self.evictions),
+            }
+
+tenants = TenantStores()
+
+class ReplicationError(ValueError):
+    """The primary's stream can't be applied to this replica's copy as it is"""
+
+class Replicator:
+    """Keeps this server a read replica of a primary (--replicate-from).
+
+    A background thread holds the primary's replication stream open
+    (/api/customizations/stream?replica=<name>) and installs every version
+    it sends with store.replicate(), so this server answers reads from its
+    own memory. On (re)connecting it sends the version it has and that
+    version's ETag: the primary then sends just the JSON Patch since, or the
+    whole document if its delta history no longer reaches back that far or
+    the copies differ. Patched documents are checked against the primary's
+    ETag, and a mismatch makes the next connection ask for the whole
+    document. Writes are redirected to the primary.
+    """
+
+    def __init__(self):
+        self.primary = None  # base URL, e.g. http://10.0.0.5:8082
+        self.name = None
+        self.connected = False
+        self.snapshots = 0
+        self.patches = 0
+        self.resyncs = 0
+        self.reconnects = 0
+        self.lag = None            # seconds between the primary sending the newest version and it being installed here
+        self.last_contact = None   # time.monotonic() of the last bytes from the primary, heartbeats included
+        self._resync = False
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return self.primary is not None
+
+    def start(self):
+        if self.enabled and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='replicator', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        delay = REPLICA_RETRY_MIN
+        while True:
+            try:
+                self._follow()
+            except (OSError, http.client.HTTPException, ValueError) as e:
+                if self.connected:
+                    print(f"⚠️ Lost the replication stream from {self.primary}: {e}; reconnecting")
+                    delay = REPLICA_RETRY_MIN
+                elif self.reconnects == 0:
+                    print(f"⚠️ Cannot reach the primary {self.primary}: {e}; retrying")
+            self.connected = False
+            self.reconnects += 1
+            time.sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 2, REPLICA_RETRY_MAX)
+
+    def _follow(self):
+        url = urlparse(self.primary)
+        conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=REPLICA_READ_TIMEOUT)
+        try:
+            headers = {'Accept': 'text/event-stream'}
+            snapshot = store.snapshot
+            if snapshot.version and not self._resync:
+                headers['Last-Event-ID'] = str(snapshot.version)
+                headers['If-None-Match'] = snapshot.etag
+            conn.request('GET', '/api/customizations/stream?replica=' + quote(self.name, safe=''), headers=headers)
+            response = conn.getresponse()
+            if response.status != 200:
+                raise ReplicationError(f'HTTP {response.status} from the primary')
+            self._resync = False
+            self.connected = True
+            self.last_contact = time.monotonic()
+            print(f"🔗 Replicating from {self.primary} (version {snapshot.version})")
+            fields = {}
+            while True:
+                line = response.readline()
+                if not line.endswith(b'\n'):
+                    raise ConnectionError('the primary closed the stream')
+                self.last_contact = time.monotonic()
+                line = line.rstrip(b'\r\n')
+                if not line:
+                    if 'data' in fields:
+                        self._apply(fields)
+                    fields = {}
+                elif not line.startswith(b':'):
+                    name, _, value = line.partition(b':')
+                    value = value[1:] if value.startswith(b' ') else value
+                    if name == b'data':
+                        fields.setdefault('data', []).append(value)
+                    else:
+                        fields[name.decode('latin-1')] = value
+        finally:
+            conn.close()
+
+    def _apply(self, fields):
+        """Install one replication_event frame"""
+        event = fields.get('event')
+        if event not in (b'snapshot', b'patch'):
+            return
+        meta, payload = fields['data']
+        meta = json.loads(meta)
+        version = int(fields['id'])
+        if event == b'snapshot':
+            if version <= store.snapshot.version:
+                print(f"⏪ The primary sent version {version}, not newer than this replica's "
+                      f"{store.snapshot.version}; starting over from it")
+            snapshot = store.replicate(json.loads(payload), version, body=payload)
+            self.snapshots += 1
+        else:
+            current = store.snapshot
+            if meta['base'] != current.version:
+                self._resync = True
+                raise ReplicationError(f"patch is from version {meta['base']}, this replica has {current.version}")
+            ops = json.loads(payload)
+            snapshot = store.replicate(apply_json_patch(current.data, ops), version, ops)
+            self.patches += 1
+            if snapshot.etag != meta['etag']:
+                # Same content, serialized differently (or a bug): start again from the primary's bytes
+                self._resync = True
+                self.resyncs += 1
+                raise ReplicationError(f'version {version} does not match the primary after patching')
+        self.lag = max(time.time() - meta['sent'], 0.0)
+
+    def redirect(self, request):
+        """307 sending a write to the primary (the method and body are kept)"""
+        location = self.primary.rstrip('/') + request.path
+        if request.query:
+            location += '?' + urlencode(request.query, doseq=True)
+        return json_response(307, {'error': 'This server is a read-only replica', 'primary': self.primary},
+                             headers={'Location': location})
+
+    def stats(self):
+        if not self.enabled:
+            return {'role': 'primary', 'replicas': [{'name': name, 'version': version}
+                                                    for name, version in change_feed.replicas()]}
+        return {
+            'role': 'replica',
+            'primary': self.primary,
+            'name': self.name,
+            'connected': self.connected,
+            'version': store.snapshot.version,
+            'lag_seconds': self.lag,
+            'last_contact_seconds': time.monotonic() - self.last_contact if self.last_contact else None,
+            'snapshots': self.snapshots,
+            'patches': self.patches,
+            'resyncs': self.resyncs,
+            'reconnects': self.reconnects,
+        }
+
+replicator = Replicator()
+
+class CustomizationFile:
+    """customization_data.json: loaded into `store` once at startup, then watched for edits made on disk.
+
+    start() loads the document once per process; the write-ahead log wins
+    when it exists, then customization_data.json, then the seed in
+    initial_customization_data.json. A file that was edited while the server
+    was stopped (it no longer matches the log's last export) is published
+    on top of the recovered log. The watcher then picks up edits to the
+    file without a restart, through inotify where available or else by
+    polling its mtime. An edit is published as a new logged version only
+    when its content differs from the published document and from the
+    server's own latest export; requests in flight keep the snapshot they
+    already have.
+    """
+
+    def __init__(self, store, path='customization_data.json', initial_path='initial_customization_data.json'):
+        self.store = store
+        self.path = path
+        self.initial_path = initial_path
+        # 'auto' (inotify where available, else polling), 'inotify', 'poll' or 'off'
+        self.watch_mode = 'auto'
+        self.mode = None  # what the watcher ended up using
+        self.source = None  # where the document was loaded from: 'log', 'file' or 'initial'
+        # Publish edits saved to the file while the server was stopped (not on replicas: the primary's document wins)
+        self.adopt_edits = True
+        self.load_seconds = None
+        self._started = False
+        self._lock = threading.Lock()
+        self._signature = None
+        self.reloads = 0
+        self.unchanged = 0
+        self.rejected = 0
+
+    def start(self):
+        """load() and watch(), once; main() calls it, and WSGI/ASGI servers importing the module on first use"""
+        if self._started:
+            return
+        with self._lock:
+            if not self._started:
+                self.load()
+                self.watch()
+                self._started = True
+
+    def load(self):
+        started = time.perf_counter()
+        try:
+            self._load()
+        except LogInUseError:
+            raise  # serving a document of its own next to the log's owner would fork the data
+        except Exception as e:
+            print(f"❌ Error loading customization data: {e}")
+        self.load_seconds = time.perf_counter() - started
+
+    def _load(self):
+        # The write-ahead log is authoritative once it exists
+        if self.store.recover_from_log():
+            self.source = 'log'
+            # A file that no longer matches the last export was edited while the server was
+            # stopped; log it as a new version before the next compaction exports over it
+            if self.adopt_edits:
+                self.check()
+            return
+        
         # Try to load from existing file first
-        if os.path.exists('customization_data.json'):
-            with open('customization_data.json', 'r') as f:
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
                 data = json.load(f)
-                # Check if it's valid customization data (not test data)
-                if 'collections' in data or 'showPromotionalBanner' in data:
-                    customization_data = data
-                    print(f"📂 Loaded existing customization data: {len(customization_data)} items")
-                    return
+            # Check if it's valid customization data (not test data)
+            if 'collections' in data or 'showPromotionalBanner' in data:
+                self.store.replace(data)
+                print(f"📂 Loaded existing customization data: {len(data)} items")
+                self.store.start_log()
+                self.source = 'file'
+                return
         
         # If no valid data, load from initial file
-        if os.path.exists('initial_customization_data.json'):
-            with open('initial_customization_data.json', 'r') as f:
-                customization_data = json.load(f)
-                # Save to main file
-                with open('customization_data.json', 'w') as f:
-                    json.dump(customization_data, f, indent=2)
-                print(f"📂 Loaded initial customization data: {len(customization_data)} items")
+        if os.path.exists(self.initial_path):
+            with open(self.initial_path, 'r') as f:
+                data = json.load(f)
+            self.store.replace(data)
+            # Save to main file
+            save_customization_data(data, self.path)
+            print(f"📂 Loaded initial customization data: {len(data)} items")
+            self.store.start_log()
+            self.source = 'initial'
         else:
             print("⚠️ No initial customization data found")
-    except Exception as e:
-        print(f"❌ Error loading customization data: {e}")
 
-# Load data on startup
-load_initial_data()
+    def watch(self):
+        """Start the watcher thread (unless watch_mode is 'off')"""
+        if self.watch_mode == 'off':
+            return
+        fd = None
+        if self.watch_mode in ('auto', 'inotify'):
+            fd = inotify_open(os.path.dirname(os.path.abspath(self.path)))
+            if fd is None and self.watch_mode == 'inotify':
+                print(f"⚠️ inotify is not available; polling {self.path} instead")
+        self.mode = 'poll' if fd is None else 'inotify'
+        # load() has published the file as it is now; only edits made from now on are
+        self._signature = self._stat_signature()
+        threading.Thread(target=self._watch, args=(fd,), name='file-watcher', daemon=True).start()
+
+    def _watch(self, fd):
+        name = os.fsencode(os.path.basename(self.path))
+        while True:
+            if fd is None:
+                time.sleep(FILE_WATCH_POLL_INTERVAL)
+            else:
+                names = inotify_names(fd)
+                # An empty name is a queue overflow: anything may have changed
+                if name not in names and b'' not in names:
+                    continue
+                # Let an editor that saves in several steps finish
+                time.sleep(FILE_WATCH_SETTLE)
+            try:
+                self.check()
+            except Exception as e:
+                print(f"❌ Error reloading {self.path}: {e}")
+
+    def _stat_signature(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    def check(self):
+        """Publish the file's document if it changed on disk since the last check; True when it was published"""
+        log = self.store.log
+        # A compaction exporting now would leave the file read here older than log.exported
+        with log.export_lock if log is not None else contextlib.nullcontext():
+            signature = self._stat_signature()
+            if signature is None or signature == self._signature:
+                return False
+            self._signature = signature
+            try:
+                with open(self.path, 'rb') as f:
+                    data = json.loads(f.read())
+                if not isinstance(data, dict):
+                    raise ValueError('the customization document must be a JSON object')
+            except (OSError, ValueError) as e:
+                # Most likely caught mid-save: the finished file changes the signature again
+                self.rejected += 1
+                print(f"⚠️ Not reloading {self.path}: {e}")
+                return False
+            # The log's compactions rewrite the file with a version the server already has
+            if data == self.store.snapshot.data or (log is not None and data == log.exported):
+                self.unchanged += 1
+                return False
+        snapshot = self.store.replace(data, persist=True)
+        self.reloads += 1
+        print(f"🔄 Reloaded {self.path} from disk: version {snapshot.version}")
+        return True
+
+    def stats(self):
+        return {
+            'path': self.path,
+            'source': self.source,
+            'load_ms': round(self.load_seconds * 1000, 1) if self.load_seconds is not None else None,
+            'watch': self.mode or 'off',
+            'reloads': self.reloads,
+            'unchanged': self.unchanged,
+            'rejected': self.rejected,
+        }
+
+def inotify_open(directory):
+    """An inotify descriptor reporting files written or renamed into `directory`, or None without inotify"""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+def inotify_names(fd):
+    """Block until inotify events arrive on `fd`; the file names they are about"""
+    buffer = os.read(fd, 64 * 1024)
+    names, offset = set(), 0
+    while offset < len(buffer):
+        _, _, _, length = INOTIFY_EVENT.unpack_from(buffer, offset)
+        offset += INOTIFY_EVENT.size
+        names.add(buffer[offset:offset + length].rstrip(b'\0'))
+        offset += length
+    return names
+
+document_file = CustomizationFile(store)
+
+class StaticFileCache:
+    """Size-bounded LRU of small, frequently requested static files.
+
+    Entries are keyed by path (or path and content coding, for files that
+    have no precompressed sidecar) and validated against the file's mtime
+    and size on every lookup, so an edited file is re-read on its next request.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_STATIC_CACHE_BYTES, max_file_bytes=DEFAULT_STATIC_CACHE_MAX_FILE):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self._entries = collections.OrderedDict()  # path or (path, coding) -> (mtime_ns, size, body)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path, st):
+        """Cached contents of `path` (whose os.stat result is `st`), or None if it's too big"""
+        return self._lookup(path, path, st, None)
+
+    def get_encoded(self, path, st, encoding):
+        """`path` compressed with `encoding`, compressed once per version of the file, or None if it's too big"""
+        return self._lookup((path, encoding), path, st, encoding)
+
+    def _lookup(self, key, path, st, encoding):
+        if st.st_size > self.max_file_bytes:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+        with open(path, 'rb') as f:
+            body = f.read()
+        if encoding is not None:
+            body = compress_body(body, encoding)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[2])
+            self._entries[key] = (st.st_mtime_ns, st.st_size, body)
+            self._bytes += len(body)
+            while self._bytes > self.max_bytes:
+                self._bytes -= len(self._entries.popitem(last=False)[1][2])
+        return body
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._bytes,
+                    'hits': self.hits, 'misses': self.misses}
+
+static_cache = StaticFileCache()
+
+class StaticPrecompressor:
+    """Brotli and gzip sidecars (main.dart.js.br, main.dart.js.gz) for the web build.
+
+    build() compresses every compressible file under the root at the
+    strongest settings, once, and gives each sidecar its source's mtime. A
+    sidecar is only served while that mtime still matches, so a file
+    replaced by a new deploy is never answered with the previous build;
+    the first request for it queues the sidecars to be rebuilt on a
+    background thread. At startup build() runs in a forked process, as
+    brotli takes seconds on the large bundle files.
+    """
+
+    def __init__(self, root=STATIC_ROOT, min_bytes=STATIC_PRECOMPRESS_MIN_BYTES):
+        self.root = root
+        self.min_bytes = min_bytes
+        self.enabled = True  # build at startup and rebuild stale sidecars
+        self.served = collections.Counter()  # coding -> responses sent from a sidecar
+        self.rebuilt = 0
+        self._builder = None  # pid of the startup build while it runs
+        self._queue = None
+        self._queued = set()
+        self._lock = threading.Lock()
+        if hasattr(os, 'register_at_fork'):
+            # A forked worker starts its own rebuild thread; the parent's isn't copied
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._queue = None
+        self._queued = set()
+        self._lock = threading.Lock()
+        self.served = collections.Counter()
+        self.rebuilt = 0
+
+    def start(self, reap=True):
+        """Bring the sidecars up to date in a forked process; `reap` waits for it on a thread.
+
+        Call it before request threads start. Without reap the caller must
+        collect the child itself (serve_processes' os.wait() loop does).
+        """
+        if not self.enabled or not os.path.isdir(self.root):
+            return
+        if not hasattr(os, 'fork'):
+            threading.Thread(target=self.build, name='precompress', daemon=True).start()
+            return
+        sys.stdout.flush()  # or the child would print the parent's buffered output again
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            status = 0
+            try:
+                self.build()
+            except BaseException as e:
+                print(f"❌ Precompressing {self.root} failed: {e}")
+                status = 1
+            finally:
+                sys.stdout.flush()
+                os._exit(status)
+        self._builder = pid
+        if reap:
+            threading.Thread(target=self._reap, args=(pid,), name='precompress-reaper', daemon=True).start()
+
+    def _reap(self, pid):
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass
+        self._builder = None
+
+    def building(self):
+        """True while the startup build is still running"""
+        pid = self._builder
+        if pid is None:
+            return False
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            self._builder = None
+            return False
+        return True
+
+    def build(self):
+        """Write every missing or stale sidecar under the root; returns how many were written"""
+        started = time.monotonic()
+        written = 0
+        # Resolved first, so the paths stay valid if a symlink on the way is removed mid-build
+        root = os.path.realpath(self.root)
+        for directory, dirnames, filenames in os.walk(root):
+            dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+            for name in filenames:
+                path = os.path.join(directory, name)
+                if name.startswith('.') or not static_compressible(path):
+                    continue
+                try:
+                    written += self.compress_file(path)
+                except OSError as e:
+                    print(f"⚠️ Could not precompress {path}: {e}")
+        if written:
+            print(f"🗜️ Wrote {written} precompressed sidecars under {self.root} "
+                  f"in {time.monotonic() - started:.1f}s")
+        return written
+
+    def sidecar_stat(self, path, st, encoding):
+        """os.stat of `path`'s sidecar for `encoding` if it was made from this version (`st`), else None"""
+        try:
+            sidecar_st = os.stat(path + STATIC_SIDECAR_SUFFIXES[encoding])
+        except OSError:
+            return None
+        return sidecar_st if sidecar_st.st_mtime_ns == st.st_mtime_ns else None
+
+    def compress_file(self, path):
+        """Write `path`'s missing or stale sidecars (gzip first, it's quick); returns how many"""
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            if st.st_size < self.min_bytes:
+                return 0
+            stale = [encoding for encoding in reversed(available_encodings())
+                     if self.sidecar_stat(path, st, encoding) is None]
+            if not stale:
+                return 0
+            body = f.read()
+        for encoding in stale:
+            sidecar = path + STATIC_SIDECAR_SUFFIXES[encoding]
+            tmp = f'{sidecar}.{os.getpid()}.tmp'
+            try:
+                with open(tmp, 'wb') as f:
+                    f.write(compress_body(body, encoding))
+                # The source's mtime marks which version of it the sidecar was made from
+                os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+                os.replace(tmp, sidecar)
+            except BaseException:
+                with contextlib.suppress(OSError):
+                    os.remove(tmp)
+                raise
+        return len(stale)
+
+    def negotiate(self, path, st, accept_encoding):
+        """(coding, sidecar path, sidecar stat) to answer a request for `path` (a compressible file) with.
+
+        With no fresh sidecar the path and stat are None and the coding, if
+        any, is one to compress the file with in memory.
+        """
+        if not accept_encoding or st.st_size < self.min_bytes:
+            return None, None, None
+        fresh, stale = {}, False
+        for encoding in available_encodings():
+            sidecar_st = self.sidecar_stat(path, st, encoding)
+            if sidecar_st is None:
+                stale = True
+            elif sidecar_st.st_size < st.st_size:  # only offer a coding when it actually saves bytes
+                fresh[encoding] = sidecar_st
+        if stale and self.enabled and not self.building():
+            self.rebuild(path)
+        encoding = choose_encoding(accept_encoding, fresh)
+        if encoding is not None:
+            with self._lock:
+                self.served[encoding] += 1
+            return encoding, path + STATIC_SIDECAR_SUFFIXES[encoding], fresh[encoding]
+        if not stale:
+            return None, None, None
+        return choose_encoding(accept_encoding, ('gzip',)), None, None
+
+    def rebuild(self, path):
+        """Queue `path`'s sidecars to be rewritten on the rebuild thread"""
+        with self._lock:
+            if path in self._queued:
+                return
+            if self._queue is None:
+                self._queue = queue.Queue()
+                threading.Thread(target=self._run, args=(self._queue,), name='precompress', daemon=True).start()
+            self._queued.add(path)
+            self._queue.put(path)
+
+    def _run(self, q):
+        while True:
+            path = q.get()
+            try:
+                written = self.compress_file(path)
+            except OSError as e:
+                print(f"⚠️ Could not precompress {path}: {e}")
+                written = 0
+            with self._lock:
+                self._queued.discard(path)
+                self.rebuilt += written
+
+    def stats(self):
+        with self._lock:
+            return {'encodings': list(available_encodings()), 'served': dict(self.served),
+                    'rebuilt': self.rebuilt, 'rebuilding': len(self._queued), 'building': self.building()}
+
+static_sidecars = StaticPrecompressor()
+
+def resize_image(source, width, height, image_format):
+    """`source` scaled down to fit within width x height and encoded as `image_format` (runs in a pool process)"""
+    from PIL import Image, ImageOps
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((width or MAX_IMAGE_DIMENSION, height or MAX_IMAGE_DIMENSION), Image.LANCZOS)
+        pil_format = IMAGE_FORMATS[image_format][0]
+        if pil_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        out = io.BytesIO()
+        image.save(out, pil_format, quality=IMAGE_QUALITY, optimize=True)
+        return out.getvalue()
+
+def _image_worker_started(server_pid):
+    """Initializer of each resizing process: exit once the server that forked it is gone"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C is the server's to handle
+
+    def watch():
+        while os.getppid() == server_pid:
+            time.sleep(1)
+        os._exit(0)
+
+    threading.Thread(target=watch, name='image-worker-watch', daemon=True).start()
+
+class ImageResizer:
+    """Resized variants of local images for /img/<path>, cached on disk.
+
+    Resizing runs in a process pool, so request threads only wait for it.
+    A variant's file is named by a hash of the source image's contents and
+    the requested size and format, so an edited image gets new variants and
+    identical copies share them. The least recently used files are deleted
+    once the cache outgrows max_bytes. A request for a variant that is
+    already being made waits for that job instead of starting another.
+    """
+
+    def __init__(self, image_dir=DEFAULT_IMAGE_DIR, cache_dir=DEFAULT_IMAGE_CACHE_DIR,
+                 max_bytes=DEFAULT_IMAGE_CACHE_BYTES, workers=None):
+        self.image_dir = image_dir
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self._entries = None  # file name -> size, least recently used first; read from cache_dir on first use
+        self._bytes = 0
+        self._pending = {}  # file name -> Future of a resize in progress
+        self._digests = collections.OrderedDict()  # (path, mtime_ns, size) -> content hash
+        self._executor = None
+        self._available = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.failures = 0
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    @property
+    def available(self):
+        # Found rather than imported: only the resizing processes need Pillow loaded
+        if self._available is None:
+            self._available = importlib.util.find_spec('PIL') is not None
+        return self._available
+
+    def start(self):
+        """Fork the pool's processes now, while no request threads are running"""
+        if self.available:
+            self._pool().submit(int).result()
+
+    def _pool(self):
+        if self._executor is None:
+            try:
+                context = multiprocessing.get_context('fork')
+            except ValueError:  # no fork() on Windows; Pillow releases the GIL while resampling
+                self._executor = concurrent.futures.ThreadPoolExecutor(self.workers, 'image-resize')
+            else:
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    self.workers, mp_context=context, initializer=_image_worker_started, initargs=(os.getpid(),))
+        return self._executor
+
+    def _after_fork(self):
+        # A forked server worker (--processes) starts a pool of its own
+        self._executor = None
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def source_path(self, path):
+        """File for /img/<path> under image_dir, else the web build; None if missing or outside both"""
+        relative = path.lstrip('/')
+        for root in (self.image_dir, STATIC_ROOT):
+            root = os.path.abspath(root)
+            file_path = os.path.abspath(os.path.join(root, relative))
+            if file_path.startswith(root + os.sep) and os.path.isfile(file_path):
+                return file_path
+        return None
+
+    def _source_digest(self, path):
+        st = os.stat(path)
+        key = (path, st.st_mtime_ns, st.st_size)
+        with self._lock:
+            digest = self._digests.get(key)
+        if digest is None:
+            with open(path, 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            with self._lock:
+                self._digests[key] = digest
+                if len(self._digests) > 4096:
+                    self._digests.popitem(last=False)
+        return digest
+
+    def variant(self, source, width, height, image_format):
+        """Path of the cached variant of `source`, waiting for it to be made if needed.
+
+        Raises concurrent.futures.TimeoutError after IMAGE_RESIZE_TIMEOUT, or
+        whatever Pillow raised for an image it cannot read.
+        """
+        key = f'{self._source_digest(source)}:{width}x{height}:{image_format}:{IMAGE_QUALITY}'
+        name = hashlib.sha256(key.encode()).hexdigest()[:40] + IMAGE_FORMATS[image_format][2]
+        with self._lock:
+            self._load_entries()
+            if name in self._entries:
+                self._entries.move_to_end(name)
+                self.hits += 1
+                return os.path.join(self.cache_dir, name)
+            done = self._pending.get(name)
+            first = done is None
+            if first:
+                self.misses += 1
+                done = self._pending[name] = concurrent.futures.Future()
+            else:
+                self.coalesced += 1
+        if first:
+            try:
+                job = self._pool().submit(resize_image, source, width, height, image_format)
+            except RuntimeError as e:  # the pool broke (a process was killed) or shut down
+                job = concurrent.futures.Future()
+                job.set_exception(e)
+            job.add_done_callback(lambda job: self._store(name, job, done))
+        return done.result(IMAGE_RESIZE_TIMEOUT)
+
+    def _store(self, name, job, done):
+        """Write a finished resize to the cache, then wake everyone waiting for it"""
+        try:
+            body = job.result()
+            path = os.path.join(self.cache_dir, name)
+            temp = f'{path}.{os.getpid()}.tmp'
+            with open(temp, 'wb') as f:
+                f.write(body)
+            os.replace(temp, path)
+        except BaseException as e:
+            with self._lock:
+                self.failures += 1
+                self._pending.pop(name, None)
+                if isinstance(e, concurrent.futures.BrokenExecutor):
+                    # Start a fresh pool for the next request
+                    self._executor = None
+            done.set_exception(e)
+            return
+        with self._lock:
+            self._entries[name] = len(body)
+            self._bytes += len(body)
+            self._evict()
+            self._pending.pop(name, None)
+        done.set_result(path)
+
+    def discard(self, path):
+        """Forget a variant whose file disappeared (another worker process evicted it)"""
+        with self._lock:
+            size = self._entries.pop(os.path.basename(path), None)
+            if size is not None:
+                self._bytes -= size
+
+    def _load_entries(self):
+        if self._entries is not None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.tmp'):
+                continue
+            st = entry.stat()
+            files.append((st.st_mtime, entry.name, st.st_size))
+        files.sort()
+        self._entries = collections.OrderedDict((name, size) for _, name, size in files)
+        self._bytes = sum(self._entries.values())
+        self._evict()
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            name, size = self._entries.popitem(last=False)
+            self._bytes -= size
+            try:
+                os.unlink(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {'available': self.available, 'files': len(self._entries or ()), 'bytes': self._bytes,
+                    'max_bytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses,
+                    'coalesced': self.coalesced, 'failures': self.failures, 'in_progress': len(self._pending)}
+
+image_resizer = ImageResizer()
+
+def resolve_static_path(path):
+    """Map a percent-encoded URL path to a file under STATIC_ROOT, or None if it escapes the root"""
+    if path == '/':
+        path = '/index.html'
+    root = os.path.abspath(STATIC_ROOT)
+    # Checked after decoding, so %2e%2e/ cannot climb out of the root
+    file_path = os.path.abspath(os.path.join(root, unquote(path).lstrip('/')))
+    if file_path != root and not file_path.startswith(root + os.sep):
+        return None
+    return file_path
+
+def static_cache_control(file_path):
+    """Cache-Control for a build file: immutable if its name is content-hashed, else revalidate"""
+    if STATIC_HASHED_NAME.search(os.path.basename(file_path)):
+        return STATIC_IMMUTABLE_CACHE_CONTROL
+    return STATIC_REVALIDATE_CACHE_CONTROL
+
+def static_etag(st):
+    """Validator for a static file derived from its mtime and size (no need to hash the contents)"""
+    return '"%x-%x"' % (st.st_mtime_ns, st.st_size)
+
+def static_not_modified(headers, etag, mtime):
+    """True when the request's conditional headers show the client's copy is current.
+
+    If-None-Match takes precedence; If-Modified-Since is only consulted without it.
+    """
+    if_none_match = headers.get('If-None-Match')
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag)
+    since = parse_http_date(headers.get('If-Modified-Since'))
+    return since is not None and int(mtime) <= since
+
+def parse_http_date(value):
+    """Seconds since the epoch for an HTTP-date header, or None if absent or malformed"""
+    if not value:
+        return None
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+def parse_byte_range(header, size):
+    """(start, end) inclusive for a single-range `Range: bytes=...` header.
+
+    Returns None when the header is absent, malformed or asks for several
+    ranges (the full file is sent instead), and False when the range lies
+    outside the file (416).
+    """
+    if not header or not header.startswith('bytes='):
+        return None
+    spec = header[len('bytes='):].strip()
+    if ',' in spec or '-' not in spec:
+        return None
+    first, last = (part.strip() for part in spec.split('-', 1))
+    try:
+        if not first:
+            # Suffix range: the final `last` bytes
+            length = int(last)
+            if length <= 0:
+                return False if length == 0 else None
+            return (max(size - length, 0), size - 1) if size else False
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        return False
+    if end < start:
+        return None
+    return start, min(end, size - 1)
+
+def static_content_type(file_path):
+    """Content type based on file extension"""
+    return STATIC_CONTENT_TYPES.get(os.path.splitext(file_path)[1].lower(), 'application/octet-stream')
+
+def static_compressible(file_path):
+    """True for build files that are sent compressed to clients that accept it"""
+    return os.path.splitext(file_path)[1].lower() in STATIC_COMPRESSIBLE
+
+class _MetricsShard:
+    """Request counters written by one thread only, so recording takes no lock"""
+    __slots__ = ('requests', 'bytes', 'latency', 'feed', 'in_flight')
+
+    def __init__(self):
+        self.requests = {}   # (route, method, status) -> count
+        self.bytes = {}      # route -> response body bytes
+        self.latency = {}    # route -> [count per LATENCY_BUCKETS bucket..., +Inf count, sum of seconds]
+        self.feed = {}       # 'stream' / 'wait' -> requests handed to the change feed
+        self.in_flight = 0
+
+    def merge(self, other):
+        for key, value in other.requests.items():
+            self.requests[key] = self.requests.get(key, 0) + value
+        for key, value in other.bytes.items():
+            self.bytes[key] = self.bytes.get(key, 0) + value
+        for key, value in other.latency.items():
+            mine = self.latency.setdefault(key, [0] * len(value))
+            for index, count in enumerate(value):
+                mine[index] += count
+        for key, value in other.feed.items():
+            self.feed[key] = self.feed.get(key, 0) + value
+        self.in_flight += other.in_flight
+
+class RequestMetrics:
+    """Per-route request counts, status codes, bytes and latency histograms for /metrics.
+
+    Each thread records into its own shard, so the request path takes no
+    lock; a scrape copies every shard (dict and list copies are atomic under
+    the GIL) and adds them up. A thread's shard is folded into a retired
+    total when the thread exits.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._retired = _MetricsShard()
+        # Reentrant: a shard can be retired by garbage collection during a scrape
+        self._lock = threading.RLock()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            pass
+        shard = _MetricsShard()
+        owner = _ShardOwner()
+        self._local.shard = shard
+        self._local.owner = owner
+        with self._lock:
+            self._shards.append(shard)
+        # The thread's locals are dropped when it exits, which retires the shard
+        weakref.finalize(owner, self._retire, shard)
+        return shard
+
+    def _retire(self, shard):
+        with self._lock:
+            self._shards.remove(shard)
+            self._retired.merge(shard)
+
+    def request_started(self):
+        self._shard().in_flight += 1
+
+    def request_finished(self, route, method, status, sent, seconds):
+        """Record a finished request; status None means it went to the change feed"""
+        shard = self._shard()
+        shard.in_flight -= 1
+        if status is None:
+            return
+        key = (route, method, status)
+        shard.requests[key] = shard.requests.get(key, 0) + 1
+        shard.bytes[route] = shard.bytes.get(route, 0) + sent
+        latency = shard.latency.get(route)
+        if latency is None:
+            latency = shard.latency[route] = [0] * (len(LATENCY_BUCKETS) + 2)
+        latency[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        latency[-1] += seconds
 
-class CustomizationHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        parsed_url = urlparse(self.path)
-        path = parsed_url.path
+    def feed_request(self, kind):
+        shard = self._shard()
+        shard.feed[kind] = shard.feed.get(kind, 0) + 1
+
+    def collect(self):
+        """All shards merged into one"""
+        total = _MetricsShard()
+        with self._lock:
+            shards = [self._retired] + list(self._shards)
+        for shard in shards:
+            view = _MetricsShard()
+            view.requests = shard.requests.copy()
+            view.bytes = shard.bytes.copy()
+            view.latency = {route: list(counts) for route, counts in shard.latency.copy().items()}
+            view.feed = shard.feed.copy()
+            view.in_flight = shard.in_flight
+            total.merge(view)
+        return total
+
+class _ShardOwner:
+    """Lives in a thread's locals only; its collection means the thread is gone"""
+
+metrics = RequestMetrics()
+
+class AccessLog:
+    """JSON-lines access log written by a background thread.
+
+    record() samples the request and enqueues a tuple; formatting and the
+    write happen on the writer thread, so a slow terminal or journald never
+    sits on a response. A record that finds the queue full is dropped and
+    counted instead of waiting. Errors (status >= 400) are always kept.
+    message() queues a console line (a write, a failed resize) the same way;
+    those go to stdout even when the log itself is a file or off.
+    """
+
+    def __init__(self, destination='-', sample=1.0, max_queue=DEFAULT_ACCESS_LOG_QUEUE):
+        self.destination = destination  # '-' for stdout, a file path, or 'off'
+        self.sample = sample
+        self.max_queue = max_queue
+        self.written = 0
+        self.dropped = 0
+        self.write_errors = 0
+        self._queue = None
+        self._thread = None
+        self._lock = threading.Lock()
+        if hasattr(os, 'register_at_fork'):
+            # A forked worker starts its own writer; the parent's thread isn't copied
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    @property
+    def enabled(self):
+        return self.destination != 'off' and self.sample > 0
+
+    def _after_fork(self):
+        self._queue = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self.written = self.dropped = self.write_errors = 0
+
+    def _start(self):
+        with self._lock:
+            if self._queue is None:
+                q = queue.Queue(self.max_queue)
+                self._thread = threading.Thread(target=self._run, args=(q,), name='access-log', daemon=True)
+                self._thread.start()
+                self._queue = q
+            return self._queue
+
+    def record(self, method, path, route, status, sent, seconds, client, version, feed=None):
+        """Queue one request for the log; never blocks. status is None for a change feed handoff."""
+        if not self.enabled:
+            return
+        if self.sample < 1 and (status is None or status < 400) and random.random() >= self.sample:
+            return
+        self._put((time.time(), method, path, route, status, sent, seconds, client, version, feed))
+
+    def message(self, text):
+        """Print `text` from the writer thread; never blocks"""
+        self._put(text)
+
+    def _put(self, entry):
+        q = self._queue or self._start()
+        try:
+            q.put_nowait(entry)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def _run(self, q):
+        stream = None
+        while True:
+            entries = [q.get()]
+            try:
+                while len(entries) < ACCESS_LOG_BATCH:
+                    entries.append(q.get_nowait())
+            except queue.Empty:
+                pass
+            closing = entries[-1] is None
+            if closing:
+                entries.pop()
+            messages = [entry for entry in entries if isinstance(entry, str)]
+            if messages:
+                entries = [entry for entry in entries if not isinstance(entry, str)]
+                try:
+                    sys.stdout.write(''.join(text + '\n' for text in messages))
+                    sys.stdout.flush()
+                except (OSError, ValueError):
+                    pass
+            try:
+                if stream is None and entries:
+                    stream = sys.stdout if self.destination == '-' else open(self.destination, 'a', encoding='utf-8')
+                if entries:
+                    stream.write(''.join(map(self._format, entries)))
+                    stream.flush()
+                    self.written += len(entries)
+            except (OSError, ValueError) as e:
+                if not self.write_errors:
+                    print(f"❌ Access log write failed: {e}", file=sys.stderr)
+                self.write_errors += 1
+                with self._lock:
+                    self.dropped += len(entries)
+            if closing:
+                if stream is not None and stream is not sys.stdout:
+                    stream.close()
+                return
+
+    @staticmethod
+    def _format(entry):
+        timestamp, method, path, route, status, sent, seconds, client, version, feed = entry
+        fields = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(timestamp)) + f'.{int(timestamp % 1 * 1000):03d}Z',
+            'method': method,
+            'path': path,
+            'route': route,
+            'status': status,
+            'bytes': sent,
+            'duration_ms': round(seconds * 1000, 3),
+            'client': client,
+            'version': version,
+        }
+        if feed is not None:
+            fields['feed'] = feed
+        return json.dumps(fields, separators=(',', ':')) + '\n'
+
+    def close(self, timeout=2):
+        """Write out what is queued and stop the writer thread"""
+        with self._lock:
+            q, thread = self._queue, self._thread
+            self._queue = self._thread = None
+        if q is None:
+            return
+        try:
+            q.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        thread.join(timeout)
+
+    def stats(self):
+        q = self._queue
+        return {
+            'destination': self.destination,
+            'sample': self.sample,
+            'queued': q.qsize() if q is not None else 0,
+            'written': self.written,
+            'dropped': self.dropped,
+        }
+
+access_log = AccessLog()
+
+def _metric_labels(labels):
+    if not labels:
+        return ''
+    pairs = []
+    for name, value in labels.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+def _histogram_samples(labels, counts, total, buckets):
+    """_bucket/_sum/_count samples from per-bucket counts (+Inf last)"""
+    cumulative = 0
+    for bound, count in zip(buckets + (float('inf'),), counts):
+        cumulative += count
+        yield '_bucket', {**labels, 'le': '+Inf' if bound == float('inf') else repr(bound)}, cumulative
+    yield '_sum', labels, total
+    yield '_count', labels, cumulative
+
+def render_metrics():
+    """Prometheus text exposition format (0.0.4) of request and server metrics"""
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for suffix, labels, value in samples:
+            lines.append(f'{name}{suffix}{_metric_labels(labels)} {value}')
+
+    requests = metrics.collect()
+    metric('customization_http_requests_total', 'counter', 'HTTP requests by route, method and status code',
+           [('', {'route': route, 'method': method, 'status': status}, count)
+            for (route, method, status), count in sorted(requests.requests.items())])
+    metric('customization_http_response_bytes_total', 'counter', 'Response body bytes sent, by route',
+           [('', {'route': route}, sent) for route, sent in sorted(requests.bytes.items())])
+    metric('customization_http_request_duration_seconds', 'histogram',
+           'Time from reading a request to sending its response, by route',
+           [sample for route, counts in sorted(requests.latency.items())
+            for sample in _histogram_samples({'route': route}, counts[:-1], counts[-1], LATENCY_BUCKETS)])
+    metric('customization_http_requests_in_flight', 'gauge', 'Requests being handled right now',
+           [('', {}, requests.in_flight)])
+    metric('customization_change_feed_requests_total', 'counter',
+           'Requests handed to the change feed (SSE streams and long-polls)',
+           [('', {'kind': kind}, count) for kind, count in sorted(requests.feed.items())])
+    metric('customization_change_feed_subscribers', 'gauge', 'Open SSE streams and parked long-polls',
+           [('', {}, change_feed.subscriber_count)])
+
+    metric('customization_poll_interval_seconds', 'gauge',
+           'Poll interval currently advised to devices (X-Poll-Interval, before jitter)',
+           [('', {}, poll_advisor.interval())])
+
+    snapshot = store.snapshot
+    metric('customization_document_version', 'gauge', 'Version of the published customization document',
+           [('', {}, snapshot.version)])
+    metric('customization_document_bytes', 'gauge', 'Size of the published document, by content coding',
+           [('', {'encoding': 'identity'}, len(snapshot.body))] +
+           [('', {'encoding': encoding}, len(body)) for encoding, body in sorted(snapshot.encoded.items())])
+
+    log_stats = storage.stats()
+    metric('customization_wal_bytes', 'gauge', 'Size of the write-ahead log', [('', {}, log_stats['bytes'])])
+    counts, total = storage.sync_seconds.snapshot()
+    metric('customization_wal_sync_duration_seconds', 'histogram',
+           'Time to write and fsync a batch of log records (one group commit)',
+           list(_histogram_samples({}, counts, total, PERSISTENCE_BUCKETS)))
+    counts, total = storage.compact_seconds.snapshot()
+    metric('customization_wal_compaction_duration_seconds', 'histogram',
+           'Time to compact the log into a checkpoint and export customization_data.json',
+           list(_histogram_samples({}, counts, total, PERSISTENCE_BUCKETS)))
+
+    deltas = delta_history.stats()
+    metric('customization_delta_requests_total', 'counter', '?since= requests answered with a delta or not',
+           [('', {'result': 'hit'}, deltas['hits']), ('', {'result': 'miss'}, deltas['misses'])])
+    views = document_views.stats(store.snapshot)
+    metric('customization_document_view_requests_total', 'counter',
+           '?fields=/visibleOnly= views served from cache, built and cached, or built uncached past the limit',
+           [('', {'result': 'hit'}, views['hits']), ('', {'result': 'build'}, views['builds']),
+            ('', {'result': 'uncached'}, views['uncached'])])
+    cache = static_cache.stats()
+    metric('customization_static_cache_requests_total', 'counter', 'Static file cache lookups',
+           [('', {'result': 'hit'}, cache['hits']), ('', {'result': 'miss'}, cache['misses'])])
+    metric('customization_static_cache_bytes', 'gauge', 'Static file bytes held in memory',
+           [('', {}, cache['bytes'])])
+    sidecars = static_sidecars.stats()
+    metric('customization_static_sidecar_responses_total', 'counter',
+           'Static responses sent from a precompressed sidecar, by content coding',
+           [('', {'encoding': encoding}, count) for encoding, count in sorted(sidecars['served'].items())])
+    images = image_resizer.stats()
+    metric('customization_image_cache_requests_total', 'counter',
+           '/img/ variants served from the disk cache, resized, joined to a resize in progress, or failed',
+           [('', {'result': 'hit'}, images['hits']), ('', {'result': 'miss'}, images['misses']),
+            ('', {'result': 'coalesced'}, images['coalesced']), ('', {'result': 'failed'}, images['failures'])])
+    metric('customization_image_cache_bytes', 'gauge', 'Resized image bytes on disk', [('', {}, images['bytes'])])
+    shed = admission.stats()['shed']
+    metric('customization_http_requests_shed_total', 'counter',
+           'Requests turned away by admission control (queue full, waited too long, client over its rate)',
+           [('', {'reason': reason}, count) for reason, count in sorted(shed.items())])
+    log = access_log.stats()
+    metric('customization_access_log_records_total', 'counter',
+           'Access log records written, or dropped because the writer fell behind',
+           [('', {'result': 'written'}, log['written']), ('', {'result': 'dropped'}, log['dropped'])])
+    metric('customization_access_log_queued', 'gauge', 'Access log records waiting for the writer thread',
+           [('', {}, log['queued'])])
+    reloads = document_file.stats()
+    metric('customization_file_reloads_total', 'counter',
+           'Edits to customization_data.json seen on disk: published, unchanged (or the server\'s own export) '
+           'or rejected as invalid JSON',
+           [('', {'result': 'published'}, reloads['reloads']), ('', {'result': 'unchanged'}, reloads['unchanged']),
+            ('', {'result': 'rejected'}, reloads['rejected'])])
+    tenant_stats = tenants.stats()
+    metric('customization_tenants_resident', 'gauge', 'Tenant documents loaded in memory',
+           [('', {}, tenant_stats['resident'])])
+    metric('customization_tenant_resident_bytes', 'gauge',
+           'Estimated memory of resident tenants (documents, encoded bodies, delta rings), held to the budget',
+           [('', {}, tenant_stats['resident_bytes'])])
+    metric('customization_tenant_loads_total', 'counter', 'Tenant documents loaded from disk (or created)',
+           [('', {}, tenant_stats['loads'])])
+    metric('customization_tenant_evictions_total', 'counter',
+           'Tenant documents unloaded, for being idle or to fit the budget',
+           [('', {'reason': reason}, count) for reason, count in sorted(tenant_stats['evictions'].items())])
+    replication = replicator.stats()
+    if replication['role'] == 'replica':
+        metric('customization_replication_connected', 'gauge', 'Whether the stream from the primary is open',
+               [('', {}, int(replication['connected']))])
+        metric('customization_replication_lag_seconds', 'gauge',
+               'Time from the primary sending the newest version to it being installed here',
+               [('', {}, replication['lag_seconds'] or 0)])
+        metric('customization_replication_last_contact_seconds', 'gauge',
+               'Time since anything (heartbeats included) was heard from the primary',
+               [('', {}, replication['last_contact_seconds'] or 0)])
+        metric('customization_replication_events_total', 'counter',
+               'Versions received from the primary, as the whole document or a patch',
+               [('', {'kind': 'snapshot'}, replication['snapshots']), ('', {'kind': 'patch'}, replication['patches'])])
+    else:
+        version = store.snapshot.version
+        metric('customization_replication_versions_behind', 'gauge',
+               'Versions not yet sent to each read replica streaming from this server',
+               [('', {'replica': replica['name']}, version - replica['version'])
+                for replica in replication['replicas']])
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+class Request:
+    """One HTTP request, independent of the server that received it"""
+    __slots__ = ('method', 'path', 'query', 'headers', 'body')
+
+    def __init__(self, method, path, query_string, headers, body=b''):
+        self.method = method
+        self.path = path  # still percent-encoded; routes unquote the parts they take from it
+        self.query = parse_qs(query_string)
+        # Anything with a case-insensitive get(name): http.server's message or RequestHeaders
+        self.headers = headers
+        self.body = body
+
+class RequestHeaders(dict):
+    """Case-insensitive request headers for the WSGI and ASGI adapters"""
+
+    def __init__(self, items=()):
+        super().__init__()
+        for name, value in items:
+            name = name.lower()
+            self[name] = f'{self[name]}, {value}' if name in self else value
+
+    def get(self, name, default=None):
+        return super().get(name.lower(), default)
+
+class Response:
+    """A route's answer, for the server adapter to send.
+
+    `body` is bytes, or None for a response without one (304). A large
+    static file is instead an open `file` to send `count` bytes of from
+    `offset` (the adapter closes it). `feed` hands the request to the change
+    feed: 'stream' starts an SSE stream whose first chunk is `body`,
+    'replication' is the same for the read replica named `replica` (its
+    events are replication_event frames), and 'wait' is a long-poll for a
+    version newer than `version`, answered with `view` of it in
+    `media_type` (see select_document). How those are held open is up to
+    each adapter.
+    """
+    __slots__ = ('status', 'headers', 'body', 'file', 'offset', 'count', 'feed', 'version', 'view', 'media_type',
+                 'replica')
+
+    def __init__(self, status, headers=None, body=None, file=None, offset=0, count=0, feed=None, version=None,
+                 view=None, media_type=None, replica=None):
+        self.status = status
+        self.headers = headers or {}
+        self.body = body
+        self.file = file
+        self.offset = offset
+        self.count = count
+        self.feed = feed
+        self.version = version
+        self.view = view
+        self.media_type = media_type
+        self.replica = replica
+
+    @property
+    def content_length(self):
+        if self.file is not None:
+            return self.count
+        return len(self.body) if self.body is not None else 0
+
+def body_response(status, content_type, body, cors=True, headers=None):
+    """Complete response with a body (adapters add the Content-Length)"""
+    all_headers = {'Content-type': content_type}
+    if cors:
+        all_headers['Access-Control-Allow-Origin'] = '*'
+    all_headers.update(headers or {})
+    return Response(status, all_headers, body)
+
+def json_response(status, payload, headers=None):
+    return body_response(status, 'application/json', json.dumps(payload).encode(), headers=headers)
+
+def not_modified_response(etag):
+    """304 with no body: the client's copy is current"""
+    return Response(304, {
+        'ETag': etag,
+        'Vary': 'Accept, Accept-Encoding',
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers': 'ETag',
+    })
+
+def document_response(snapshot, accept_encoding):
+    """200 with the best encoding of a document version"""
+    encoding, body, etag = snapshot.representation(accept_encoding)
+    headers = {'ETag': etag, 'X-Customization-Version': str(snapshot.version),
+               'Vary': 'Accept, Accept-Encoding',
+               'Access-Control-Expose-Headers': 'ETag, X-Customization-Version'}
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    return body_response(200, snapshot.content_type, body, headers=headers)
+
+def long_poll_result(snapshot, version, accept_encoding, view=None, media_type=None):
+    """Answer to a long-poll on `version` once it has waited: the new version, or 304 on timeout"""
+    snapshot = select_document(snapshot, view, media_type, strict=False)
+    if snapshot.version != version:
+        response = document_response(snapshot, accept_encoding)
+    else:
+        response = Response(304, {
+            'ETag': snapshot.etag,
+            'X-Customization-Version': str(snapshot.version),
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Expose-Headers': 'ETag, X-Customization-Version',
+        })
+    return with_poll_advice(response, count=False)
+
+def with_poll_advice(response, count=True):
+    """Add X-Poll-Interval to a /api/customizations response"""
+    response.headers['X-Poll-Interval'] = str(poll_advisor.advise(count))
+    expose = response.headers.get('Access-Control-Expose-Headers')
+    response.headers['Access-Control-Expose-Headers'] = f'{expose}, X-Poll-Interval' if expose else 'X-Poll-Interval'
+    return response
+
+class CustomizationApp:
+    """The sync server's routes, independent of the HTTP server running them.
+
+    handle() maps a Request to a Response. CustomizationHandler adapts it to
+    http.server (the zero-dependency default); wsgi_app and asgi_app expose
+    it to WSGI and ASGI servers.
+    """
+    # GET routes answered from memory, which an event loop can run inline
+    IN_MEMORY_ROUTES = frozenset(('/health', '/metrics', '/api/customizations', '/api/customizations/stream',
+                                  '/api/customizations/history'))
+    # Paths reported as their own route in /metrics; other GETs are static files
+    ROUTES = IN_MEMORY_ROUTES | {'/api/customizations/rollback', '/customize'}
+    # Any other path below this is an array of the document: /<section> pages it, /<section>/<id> is one item
+    SECTION_PREFIX = '/api/customizations/'
+    # Resized images: /img/<path>?w=&h=&fmt=
+    IMAGE_PREFIX = '/img/'
+    # Tenant documents: /api/t/<tenant>/customizations (see TenantStores)
+    TENANT_PREFIX = '/api/t/'
+    METHODS = frozenset(('GET', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'))
+
+    def handle(self, request):
+        route = {'GET': self.get, 'POST': self.post, 'PUT': self.put, 'PATCH': self.patch,
+                 'DELETE': self.delete, 'OPTIONS': self.options}.get(request.method)
+        if route is None:
+            return body_response(501, 'text/plain', b'Unsupported method', cors=False)
+        if replicator.enabled and request.method != 'OPTIONS' and request.path.startswith('/api/') and (
+                request.method != 'GET' or request.path.startswith(self.TENANT_PREFIX)):
+            # Tenants aren't replicated, so their reads go to the primary as well
+            return replicator.redirect(request)
+        if request.path.startswith(self.TENANT_PREFIX) and request.method != 'OPTIONS':
+            return self._tenant(request)
+        return route(request)
+
+    def route_of(self, request):
+        """(route, method) labels for /metrics, bounded so every static file shares one route"""
+        method = request.method if request.method in self.METHODS else 'other'
+        if request.path in self.ROUTES:
+            return request.path, method
+        if request.path.startswith(self.SECTION_PREFIX):
+            if '/' in request.path[len(self.SECTION_PREFIX):]:
+                return self.SECTION_PREFIX + '<section>/<id>', method
+            return self.SECTION_PREFIX + '<section>', method
+        if request.path.startswith(self.IMAGE_PREFIX):
+            return self.IMAGE_PREFIX + '<path>', method
+        if request.path.startswith(self.TENANT_PREFIX):
+            return self.TENANT_PREFIX + '<tenant>/customizations', method
+        return ('static' if request.method == 'GET' else 'other'), method
+
+    def blocks(self, request):
+        """True when handling `request` may touch the disk (writes, static files)"""
+        return request.method != 'OPTIONS' and not (request.method == 'GET' and (
+            request.path in self.IN_MEMORY_ROUTES or request.path.startswith(self.SECTION_PREFIX)))
+
+    def get(self, request):
+        path = request.path
+        # With --processes, reads see writes accepted by the other workers straight away
+        store.follow_shared()
         
         if path == '/health':
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps({'status': 'healthy'}).encode())
-            return
+            health = {
+                'status': 'healthy',
+                'pid': os.getpid(),
+                'version': store.snapshot.version,
+                'delta_history': delta_history.stats(),
+                'log': storage.stats(),
+                'static_cache': static_cache.stats(),
+                'static_sidecars': static_sidecars.stats(),
+                'images': image_resizer.stats(),
+                'views': document_views.stats(store.snapshot),
+                'access_log': access_log.stats(),
+                'admission': admission.stats(),
+                'poll': poll_advisor.stats(),
+                'replication': replicator.stats(),
+                'tenants': tenants.stats(),
+                'document_file': document_file.stats(),
+            }
+            return json_response(200, health)
+            
+        elif path == '/metrics':
+            return body_response(200, 'text/plain; version=0.0.4; charset=utf-8', render_metrics(), cors=False)
             
+        elif path == '/api/customizations/stream':
+            return self._event_stream(request)
+
+        elif path == '/api/customizations/history':
+            versions = [{'version': s.version, 'etag': s.etag, 'bytes': len(s.body)} for s in store.history()]
+            return json_response(200, {'versions': versions})
+
         elif path == '/api/customizations':
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps(customization_data).encode())
-            return
+            response = self._customizations(request)
+            # Parked long-polls get their advice when they are answered
+            return response if response.feed is not None else with_poll_advice(response)
+
+        elif path.startswith(self.SECTION_PREFIX):
+            return self._section_get(request)
+
+        elif path.startswith(self.IMAGE_PREFIX):
+            return self._image(request)
             
         elif path == '/customize':
             # Serve the customization manager
             try:
                 with open('local-customization-manager.html', 'r') as f:
                     content = f.read()
-                
-                self.send_response(200)
-                self.send_header('Content-type', 'text/html')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(content.encode())
-                return
+                return body_response(200, 'text/html', content.encode())
             except FileNotFoundError:
-                self.send_response(404)
-                self.send_header('Content-type', 'text/plain')
-                self.end_headers()
-                self.wfile.write(b'Customization manager not found')
-                return
+                return body_response(404, 'text/plain', b'Customization manager not found', cors=False)
             
         else:
-            # Serve static files from build/web directory
-            file_path = f'build/web{path}'
-            if path == '/':
-                file_path = 'build/web/index.html'
-            
-            if os.path.exists(file_path) and os.path.isfile(file_path):
-                self.send_response(200)
-                
-                # Set content type based on file extension
-                if file_path.endswith('.html'):
-                    self.send_header('Content-type', 'text/html')
-                elif file_path.endswith('.js'):
-                    self.send_header('Content-type', 'application/javascript')
-                elif file_path.endswith('.css'):
-                    self.send_header('Content-type', 'text/css')
-                elif file_path.endswith('.json'):
-                    self.send_header('Content-type', 'application/json')
-                elif file_path.endswith('.png'):
-                    self.send_header('Content-type', 'image/png')
-                elif file_path.endswith('.jpg') or file_path.endswith('.jpeg'):
-                    self.send_header('Content-type', 'image/jpeg')
-                elif file_path.endswith('.gif'):
-                    self.send_header('Content-type', 'image/gif')
-                elif file_path.endswith('.ico'):
-                    self.send_header('Content-type', 'image/x-icon')
-                else:
-                    self.send_header('Content-type', 'application/octet-stream')
-                
-                self.end_headers()
-                
-                with open(file_path, 'rb') as f:
-                    self.wfile.write(f.read())
+            return self._static(path, request.headers)
+
+    def _customizations(self, request):
+        return self._document(request, store.snapshot, delta_history, wait=True)
+
+    def _document(self, request, snapshot, deltas, wait=False):
+        """GET of a document at `snapshot`: a view in a format, a delta from `deltas`, a 304, or with `wait` a long-poll"""
+        query = request.query
+        media_type = choose_format(request.headers.get('Accept'))
+        try:
+            view = parse_view(query)
+            snapshot = select_document(snapshot, view, media_type)
+        except ValueError as e:
+            return json_response(400, {'error': str(e)})
+        if 'wait' in query:
+            if not wait:
+                return json_response(400, {'error': 'Long-polling is only available on /api/customizations'})
+            try:
+                wait_version = int(query['wait'][0])
+            except ValueError:
+                return json_response(400, {'error': 'Invalid wait version'})
+            if wait_version == snapshot.version:
+                # Nothing newer yet: park the request until a write publishes
+                return Response(None, feed='wait', version=wait_version, view=view, media_type=media_type)
+        # Deltas are JSON patches of the whole document, so views and binary formats are sent in full
+        if 'since' in query and view is None and media_type is None:
+            response = self._delta(snapshot, deltas, query['since'][0])
+            if response is not None:
+                return response
+        if snapshot.matches(request.headers.get('If-None-Match')):
+            return not_modified_response(snapshot.representation(request.headers.get('Accept-Encoding'))[2])
+        return document_response(snapshot, request.headers.get('Accept-Encoding'))
+
+    def _section_path(self, path):
+        """(section, item id or None) for a path below SECTION_PREFIX"""
+        section, _, item_id = path[len(self.SECTION_PREFIX):].partition('/')
+        return unquote(section), (unquote(item_id) if item_id else None)
+
+    def _section_get(self, request):
+        snapshot = store.snapshot
+        section, item_id = self._section_path(request.path)
+        index = snapshot.index(section)
+        if index is None:
+            return json_response(404, {'error': f'No array section {section!r}'})
+        items = snapshot.data[section]
+        headers = {'X-Customization-Version': str(snapshot.version),
+                   'Access-Control-Expose-Headers': 'X-Customization-Version'}
+        if item_id is not None:
+            position = index.get(item_id)
+            if position is None:
+                return json_response(404, {'error': f'No item with id {item_id!r} in {section}'})
+            return json_response(200, items[position], headers=headers)
+
+        try:
+            limit = int(request.query.get('limit', [DEFAULT_PAGE_LIMIT])[0])
+        except ValueError:
+            return json_response(400, {'error': 'Invalid limit'})
+        if limit < 1:
+            return json_response(400, {'error': 'Invalid limit'})
+        limit = min(limit, MAX_PAGE_LIMIT)
+        start = 0
+        cursor = request.query.get('cursor', [''])[0]
+        if cursor:
+            # <position of the last item sent>:<its id>; the id survives inserts and deletes before it
+            position, _, last_id = cursor.partition(':')
+            if not position.isdigit():
+                return json_response(400, {'error': 'Invalid cursor'})
+            if last_id:
+                found = find_item(items, last_id, index, exact=True)
+                # If that item was deleted since, the next one has moved into its position
+                start = found + 1 if found is not None else int(position)
             else:
-                self.send_response(404)
-                self.send_header('Content-type', 'text/plain')
-                self.end_headers()
-                self.wfile.write(b'File not found')
-    
-    def do_POST(self):
-        parsed_url = urlparse(self.path)
-        path = parsed_url.path
+                # An item without an id can't be looked up again: resume right after its position
+                start = int(position) + 1
+        page = items[start:start + limit]
+        end = start + len(page)
+        next_cursor = None
+        if end < len(items):
+            last = page[-1]
+            last_id = str(last['id']) if isinstance(last, dict) and 'id' in last else ''
+            next_cursor = f'{end - 1}:{last_id}'
+        return json_response(200, {'items': page, 'nextCursor': next_cursor, 'total': len(items)},
+                             headers=headers)
+
+    def _image(self, request):
+        """A local image scaled down to fit ?w= x ?h=, as ?fmt= (or WebP when the client accepts it)"""
+        if not image_resizer.available:
+            return body_response(501, 'text/plain', b'Image resizing needs Pillow (pip install Pillow)', cors=False)
+        query = request.query
+        try:
+            width, height = (int(query[name][0]) if name in query else None for name in ('w', 'h'))
+        except ValueError:
+            return body_response(400, 'text/plain', b'w and h must be whole numbers', cors=False)
+        if width is None and height is None:
+            return body_response(400, 'text/plain', b'Give a width (w), a height (h) or both', cors=False)
+        if any(size is not None and not 1 <= size <= MAX_IMAGE_DIMENSION for size in (width, height)):
+            return body_response(400, 'text/plain', f'w and h must be 1-{MAX_IMAGE_DIMENSION}'.encode(), cors=False)
+        # Decoded like any other path segment, so /img/my%20photo.jpg finds 'my photo.jpg'; source_path
+        # checks the decoded path, so %2e%2e/ cannot climb out of the image roots either
+        source = image_resizer.source_path(unquote(request.path[len(self.IMAGE_PREFIX):]))
+        if source is None:
+            return body_response(404, 'text/plain', b'Image not found', cors=False)
+        headers = {'Cache-Control': STATIC_REVALIDATE_CACHE_CONTROL, 'Access-Control-Allow-Origin': '*'}
+        image_format = query.get('fmt', [''])[0].lower()
+        if not image_format:
+            # Negotiated, so shared caches must key on Accept
+            headers['Vary'] = 'Accept'
+            if 'image/webp' in (request.headers.get('Accept') or ''):
+                image_format = 'webp'
+            else:
+                image_format = 'png' if source.lower().endswith('.png') else 'jpeg'
+        if image_format not in IMAGE_FORMATS:
+            return body_response(400, 'text/plain', f'fmt must be one of {", ".join(IMAGE_FORMATS)}'.encode(),
+                                 cors=False)
+
+        for _ in range(2):
+            try:
+                path = image_resizer.variant(source, width, height, image_format)
+            except concurrent.futures.TimeoutError:
+                return body_response(503, 'text/plain', b'Image is still being resized', cors=False,
+                                     headers={'Retry-After': '1'})
+            except (OSError, ValueError, RuntimeError) as e:  # unreadable image or a failed pool process
+                access_log.message(f"⚠️ Could not resize {source}: {e}")
+                return body_response(422, 'text/plain', b'Cannot resize this image', cors=False)
+            try:
+                f = open(path, 'rb')
+            except FileNotFoundError:
+                # Evicted by another worker process between lookup and open: make it again
+                image_resizer.discard(path)
+                continue
+            break
+        else:
+            return body_response(503, 'text/plain', b'Image cache is busy', cors=False, headers={'Retry-After': '1'})
+        # The file name is a hash of the source contents and the variant
+        headers['ETag'] = f'"{os.path.basename(path).partition(".")[0][:20]}"'
+        if etag_matches(request.headers.get('If-None-Match'), headers['ETag']):
+            f.close()
+            return Response(304, headers)
+        size = os.fstat(f.fileno()).st_size
+        headers['Content-type'] = IMAGE_FORMATS[image_format][1]
+        return Response(200, headers, file=f, offset=0, count=size)
+
+    def _event_stream(self, request):
+        """Start an SSE stream; the adapter keeps it open and feeds it new versions"""
+        snapshot = store.snapshot
+        headers = {
+            'Content-type': 'text/event-stream',
+            'Cache-Control': 'no-cache',
+            'Access-Control-Allow-Origin': '*',
+            'X-Accel-Buffering': 'no',
+        }
+        initial = b'retry: 3000\n\n'
+        replica = request.query.get('replica', [None])[0]
+        if replica is not None:
+            base = replica_base(request.headers)
+            if base != snapshot.version:
+                initial += replication_event(base, snapshot)
+            return Response(200, headers, initial, feed='replication', version=snapshot.version, replica=replica)
+        # A reconnecting EventSource that already has this version gets no replay
+        if request.headers.get('Last-Event-ID') != str(snapshot.version):
+            initial += sse_event(snapshot)
+        return Response(200, headers, initial, feed='stream', version=snapshot.version)
+
+    def _delta(self, snapshot, deltas, since):
+        """Answer ?since=<version> with a JSON Patch; None means send the full document"""
+        try:
+            since = int(since)
+        except ValueError:
+            return json_response(400, {'error': 'Invalid since version'})
+        headers = {'X-Customization-Version': str(snapshot.version),
+                   'Access-Control-Expose-Headers': 'ETag, X-Customization-Version, X-Delta-Base'}
+        if since == snapshot.version:
+            return not_modified_response(snapshot.etag)
+        body = deltas.delta_since(since, snapshot.version)
+        if body is None:
+            # Aged out of the ring (or unknown): the caller sends a full snapshot
+            return None
+        headers['X-Delta-Base'] = str(since)
+        headers['ETag'] = snapshot.etag
+        return body_response(200, 'application/json-patch+json', body, headers=headers)
+
+    def _static(self, path, request_headers):
+        """Serve a file from the Flutter web build: small hot files from memory, large ones from disk.
+
+        Every response carries ETag/Last-Modified validators so a revisit is
+        answered with 304s, and single byte ranges are honoured so interrupted
+        downloads of the large bundle files can resume. Compressible files go
+        out as their precompressed .br/.gz sidecar when the client accepts one.
+        """
+        file_path = resolve_static_path(path)
+        try:
+            st = os.stat(file_path) if file_path else None
+        except (OSError, ValueError):  # ValueError: a %00 in the path
+            st = None
+        if st is None or not stat.S_ISREG(st.st_mode):
+            return body_response(404, 'text/plain', b'File not found', cors=False)
+        
+        served, encoding = file_path, None
+        if static_compressible(file_path):
+            encoding, sidecar, sidecar_st = static_sidecars.negotiate(
+                file_path, st, request_headers.get('Accept-Encoding'))
+            if sidecar is not None:
+                served, st = sidecar, sidecar_st
+            elif encoding is not None:
+                # No sidecar yet: small files are compressed once in memory, big ones go out as they are
+                body = static_cache.get_encoded(file_path, st, encoding)
+                if body is not None:
+                    return self._static_response(file_path, st, request_headers, body, None, encoding)
+                encoding = None
+        
+        body = static_cache.get(served, st)
+        if body is not None:
+            return self._static_response(file_path, st, request_headers, body, None, encoding)
+        
+        f = open(served, 'rb')
+        try:
+            response = self._static_response(file_path, os.fstat(f.fileno()), request_headers, None, f, encoding)
+        except BaseException:
+            f.close()
+            raise
+        if response.file is None:
+            f.close()
+        return response
+
+    def _static_response(self, file_path, st, request_headers, body, f, encoding=None):
+        """Conditional and range handling for one static file, from `body` if cached or else `f`.
+
+        `st` is the stat of what is sent: the file itself or, with `encoding`,
+        its sidecar (which has the file's mtime). Ranges count bytes of the
+        compressed representation.
+        """
+        etag = static_etag(st)
+        if encoding is not None:
+            # Each coding is a different representation, so it gets its own ETag
+            etag = f'{etag[:-1]}-{encoding}"'
+        last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+        headers = {
+            'ETag': etag,
+            'Last-Modified': last_modified,
+            'Cache-Control': static_cache_control(file_path),
+            'Accept-Ranges': 'bytes',
+        }
+        if static_compressible(file_path):
+            headers['Vary'] = 'Accept-Encoding'
+        if encoding is not None:
+            headers['Content-Encoding'] = encoding
+        if static_not_modified(request_headers, etag, st.st_mtime):
+            return Response(304, headers)
+        
+        size = len(body) if body is not None else st.st_size
+        byte_range = None
+        if_range = request_headers.get('If-Range')
+        if if_range is None or if_range in (etag, last_modified):
+            byte_range = parse_byte_range(request_headers.get('Range'), size)
+        if byte_range is False:
+            headers['Content-Range'] = f'bytes */{size}'
+            return body_response(416, 'text/plain', b'Requested range not satisfiable', cors=False, headers=headers)
+        
+        code, start, end = 200, 0, size - 1
+        if byte_range is not None:
+            code, (start, end) = 206, byte_range
+            headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+        content_type = static_content_type(file_path)
+        if body is not None:
+            return body_response(code, content_type, body[start:end + 1], cors=False, headers=headers)
+        return Response(code, {'Content-type': content_type, **headers}, file=f, offset=start, count=end + 1 - start)
+
+    def post(self, request):
+        path = request.path
         
         if path == '/api/customizations':
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            
             try:
-                global customization_data
-                customization_data = json.loads(post_data.decode('utf-8'))
-                
-                # Save to file for persistence
-                with open('customization_data.json', 'w') as f:
-                    json.dump(customization_data, f, indent=2)
-                
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(json.dumps({'status': 'success'}).encode())
-                
-                print(f"✅ Customization data updated: {len(customization_data)} items")
-                
-            except json.JSONDecodeError as e:
-                self.send_response(400)
-                self.send_header('Content-type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(json.dumps({'error': 'Invalid JSON'}).encode())
+                data = decode_body(request)
+            except ValueError as e:
+                return json_response(400, {'error': str(e)})
+            return self._replace(store, data)
                 
+        elif path == '/api/customizations/rollback':
+            try:
+                version = int(decode_body(request)['version'])
+            except (ValueError, KeyError, TypeError):
+                return json_response(400, {'error': 'Expected {"version": <number>}'})
+            try:
+                snapshot = store.rollback(version)
+            except PatchError as e:
+                return json_response(e.status, {'error': str(e)})
+            access_log.message(f"⏪ Customization data rolled back to version {version} "
+                               f"(now version {snapshot.version})")
+            return json_response(200, {'status': 'success', 'version': snapshot.version, 'restored': version})
+            
         else:
-            self.send_response(404)
-            self.send_header('Content-type', 'text/plain')
-            self.end_headers()
-            self.wfile.write(b'Endpoint not found')
+            return body_response(404, 'text/plain', b'Endpoint not found', cors=False)
+
+    def _replace(self, target, data, tenant=None):
+        """Replace the whole document in store `target` (the global one, or `tenant`'s)"""
+        try:
+            # Logged durably before it is published
+            snapshot = target.replace(data, persist=True)
+        except PatchError as e:
+            return json_response(e.status, {'error': str(e)})
+        access_log.message(f"✅ Customization data updated{f' for tenant {tenant}' if tenant else ''}: "
+                           f"{len(snapshot.data)} items")
+        return json_response(200, {'status': 'success', 'version': snapshot.version})
+    
+    def put(self, request):
+        """Create or replace one item of an array section: PUT /api/customizations/<section>/<id>"""
+        if not request.path.startswith(self.SECTION_PREFIX):
+            return body_response(404, 'text/plain', b'Endpoint not found', cors=False)
+        section, item_id = self._section_path(request.path)
+        if item_id is None:
+            return body_response(404, 'text/plain', b'Endpoint not found', cors=False)
+        try:
+            item = decode_body(request)
+        except ValueError as e:
+            return json_response(400, {'error': str(e)})
+        if not isinstance(item, dict):
+            return json_response(400, {'error': 'An item must be a JSON object'})
+        if str(item.pop('id', item_id)) != item_id:
+            return json_response(400, {'error': 'The item id does not match the URL'})
+        created = False
+
+        def change(data):
+            nonlocal created
+            items = list(self._section_items(data, section))
+            position = self._find(data, section, item_id)
+            if position is None:
+                items.append({'id': new_item_id(items, item_id), **item})
+                created = True
+            else:
+                items[position] = {'id': items[position]['id'], **item}
+            return {**data, section: items}
+
+        return self._write_item(request, change, lambda: 201 if created else 200,
+                                f"✅ Customization item saved: {section}/{item_id}")
+
+    def delete(self, request):
+        """Remove one item of an array section: DELETE /api/customizations/<section>/<id>"""
+        if not request.path.startswith(self.SECTION_PREFIX):
+            return body_response(404, 'text/plain', b'Endpoint not found', cors=False)
+        section, item_id = self._section_path(request.path)
+        if item_id is None:
+            return body_response(404, 'text/plain', b'Endpoint not found', cors=False)
+
+        def change(data):
+            items = self._section_items(data, section)
+            position = self._find(data, section, item_id)
+            if position is None:
+                raise PatchError(f'No item with id {item_id!r} in {section}', 404)
+            return {**data, section: items[:position] + items[position + 1:]}
+
+        return self._write_item(request, change, lambda: 200,
+                                f"🗑️ Customization item deleted: {section}/{item_id}")
+
+    def _section_items(self, data, section):
+        items = data.get(section)
+        if not isinstance(items, list):
+            raise PatchError(f'No array section {section!r}', 404)
+        return items
+
+    def _find(self, data, section, item_id):
+        """Position of an item in the document being written, through the published version's id index"""
+        snapshot = store.snapshot
+        index = snapshot.index(section) or {}
+        # The document being written can be ahead of the published one while a log write syncs
+        exact = snapshot.data.get(section) is data[section]
+        return find_item(data[section], item_id, index, exact)
+
+    def _write_item(self, request, change, status, message):
+        try:
+            snapshot = store.update(change, if_match=request.headers.get('If-Match'))
+        except PatchError as e:
+            return json_response(e.status, {'error': str(e)})
+        access_log.message(message)
+        return json_response(status(), {'status': 'success', 'version': snapshot.version},
+                             headers={'ETag': snapshot.etag, 'Access-Control-Expose-Headers': 'ETag'})
+
+    def patch(self, request):
+        if request.path != '/api/customizations':
+            return body_response(404, 'text/plain', b'Endpoint not found', cors=False)
+        
+        try:
+            patch = decode_body(request)
+        except ValueError as e:
+            return json_response(400, {'error': str(e)})
+        return self._patch(request, store, patch)
+
+    def _patch(self, request, target, patch, tenant=None):
+        """Apply a JSON Patch or merge patch to the document in store `target` (the global one, or `tenant`'s)"""
+        # application/json-patch+json is RFC 6902, application/merge-patch+json RFC 7386;
+        # for plain application/json (or MessagePack/CBOR) an array is a JSON Patch and an object a merge patch
+        content_type = (request.headers.get('Content-Type') or '').split(';')[0].strip().lower()
+        if content_type == 'application/json-patch+json' or (
+                content_type != 'application/merge-patch+json' and isinstance(patch, list)):
+            change = lambda data: apply_json_patch(data, patch)
+        else:
+            change = lambda data: apply_merge_patch(data, patch)
+        
+        try:
+            snapshot = target.update(change, if_match=request.headers.get('If-Match'))
+        except PatchError as e:
+            return json_response(e.status, {'error': str(e)})
+        
+        access_log.message(f"✅ Customization data patched{f' for tenant {tenant}' if tenant else ''}: "
+                           f"version {snapshot.version}")
+        return json_response(200, {'status': 'success', 'version': snapshot.version},
+                             headers={'ETag': snapshot.etag, 'Access-Control-Expose-Headers': 'ETag'})
+
+    def _tenant(self, request):
+        """GET, POST (replace) or PATCH a tenant's document: /api/t/<tenant>/customizations"""
+        name, _, rest = request.path[len(self.TENANT_PREFIX):].partition('/')
+        if rest != 'customizations' or not TENANT_NAME.match(name) or request.method not in ('GET', 'POST', 'PATCH'):
+            return body_response(404, 'text/plain', b'Endpoint not found', cors=False)
+        if not tenants.enabled:
+            return json_response(501, {'error': 'Tenants need a single server process (drop --processes)'})
+        body = None
+        if request.method != 'GET':
+            # Decoded first, so a bad request never creates a tenant
+            try:
+                body = decode_body(request)
+            except ValueError as e:
+                return json_response(400, {'error': str(e)})
+        try:
+            with tenants.open(name, create=body is not None) as tenant_store:
+                if tenant_store is None:
+                    return json_response(404, {'error': f'No tenant {name!r}'})
+                if request.method == 'GET':
+                    return self._document(request, tenant_store.snapshot, tenant_store.deltas)
+                if request.method == 'POST':
+                    return self._replace(tenant_store, body, name)
+                return self._patch(request, tenant_store, body, name)
+        except (OSError, ValueError) as e:  # an unreadable log or export
+            access_log.message(f"❌ Error loading tenant {name}: {e}")
+            return json_response(500, {'error': f'Could not load tenant {name!r}'})
     
-    def do_OPTIONS(self):
-        self.send_response(200)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+    def options(self, request):
+        return Response(200, {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': 'GET, POST, PUT, PATCH, DELETE, OPTIONS',
+            'Access-Control-Allow-Headers': 'Content-Type, If-Match, If-None-Match, Last-Event-ID',
+        }, b'')
+
+app = CustomizationApp()
+
+def record_request(request, client, status, sent, started, feed=None):
+    """Count a finished request in /metrics and queue it for the access log"""
+    seconds = time.perf_counter() - started
+    route, method = app.route_of(request)
+    metrics.request_finished(route, method, status, sent, seconds)
+    access_log.record(request.method, request.path, route, status, sent, seconds, client,
+                      store.snapshot.version, feed)
+
+# Request priorities, most urgent first
+PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_BULK = 0, 1, 2
+PRIORITY_NAMES = ('high', 'normal', 'bulk')
+
+def request_priority(method, path):
+    """high: health checks, metrics and admin writes; normal: API reads and polls; bulk: static files"""
+    if path in ('/health', '/metrics') or method in ('POST', 'PUT', 'PATCH', 'DELETE'):
+        return PRIORITY_HIGH
+    if path.startswith('/api/'):
+        return PRIORITY_NORMAL
+    return PRIORITY_BULK
+
+def peek_priority(conn):
+    """Priority of the request waiting on `conn`, read without consuming it (normal if not arrived yet)"""
+    try:
+        head = conn.recv(1024, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+    except (OSError, AttributeError):  # nothing sent yet, or no MSG_DONTWAIT (Windows)
+        return PRIORITY_NORMAL
+    method, _, rest = head.partition(b' ')
+    target = rest.split(b' ', 1)[0].split(b'?', 1)[0]
+    return request_priority(method.decode('latin-1'), target.decode('latin-1'))
+
+class AdmissionControl:
+    """Sheds load before it queues up: a bounded queue, priorities and per-client rate limits.
+
+    Requests waiting for a worker are served most urgent first. Bulk
+    requests are turned away once the queue is half full and normal ones
+    once it is full; high priority requests are always served. A turned
+    away connection goes to a few separate shedding threads, which read its
+    request and answer a fast 503 even while every worker is busy (reading
+    it first means the client gets the 503 rather than a reset), or serve
+    it if it turns out to be high priority. A request that waited longer than
+    queue_timeout is answered 503 too, rather than served late. A client
+    over its rate gets 429. Retry-After is jittered, so devices that
+    reconnected together don't come back together.
+    """
+
+    def __init__(self, max_queue=DEFAULT_MAX_QUEUE, queue_timeout=DEFAULT_QUEUE_TIMEOUT, rate=0,
+                 burst=DEFAULT_RATE_BURST, retry_after=DEFAULT_RETRY_AFTER):
+        self.max_queue = max_queue  # 0 means unbounded
+        self.queue_timeout = queue_timeout  # 0 means no deadline
+        self.rate = rate  # requests per second per client; 0 means no limit
+        self.burst = burst
+        self.retry_after = retry_after
+        self.shed = {'queue_full': 0, 'queue_timeout': 0, 'rate_limited': 0}
+        self._buckets = collections.OrderedDict()  # client -> (tokens, time of last refill)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _count(self, reason):
+        with self._lock:
+            self.shed[reason] += 1
+
+    def _retry_after(self, minimum=0):
+        base = max(self.retry_after, minimum)
+        return base + random.randint(0, base)
+
+    def queue_full(self, queued, priority):
+        """True if a request of `priority` is to be shed with `queued` requests already waiting"""
+        if not self.max_queue or priority == PRIORITY_HIGH:
+            return False
+        return queued >= (self.max_queue // 2 if priority == PRIORITY_BULK else self.max_queue)
+
+    def dequeued(self, queued_at, shed=False):
+        """Called by the thread that picked a connection up, before its request is read"""
+        self._local.queued_at = queued_at
+        self._local.shed = shed
+
+    @property
+    def shedding(self):
+        """True on a thread serving a turned-away connection, which must not be kept alive"""
+        return getattr(self._local, 'shed', False)
+
+    def _busy(self, reason):
+        self._count(reason)
+        return body_response(503, 'text/plain', b'Server busy, retry later',
+                             headers={'Retry-After': str(self._retry_after()), 'Connection': 'close'})
+
+    def check(self, client, request):
+        """None to go ahead, or the 503/429 Response to send instead"""
+        priority = request_priority(request.method, request.path)
+        queued_at = getattr(self._local, 'queued_at', None)
+        if queued_at is not None:
+            shed = self._local.shed
+            self._local.queued_at = None
+            if priority != PRIORITY_HIGH:
+                if shed:
+                    return self._busy('queue_full')
+                if self.queue_timeout and time.perf_counter() - queued_at > self.queue_timeout:
+                    return self._busy('queue_timeout')
+        if self.rate > 0 and priority != PRIORITY_HIGH:
+            wait = self._take_token(client)
+            if wait:
+                return body_response(429, 'text/plain', b'Too many requests',
+                                     headers={'Retry-After': str(self._retry_after(math.ceil(wait)))})
+        return None
+
+    def _take_token(self, client):
+        """0 if `client` may send a request now, else seconds until it may"""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.pop(client, None)
+            tokens = self.burst if bucket is None else min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / self.rate
+            self._buckets[client] = (tokens - 1 if not wait else tokens, now)
+            if len(self._buckets) > MAX_RATE_LIMITED_CLIENTS:
+                self._buckets.popitem(last=False)
+            if wait:
+                self.shed['rate_limited'] += 1
+        return wait
+
+    def stats(self):
+        with self._lock:
+            return {'max_queue': self.max_queue, 'queue_timeout': self.queue_timeout,
+                    'rate_limit': self.rate, 'shed': dict(self.shed)}
+
+admission = AdmissionControl()
+
+class CustomizationHandler(BaseHTTPRequestHandler):
+    """Runs CustomizationApp on http.server; long-polls and SSE streams are parked on the change feed"""
+    # HTTP/1.1 so polling devices can reuse one connection (keep-alive)
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEP_ALIVE_TIMEOUT
+    # Headers and body go out in separate writes; without this, Nagle plus
+    # delayed ACKs add ~40 ms to every keep-alive response
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        # The asyncio engine waits for the next request on an idle connection
+        # itself, so each dispatch only serves a single request
+        if getattr(self.server, 'one_request_per_dispatch', False):
+            self.close_connection = True
+            self.handle_one_request()
+        elif hasattr(self.server, 'queued_connections'):
+            self.handle_one_request()
+            while not self.close_connection and self._next_request_arrives():
+                self.handle_one_request()
+        else:
+            super().handle()
+
+    def _next_request_arrives(self):
+        """Wait for the next request on this keep-alive connection.
+
+        False on the idle timeout, or once the connection has been idle for
+        KEEP_ALIVE_POLL_INTERVAL while other connections wait for a worker:
+        an idle device gives its worker up rather than holding it until its
+        next poll, but a browser fetching files back to back keeps it.
+        """
+        sock = self.connection
+        try:
+            sock.settimeout(0)
+            if self.rfile.peek(1):  # already buffered (pipelined)
+                return True
+            deadline = time.monotonic() + self.timeout
+            sock.settimeout(KEEP_ALIVE_POLL_INTERVAL)
+            while time.monotonic() < deadline:
+                try:
+                    return bool(sock.recv(1, socket.MSG_PEEK))
+                except socket.timeout:
+                    if self.server.queued_connections:
+                        return False
+            return False
+        except OSError:
+            return False
+        finally:
+            try:
+                sock.settimeout(self.timeout)
+            except OSError:
+                pass
+
+    def send_response(self, code, message=None):
+        super().send_response(code, message)
+        # With connections waiting for a worker, hand this one back rather than
+        # keeping it for the device's next poll
+        if (not getattr(self.server, 'keep_alive', True) or getattr(self.server, 'queued_connections', 0)
+                or admission.shedding):
+            self.send_header('Connection', 'close')
+
+    def _detach_connection(self):
+        """Take the socket away from the serving engine so it can be parked"""
+        self.close_connection = True
+        self.wfile.flush()
+        return socket.socket(fileno=self.connection.detach())
+
+    def _dispatch(self):
+        parsed_url = urlparse(self.path)
+        try:
+            content_length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            self.send_error(400, 'Invalid Content-Length')
+            return
+        body = self.rfile.read(content_length) if content_length > 0 else b''
+        request = Request(self.command, parsed_url.path, parsed_url.query, self.headers, body)
+        
+        started = time.perf_counter()
+        metrics.request_started()
+        status, sent, feed = 500, 0, None
+        try:
+            response = admission.check(self.client_address[0], request) or app.handle(request)
+            if response.feed is not None:
+                metrics.feed_request(response.feed)
+                status, feed = None, response.feed
+            else:
+                status, sent = response.status, response.content_length
+            self._send(response)
+        finally:
+            record_request(request, self.client_address[0], status, sent, started, feed)
+
+    def _send(self, response):
+        if response.feed == 'wait':
+            change_feed.add_waiter(self._detach_connection(), response.version,
+                                   self.headers.get('Accept-Encoding'), response.view, response.media_type)
+            return
+        self.send_response(response.status)
+        for name, value in response.headers.items():
+            self.send_header(name, value)
+        if response.feed in ('stream', 'replication'):
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            change_feed.add_stream(self._detach_connection(), response.version, response.body, response.replica)
+            return
+        if response.file is not None:
+            with response.file:
+                self.send_header('Content-Length', str(response.count))
+                self.end_headers()
+                # Zero-copy from the page cache to the socket (socket.sendfile falls
+                # back to read/send where os.sendfile is unavailable)
+                if response.count:
+                    self.connection.sendfile(response.file, response.offset, response.count)
+            return
+        if response.body is not None:
+            self.send_header('Content-Length', str(len(response.body)))
         self.end_headers()
+        if response.body:
+            self.wfile.write(response.body)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = do_OPTIONS = _dispatch
+    
+    def log_message(self, format, *args):
+        pass  # requests go to access_log, off the request path
+
+def wsgi_app(environ, start_response):
+    """WSGI entry point, e.g. `gunicorn --workers 1 --threads 32 web_server:wsgi_app`.
+
+    Long-polls and SSE streams hold one server thread each while they wait.
+    """
+    document_file.start()
+    headers = RequestHeaders((key[5:].replace('_', '-'), value)
+                             for key, value in environ.items() if key.startswith('HTTP_'))
+    for key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+        if environ.get(key):
+            headers[key.replace('_', '-').lower()] = environ[key]
+    try:
+        content_length = int(environ.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        content_length = 0
+    body = environ['wsgi.input'].read(content_length) if content_length > 0 else b''
+    # PATH_INFO arrives decoded (as latin-1); Request.path is percent-encoded as sent
+    request = Request(environ['REQUEST_METHOD'], quote(environ.get('PATH_INFO', '').encode('latin-1')) or '/',
+                      environ.get('QUERY_STRING', ''), headers, body)
+    started = time.perf_counter()
+    metrics.request_started()
+    status, sent, feed = 500, 0, None
+    try:
+        response = app.handle(request)
+        if response.feed is not None:
+            metrics.feed_request(response.feed)
+            status, feed = None, response.feed
+        else:
+            status, sent = response.status, response.content_length
+    finally:
+        # Streamed bodies are timed until the server starts sending them
+        record_request(request, environ.get('REMOTE_ADDR'), status, sent, started, feed)
+    
+    if response.feed == 'wait':
+        snapshot = version_waiters.wait(response.version, LONG_POLL_TIMEOUT)
+        response = long_poll_result(snapshot, response.version, headers.get('Accept-Encoding'),
+                                    response.view, response.media_type)
+    status = f'{response.status} {HTTPStatus(response.status).phrase}'
+    response_headers = list(response.headers.items())
+    if response.feed in ('stream', 'replication'):
+        start_response(status, response_headers)
+        return _wsgi_event_stream(response)
+    if response.file is not None:
+        response_headers.append(('Content-Length', str(response.count)))
+        start_response(status, response_headers)
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if (file_wrapper is not None and response.offset == 0
+                and response.count == os.fstat(response.file.fileno()).st_size):
+            # Servers such as gunicorn send a wrapped file with sendfile
+            return file_wrapper(response.file, STREAM_CHUNK_SIZE)
+        return _file_chunks(response.file, response.offset, response.count)
+    if response.body is not None:
+        response_headers.append(('Content-Length', str(len(response.body))))
+    start_response(status, response_headers)
+    return [response.body] if response.body else []
+
+def _wsgi_event_stream(response):
+    yield response.body
+    version = response.version
+    while True:
+        snapshot = version_waiters.wait(version, SSE_HEARTBEAT_INTERVAL)
+        if snapshot.version == version:
+            yield b': ping\n\n'
+        elif response.replica is not None:
+            version, frame = snapshot.version, replication_event(version, snapshot)
+            yield frame
+        else:
+            version = snapshot.version
+            yield sse_event(snapshot)
+
+def _file_chunks(f, offset, count):
+    with f:
+        f.seek(offset)
+        while count > 0:
+            chunk = f.read(min(count, STREAM_CHUNK_SIZE))
+            if not chunk:
+                break
+            count -= len(chunk)
+            yield chunk
+
+async def asgi_app(scope, receive, send):
+    """ASGI entry point, e.g. `uvicorn web_server:asgi_app`.
+
+    Routes answered from memory run on the event loop; writes and static
+    files go to the default thread pool. Long-polls and SSE streams just
+    await the next version, so they cost no thread.
+    """
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    document_file.start()
+                except LogInUseError as e:
+                    # The server stops instead of running a worker that can't write
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        return
+    # For servers that don't send lifespan events
+    document_file.start()
     
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    headers = RequestHeaders((name.decode('latin-1'), value.decode('latin-1')) for name, value in scope['headers'])
+    # scope['path'] arrives decoded; Request.path is percent-encoded as sent
+    request = Request(scope['method'], quote(scope['path']), scope.get('query_string', b'').decode('latin-1'),
+                      headers, b''.join(chunks))
+    started = time.perf_counter()
+    metrics.request_started()
+    status, sent, feed = 500, 0, None
+    try:
+        response = await _asgi_handle(request)
+        if response.feed is not None:
+            metrics.feed_request(response.feed)
+            status, feed = None, response.feed
+        else:
+            status, sent = response.status, response.content_length
+            await _asgi_send(response, headers, receive, send)
+    finally:
+        client = scope.get('client')
+        record_request(request, client[0] if client else None, status, sent, started, feed)
+    if response.feed is not None:
+        # Not counted as in flight while it waits, like the change feed's parked sockets
+        await _asgi_send(response, headers, receive, send)
+
+async def _asgi_handle(request):
+    import asyncio
+    if app.blocks(request):
+        return await asyncio.get_running_loop().run_in_executor(None, app.handle, request)
+    return app.handle(request)
+
+async def _asgi_send(response, headers, receive, send):
+    import asyncio
+    loop = asyncio.get_running_loop()
+    if response.feed == 'wait':
+        snapshot = await version_waiters.wait_async(response.version, LONG_POLL_TIMEOUT)
+        response = long_poll_result(snapshot, response.version, headers.get('Accept-Encoding'),
+                                    response.view, response.media_type)
+    response_headers = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                        for name, value in response.headers.items()]
+    if response.feed in ('stream', 'replication'):
+        await send({'type': 'http.response.start', 'status': response.status, 'headers': response_headers})
+        await _asgi_event_stream(response, receive, send)
+        return
+    if response.file is not None:
+        with response.file:
+            response_headers.append((b'content-length', str(response.count).encode('latin-1')))
+            await send({'type': 'http.response.start', 'status': response.status, 'headers': response_headers})
+            await loop.run_in_executor(None, response.file.seek, response.offset)
+            remaining, more = response.count, response.count > 0
+            if not more:
+                await send({'type': 'http.response.body', 'body': b''})
+            while more:
+                chunk = await loop.run_in_executor(None, response.file.read, min(remaining, STREAM_CHUNK_SIZE))
+                remaining -= len(chunk)
+                more = bool(chunk) and remaining > 0
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': more})
+        return
+    if response.body is not None:
+        response_headers.append((b'content-length', str(len(response.body)).encode('latin-1')))
+    await send({'type': 'http.response.start', 'status': response.status, 'headers': response_headers})
+    await send({'type': 'http.response.body', 'body': response.body or b''})
+
+async def _asgi_event_stream(response, receive, send):
+    import asyncio
+    await send({'type': 'http.response.body', 'body': response.body, 'more_body': True})
+    # The request body has been read, so the next message is the client going away
+    disconnected = asyncio.ensure_future(receive())
+    version = response.version
+    try:
+        while True:
+            waiter = asyncio.ensure_future(version_waiters.wait_async(version, SSE_HEARTBEAT_INTERVAL))
+            await asyncio.wait((waiter, disconnected), return_when=asyncio.FIRST_COMPLETED)
+            if disconnected.done():
+                waiter.cancel()
+                return
+            snapshot = waiter.result()
+            if snapshot.version == version:
+                chunk = b': ping\n\n'
+            elif response.replica is not None:
+                version, chunk = snapshot.version, replication_event(version, snapshot)
+            else:
+                version, chunk = snapshot.version, sse_event(snapshot)
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    finally:
+        disconnected.cancel()
+
+class SingleThreadHTTPServer(HTTPServer):
+    """The original engine: one request at a time, connection closed after each"""
+    keep_alive = False
+
+    def __init__(self, server_address, handler_class, reuse_port=False):
+        self.allow_reuse_port = reuse_port
+        super().__init__(server_address, handler_class)
+
+
+class PriorityWorkerPool:
+    """Fixed pool of worker threads taking jobs most urgent first, FIFO within a priority.
+
+    Jobs wait in one deque per priority; a SimpleQueue carries one wake-up
+    token per job, so submitting costs no Python-level lock.
+    """
+
+    def __init__(self, workers, name='http-worker'):
+        self._jobs = tuple(collections.deque() for _ in PRIORITY_NAMES)
+        self._tokens = queue.SimpleQueue()
+        self._workers = workers
+        self._closed = False
+        for i in range(workers):
+            threading.Thread(target=self._run, name=f'{name}-{i}', daemon=True).start()
+
+    @property
+    def queued(self):
+        """Jobs waiting for a worker"""
+        return sum(map(len, self._jobs))
+
+    def submit(self, priority, fn, *args):
+        future = concurrent.futures.Future()
+        self._jobs[priority].append((future, fn, args))
+        self._tokens.put(True)
+        return future
+
+    def _next_job(self):
+        # Every token was put after its job, so one of the deques holds a job for it
+        while not self._closed:
+            for jobs in self._jobs:
+                try:
+                    return jobs.popleft()
+                except IndexError:
+                    continue
+
+    def _run(self):
+        while self._tokens.get():
+            job = self._next_job()
+            if job is None:
+                continue
+            future, fn, args = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def shutdown(self):
+        """Stop the workers once they finish their current job; queued jobs are cancelled"""
+        self._closed = True
+        for jobs in self._jobs:
+            while jobs:
+                jobs.popleft()[0].cancel()
+        for _ in range(self._workers):
+            self._tokens.put(False)
+
+
+class ThreadPoolHTTPServer(HTTPServer):
+    """HTTPServer that serves connections on a bounded pool of worker threads.
+
+    Each worker owns a connection for its keep-alive lifetime, so the pool
+    size caps concurrent connections; further connections wait in the queue,
+    most urgent first (see AdmissionControl). While any are waiting, a
+    worker closes its keep-alive connection after the current response.
+    """
+    request_queue_size = LISTEN_BACKLOG
+
+    def __init__(self, server_address, handler_class, workers=DEFAULT_WORKERS, reuse_port=False):
+        self.allow_reuse_port = reuse_port
+        self.workers = workers
+        self._pool = PriorityWorkerPool(workers)
+        self._shed_pool = PriorityWorkerPool(SHED_WORKERS, 'http-shed')
+        super().__init__(server_address, handler_class)
+
+    @property
+    def queued_connections(self):
+        return self._pool.queued
+
+    def process_request(self, request, client_address):
+        # The request line has usually not arrived yet; the worker classes it again
+        priority = peek_priority(request)
+        shed = admission.queue_full(self._pool.queued, priority)
+        (self._shed_pool if shed else self._pool).submit(priority, self._process_request_worker,
+                                                         request, client_address, time.perf_counter(), shed)
+
+    def _process_request_worker(self, request, client_address, queued_at, shed):
+        admission.dequeued(queued_at, shed)
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self._pool.shutdown()
+        self._shed_pool.shutdown()
+
+
+class AsyncioHTTPServer:
+    """Event-loop engine: idle keep-alive connections are parked on the loop.
+
+    The loop accepts connections and waits for each one to become readable;
+    only then is a single request handed to the worker pool. Hundreds of
+    devices holding a connection open between polls cost no threads.
+    """
+    one_request_per_dispatch = True
+
+    def __init__(self, server_address, handler_class, workers=DEFAULT_WORKERS, reuse_port=False):
+        self.server_address = server_address
+        self.RequestHandlerClass = handler_class
+        self.workers = workers
+        self.socket = socket.create_server(server_address, backlog=LISTEN_BACKLOG, reuse_port=reuse_port)
+        self.socket.setblocking(False)
+        self._pool = PriorityWorkerPool(workers)
+        self._shed_pool = PriorityWorkerPool(SHED_WORKERS, 'http-shed')
+
+    def serve_forever(self):
+        import asyncio
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        while True:
+            conn, addr = await loop.sock_accept(self.socket)
+            loop.create_task(self._serve_connection(conn, addr))
+
+    async def _serve_connection(self, conn, addr):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        try:
+            while await self._wait_readable(loop, conn):
+                priority = peek_priority(conn)
+                shed = admission.queue_full(self._pool.queued, priority)
+                keep_alive = await asyncio.wrap_future((self._shed_pool if shed else self._pool).submit(
+                    priority, self._handle_one, conn, addr, time.perf_counter(), shed))
+                if not keep_alive:
+                    break
+        finally:
+            try:
+                conn.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+            conn.close()
+
+    async def _wait_readable(self, loop, conn):
+        import asyncio
+        ready = loop.create_future()
+        loop.add_reader(conn.fileno(), lambda: ready.done() or ready.set_result(True))
+        try:
+            return await asyncio.wait_for(ready, KEEP_ALIVE_TIMEOUT)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            loop.remove_reader(conn.fileno())
+
+    def _handle_one(self, conn, addr, queued_at, shed):
+        admission.dequeued(queued_at, shed)
+        conn.setblocking(True)
+        try:
+            handler = self.RequestHandlerClass(conn, addr, self)
+        except Exception as e:
+            access_log.message(f"❌ Error handling request from {addr[0]}: {e}")
+            return False
+        return not handler.close_connection
+
+    def server_close(self):
+        self.socket.close()
+        self._pool.shutdown()
+        self._shed_pool.shutdown()
+
+
+class QuietWSGIRequestHandler(WSGIRequestHandler):
     def log_message(self, format, *args):
-        # Custom logging to show API calls
-        if '/api/' in self.path:
-            print(f"🌐 API {self.command} {self.path} - {self.address_string()}")
-        else:
-            # Only log non-API requests occasionally to avoid spam
-            if not hasattr(self, '_request_count'):
-                self._request_count = 0
-            self._request_count += 1
-            if self._request_count % 10 == 0:
-                print(f"📄 Static file request: {self.path}")
-
-def load_existing_data():
-    """Load existing customization data from file if it exists"""
-    global customization_data
-    try:
-        if os.path.exists('customization_data.json'):
-            with open('customization_data.json', 'r') as f:
-                customization_data = json.load(f)
-            print(f"📂 Loaded existing customization data: {len(customization_data)} items")
-    except Exception as e:
-        print(f"⚠️ Could not load existing data: {e}")
-
-def main():
-    load_existing_data()
+        pass  # wsgiref logs every request to stderr, one line per device poll
+
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    """Zero-dependency WSGI engine: the standard library's wsgiref running wsgi_app.
+
+    A thread per connection and no keep-alive; it is here to run the WSGI
+    path without installing anything, not to replace the other engines.
+    """
+    daemon_threads = True
+    request_queue_size = LISTEN_BACKLOG
+
+    def __init__(self, server_address, reuse_port=False):
+        self.allow_reuse_port = reuse_port
+        super().__init__(server_address, QuietWSGIRequestHandler)
+        self.set_app(wsgi_app)
+
+
+def raise_open_file_limit():
+    """Allow as many open sockets as the hard limit permits (parked subscribers)"""
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    target = 65536 if hard == resource.RLIM_INFINITY else min(hard, 65536)
+    if soft != resource.RLIM_INFINITY and soft < target:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+        except (ValueError, OSError):
+            pass
+
+def create_server(server_address, engine=DEFAULT_ENGINE, workers=DEFAULT_WORKERS, reuse_port=False):
+    """Build the HTTP server for the selected serving engine"""
+    if engine == 'single':
+        return SingleThreadHTTPServer(server_address, CustomizationHandler, reuse_port)
+    if engine == 'threaded':
+        return ThreadPoolHTTPServer(server_address, CustomizationHandler, workers, reuse_port)
+    if engine == 'asyncio':
+        return AsyncioHTTPServer(server_address, CustomizationHandler, workers, reuse_port)
+    if engine == 'wsgi':
+        return ThreadingWSGIServer(server_address, reuse_port)
+    raise ValueError(f"Unknown engine: {engine}")
+
+def follow_shared_snapshot(supervisor):
+    """Worker thread: publish other workers' writes promptly, so this worker's change feed sees them"""
+    while True:
+        time.sleep(SHARED_POLL_INTERVAL)
+        if os.getppid() != supervisor:
+            os._exit(1)  # the supervisor died; don't keep serving from an orphan
+        try:
+            store.follow_shared()
+        except Exception as e:
+            print(f"❌ Error following the shared snapshot: {e}")
+
+def run_worker(server_address, engine, workers, shared):
+    """Body of one forked worker process; never returns"""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the supervisor handles Ctrl+C
+    status = 0
+    supervisor = os.getppid()
+    try:
+        shared.attach()
+        store.shared = shared
+        storage.share(shared)
+        image_resizer.start()
+        threading.Thread(target=follow_shared_snapshot, args=(supervisor,), name='shared-follower',
+                         daemon=True).start()
+        httpd = create_server(server_address, engine, workers, reuse_port=True)
+        httpd.serve_forever()
+    except BaseException as e:
+        print(f"❌ Worker {os.getpid()} failed: {e}")
+        status = 1
+    finally:
+        os._exit(status)
+
+def _raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+def serve_processes(server_address, engine, workers, processes):
+    """Fork `processes` workers that each listen on the port with SO_REUSEPORT.
+
+    The kernel spreads incoming connections across the workers, so GETs use
+    every core instead of one GIL. The supervisor publishes the loaded
+    document to the shared snapshot and restarts workers that die.
+    """
+    if fcntl is None or not hasattr(os, 'fork') or not hasattr(socket, 'SO_REUSEPORT'):
+        raise SystemExit('--processes needs fork, flock and SO_REUSEPORT (Linux, macOS, BSD)')
+    # Workers reopen the log themselves; no thread may be running across fork()
+    storage.close()
+    shared = SharedSnapshot()
+    snapshot = store.snapshot
+    shared.create(snapshot.version, snapshot.body)
+
+    def spawn():
+        sys.stdout.flush()  # or the child would print the parent's buffered output again
+        pid = os.fork()
+        if pid == 0:
+            run_worker(server_address, engine, workers, shared)
+        return pid
+
+    children = {spawn(): time.monotonic() for _ in range(processes)}
+    signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+    try:
+        while children:
+            pid, status = os.wait()
+            started = children.pop(pid, None)
+            if started is None:
+                continue
+            if os.waitstatus_to_exitcode(status) == 1 and time.monotonic() - started < 1:
+                raise SystemExit(f"❌ Worker {pid} failed to start; shutting down")
+            print(f"⚠️ Worker {pid} exited ({os.waitstatus_to_exitcode(status)}); restarting")
+            children[spawn()] = time.monotonic()
+    except KeyboardInterrupt:
+        print("\n🛑 Server stopped by user")
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        shared.close()
+        try:
+            os.remove(shared.path)
+        except FileNotFoundError:
+            pass
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='GoEye customization sync server')
+    parser.add_argument('--port', type=int, default=8082)
+    parser.add_argument('--engine', choices=ENGINES, default=DEFAULT_ENGINE,
+                        help='single (one request at a time), threaded (bounded worker pool), '
+                             'asyncio (event loop parks idle keep-alive connections) '
+                             'or wsgi (the WSGI app on the standard library\'s wsgiref)')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help='worker threads for the threaded and asyncio engines')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='worker processes sharing the port (SO_REUSEPORT); >1 uses every core')
+    parser.add_argument('--delta-depth', type=int, default=DEFAULT_DELTA_DEPTH,
+                        help='recent versions kept for ?since=<version> delta requests')
+    parser.add_argument('--delta-max-bytes', type=int, default=DEFAULT_DELTA_MAX_BYTES,
+                        help='memory budget for the delta history, in bytes of JSON')
+    parser.add_argument('--image-dir', default=DEFAULT_IMAGE_DIR,
+                        help='ingest directory searched (before the web build) for /img/<path>')
+    parser.add_argument('--image-cache-dir', default=DEFAULT_IMAGE_CACHE_DIR,
+                        help='where resized images are cached')
+    parser.add_argument('--image-cache-bytes', type=int, default=DEFAULT_IMAGE_CACHE_BYTES,
+                        help='disk budget for resized images; least recently used are deleted beyond it')
+    parser.add_argument('--image-workers', type=int, default=None,
+                        help='image resizing processes (default: one per core)')
+    parser.add_argument('--max-views', type=int, default=MAX_DOCUMENT_VIEWS,
+                        help='distinct ?fields=/visibleOnly= views cached per document version')
+    parser.add_argument('--history-depth', type=int, default=DEFAULT_HISTORY_DEPTH,
+                        help='published versions kept in memory for rollback')
+    parser.add_argument('--static-cache-bytes', type=int, default=DEFAULT_STATIC_CACHE_BYTES,
+                        help='memory budget for hot static files')
+    parser.add_argument('--static-cache-max-file', type=int, default=DEFAULT_STATIC_CACHE_MAX_FILE,
+                        help='largest static file kept in memory; bigger files use sendfile')
+    parser.add_argument('--no-precompress', action='store_true',
+                        help="don't write .br/.gz sidecars for the web build at startup or rebuild stale ones")
+    parser.add_argument('--precompress-only', action='store_true',
+                        help='write the web build\'s .br/.gz sidecars and exit (a deploy step)')
+    parser.add_argument('--wal-compact-bytes', type=int, default=DEFAULT_WAL_COMPACT_BYTES,
+                        help='compact the write-ahead log into a checkpoint past this size')
+    parser.add_argument('--commit-delay-ms', type=float, default=0,
+                        help='wait this long before an fsync so more concurrent writes share it')
+    parser.add_argument('--max-queue', type=int, default=DEFAULT_MAX_QUEUE,
+                        help='requests waiting for a worker before new ones get 503 (bulk static files at '
+                             'half of this; health checks and admin writes never); 0 for no bound')
+    parser.add_argument('--queue-timeout', type=float, default=DEFAULT_QUEUE_TIMEOUT,
+                        help='answer 503 to a request that waited longer than this many seconds; 0 to disable')
+    parser.add_argument('--rate-limit', type=float, default=0,
+                        help='requests per second allowed per client address (token bucket); 0 to disable')
+    parser.add_argument('--rate-burst', type=int, default=DEFAULT_RATE_BURST,
+                        help='requests a client may send at once before --rate-limit applies')
+    parser.add_argument('--retry-after', type=int, default=DEFAULT_RETRY_AFTER,
+                        help='base Retry-After seconds on shed requests (randomly up to twice this)')
+    parser.add_argument('--poll-min', type=float, default=DEFAULT_POLL_MIN,
+                        help='shortest poll interval advised in X-Poll-Interval (seconds), used right after writes')
+    parser.add_argument('--poll-max', type=float, default=DEFAULT_POLL_MAX,
+                        help='longest poll interval advised, reached once the document has been quiet for a while')
+    parser.add_argument('--poll-budget', type=float, default=DEFAULT_POLL_BUDGET,
+                        help='API requests/s the fleet is steered towards; above it the advice is stretched; '
+                             '0 to ignore load')
+    parser.add_argument('--replicate-from', metavar='URL',
+                        help='run as a read replica of the primary at URL (e.g. http://10.0.0.5:8082): '
+                             'reads are served locally, writes are redirected there')
+    parser.add_argument('--replica-name', default=None,
+                        help='how this replica is listed in the primary\'s /health (default: <hostname>:<port>)')
+    parser.add_argument('--watch', choices=('auto', 'inotify', 'poll', 'off'), default='auto',
+                        help='publish edits to customization_data.json without a restart: auto uses inotify '
+                             'where available and otherwise checks the file every second')
+    parser.add_argument('--tenant-root', default=DEFAULT_TENANT_ROOT,
+                        help='directory holding one subdirectory per tenant for /api/t/<tenant>/customizations')
+    parser.add_argument('--tenant-budget-bytes', type=int, default=DEFAULT_TENANT_BUDGET_BYTES,
+                        help='memory budget for resident tenant documents; least recently used are unloaded beyond it')
+    parser.add_argument('--tenant-idle', type=float, default=DEFAULT_TENANT_IDLE_SECONDS, metavar='SECONDS',
+                        help='unload a tenant after this long without requests')
+    parser.add_argument('--access-log', default='-', metavar='PATH',
+                        help="JSON-lines access log: '-' for stdout (default), a file path, or 'off'")
+    parser.add_argument('--access-log-sample', type=float, default=1.0, metavar='FRACTION',
+                        help='fraction of successful requests logged; errors are always logged')
+    parser.add_argument('--access-log-queue', type=int, default=DEFAULT_ACCESS_LOG_QUEUE,
+                        help='records buffered for the log writer; beyond this they are dropped and counted')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    started = time.perf_counter()
+    args = parse_args(argv)
+    delta_history.configure(args.delta_depth, args.delta_max_bytes)
+    document_views.limit = args.max_views
+    store.set_history_depth(args.history_depth)
+    static_cache.max_bytes = args.static_cache_bytes
+    static_cache.max_file_bytes = args.static_cache_max_file
+    static_sidecars.enabled = not args.no_precompress
+    image_resizer.image_dir = args.image_dir
+    image_resizer.cache_dir = args.image_cache_dir
+    image_resizer.max_bytes = args.image_cache_bytes
+    image_resizer.workers = args.image_workers
+    storage.compact_bytes = args.wal_compact_bytes
+    storage.commit_delay = args.commit_delay_ms / 1000.0
+    admission.max_queue = args.max_queue
+    admission.queue_timeout = args.queue_timeout
+    admission.rate = args.rate_limit
+    admission.burst = args.rate_burst
+    admission.retry_after = args.retry_after
+    poll_advisor.min_interval = args.poll_min
+    poll_advisor.max_interval = args.poll_max
+    poll_advisor.budget = args.poll_budget
+    access_log.destination = args.access_log
+    access_log.sample = args.access_log_sample
+    access_log.max_queue = args.access_log_queue
+    tenants.root = args.tenant_root
+    tenants.budget_bytes = args.tenant_budget_bytes
+    tenants.idle_seconds = args.tenant_idle
+    tenants.enabled = args.processes <= 1
+    # Worker processes and replicas get the document from the supervisor or the primary instead
+    document_file.watch_mode = args.watch if args.processes <= 1 and not args.replicate_from else 'off'
+    document_file.adopt_edits = not args.replicate_from
+    if args.replicate_from:
+        if args.processes > 1:
+            raise SystemExit('--replicate-from needs a single process (drop --processes)')
+        replicator.primary = args.replicate_from
+        replicator.name = args.replica_name or f'{socket.gethostname()}:{args.port}'
+    if args.precompress_only:
+        static_sidecars.build()
+        return
+    # Fork the sidecar build and the image workers before document_file starts the file watcher and the
+    # log compactor: a child forked while one of those threads holds a lock would find it held forever.
+    # With --processes the supervisor's os.wait() loop collects the build process
+    static_sidecars.start(reap=args.processes <= 1)
+    if args.processes <= 1:
+        image_resizer.start()
+    try:
+        document_file.start()
+    except LogInUseError as e:
+        raise SystemExit(f"❌ {e}")
+    raise_open_file_limit()
     
-    port = 8082
+    port = args.port
     server_address = ('0.0.0.0', port)  # Bind to all interfaces
-    httpd = HTTPServer(server_address, CustomizationHandler)
+    httpd = None
+    if args.processes <= 1:
+        httpd = create_server(server_address, args.engine, args.workers)
     
     print(f"🚀 Starting GoEye customization sync server on port {port}")
-    print(f"📱 Mobile app will sync every 5 seconds")
+    print(f"⚙️ Serving engine: {args.engine}" + (f" x {args.processes} processes" if httpd is None else ""))
+    print(f"📱 Mobile apps are advised to sync every "
+          f"{poll_advisor.min_interval:g}-{poll_advisor.max_interval:g} seconds (X-Poll-Interval)")
     print(f"🌐 Web app available at: http://localhost:{port}")
     print(f"🔗 API endpoint: http://localhost:{port}/api/customizations")
+    print(f"📡 Change feed: http://localhost:{port}/api/customizations/stream (SSE) or ?wait=<version>")
+    if tenants.enabled:
+        print(f"🏷️ Tenant API: http://localhost:{port}/api/t/<tenant>/customizations (stored in {tenants.root}/)")
     print(f"💚 Health check: http://localhost:{port}/health")
+    if document_file.mode:
+        print(f"👀 Watching {document_file.path} for edits ({document_file.mode})")
+    print(f"⏱️ Ready in {(time.perf_counter() - started) * 1000:.0f} ms "
+          f"(document loaded in {document_file.load_seconds * 1000:.0f} ms)")
+    if replicator.enabled:
+        print(f"🪞 Read replica of {replicator.primary} (writes are redirected there)")
+    if access_log.enabled:
+        print(f"📝 Access log: {'stdout' if args.access_log == '-' else args.access_log}"
+              + (f" (sampling {args.access_log_sample:.0%})" if args.access_log_sample < 1 else ""))
     print("=" * 50)
     
+    if httpd is None:
+        serve_processes(server_address, args.engine, args.workers, args.processes)
+        return
+    replicator.start()
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
         print("\n🛑 Server stopped by user")
         httpd.server_close()
+        access_log.close()
 
 if __name__ == '__main__':
     main()